@@ -1,8 +1,9 @@
 import streamlit as st
 from collections import namedtuple
-from src.ui.gs_body import render_body
+from src.ui.gs_body import render_body, get_file_type, read_schema
+from src.ui.gs_body import COLUMNAR_TYPES
 from src.ui import gs_utils as gsu
-from src.ui import gs_state
+from src.ui import gs_memory, gs_state, gs_trace, gs_warmup
 
 
 st.set_page_config(
@@ -16,19 +17,21 @@ st.set_page_config(
         'About': "Grid Surfer - Explore tabular datasets"
     })
 
-# app version
-app_version = gsu.get_version()
-
 # setup custom styles
 gsu.init_custom_style()
 
 # initialize session state
 gs_state.init_state()
 
+# preload plot modules and demo datasets, once per server process
+gs_warmup.start(st.session_state['examples'])
+
 
 
 @st.dialog('Grid Surfer')
 def show_help():
+    # app version, may query git in a development checkout
+    app_version = gsu.get_version()
     st.markdown(f'''                
                 &copy; Rajiv Narayan, 2025    
                 Version: `{app_version}`    
@@ -36,7 +39,8 @@ def show_help():
                 GridSurfer is a web application for exploring tabular datasets.
 
                 **Features:**
-                - Load tabular data in CSV, TSV or JSON format
+                - Load tabular data in CSV, TSV, JSON, Parquet or Feather
+                format
                 - Get descriptive statistics on numeric and categorical fields
                 - Visualize univariate and bi-variate distributions via       
                 histograms, dot and scatter plots
@@ -65,9 +69,26 @@ def data_loader():
     input_select = st.session_state['data_select']
     if input_select == 'File':
         selected_ds = st.file_uploader("**Explore your data**", 
-                        type=["csv", "txt", "tsv", "json"],
+                        type=["csv", "txt", "tsv", "json",
+                              "parquet", "pq", "feather", "arrow", "ipc",
+                              "gz", "zst"],
                         label_visibility='visible')
         if selected_ds:
+            file_type, _ = get_file_type(selected_ds.name, selected_ds.type)
+            if file_type in COLUMNAR_TYPES:
+                # Columnar files only materialize the selected columns
+                all_columns = read_schema(selected_ds, file_type)
+                load_columns = st.multiselect('Columns to load:',
+                                              all_columns,
+                                              default=all_columns)
+                if not st.button('Load', type='primary',
+                                 disabled=not load_columns):
+                    return
+                if len(load_columns) == len(all_columns):
+                    load_columns = None
+            else:
+                load_columns = None
+            st.session_state['load_columns'] = load_columns
             st.session_state['data_file'] = selected_ds
             st.rerun()
 
@@ -86,6 +107,7 @@ def data_loader():
         if selected_ds:
             Dataset = namedtuple('Dataset', 
                                     'name source type file')
+            st.session_state['load_columns'] = None
             st.session_state['data_file'] = Dataset(selected_ds, 
                                 **st.session_state.examples[selected_ds])            
             st.rerun()
@@ -107,12 +129,18 @@ def load_data():
     st.session_state['status_bar'] = col_status
 
 def main():
+    gs_memory.start_run()
+    gs_trace.start_run()
     gs_sidebar()        
     load_data()
     h_filter = st.expander('Filter Data',
                            expanded=False,
                            icon=':material/filter_alt:')
     render_body(h_filter)
+    gs_memory.enforce()
+    with st.sidebar:
+        gs_memory.show_usage()
+        gs_trace.show_panel()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,17 @@
 import json
-"""Save information of demo datasets in JSON format"""
+import os
+import sys
+"""
+Save information of demo datasets in JSON format, and precompile them
+
+Each demo is parsed as the app loads it and written, with its column
+profiles, to the bundle read by gs_store (data/demos/ by default). Bundle
+files are named by dataset key, which changes with the file contents and
+gs_store.STORE_VERSION: rerun this script after changing either, e.g. at
+image build. Stale bundle files are removed.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 examples = {
             "Anscombe's Quartet" : {'source': 'vega-dataset',
@@ -19,7 +31,7 @@ examples = {
                         'source': 'local-dataset',
                         'type': 'text/csv',
                         'file': 'data/gapminder-health-income.csv'},
-            'Iris Species': {'source': 'vega-dataset', 
+            'Iris Species': {'source': 'vega-dataset',
                                 'type': None,
                                 'file' : 'iris'},
             'Palmer Penguins' : {'source': 'local-dataset',
@@ -28,5 +40,31 @@ examples = {
                                 },
                     }
 
-with open('demo_datasets.json', 'wt') as out_file:
-    out_file.write(json.dumps(examples, indent=4))
\ No newline at end of file
+
+def save_bundle(examples: dict):
+    """Parse and profile every demo into the bundle"""
+    # demo files are relative to the repository root, like the app
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    from src.ui import gs_body, gs_profile, gs_store, gs_warmup
+    from src.ui import gs_utils as gsu
+    paths = set()
+    for name, demo in examples.items():
+        dataset = gs_warmup.Dataset(name, **demo)
+        key = gs_body.get_dataset_key(dataset)
+        df = gs_body.parse_dataset(dataset)
+        path = gs_store.write_bundle(key, df,
+                                     gs_profile.profile_dataframe(df))
+        paths.add(os.path.abspath(path))
+        print(f'{name}: {len(df)} rows, '
+              f'{gsu.format_bytes(os.path.getsize(path))}')
+    for entry in os.scandir(gs_store.BUNDLE_DIR):
+        if (entry.name.endswith('.arrow') and
+                os.path.abspath(entry.path) not in paths):
+            os.remove(entry.path)
+
+
+with open(os.path.join(ROOT, 'data', 'demo_datasets.json'),
+          'wt') as out_file:
+    out_file.write(json.dumps(examples, indent=4))
+save_bundle(examples)
@@ -1,44 +1,308 @@
 # Descriptive statistics on columns
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import streamlit as st
-from st_aggrid import AgGrid
+from pandas.api.types import is_bool_dtype, is_float_dtype, is_numeric_dtype
+from src.ui import gs_engine
+from src.ui import gs_parallel as gsp
+from src.ui import gs_profile, gs_sketch, gs_tasks, gs_trace
 from src.ui import gs_utils as gsu
 
 
+# Number of Describe results kept per session
+DESCRIBE_CACHE_ENTRIES = 8
+# Rows per block when filling sketches
+SKETCH_CHUNK_ROWS = 1_000_000
+NUMERIC_METRICS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+CATEGORICAL_METRICS = ['count', 'unique', 'top', 'freq']
+
+
 def get_description(df: pd.DataFrame, 
-                    group_var: str=None) -> tuple[pd.DataFrame, pd.DataFrame]:
-    ctypes = gsu.get_df_column_types(df)
-    if group_var is not None:
-        df_desc_num = (df
-                        .loc[:, ctypes['num_columns'] + [group_var]]
-                        .groupby(group_var)
-                        .describe()
-                        .rename_axis(columns = ['field', 'metric'])
-                        .stack(0, future_stack=True)
-                        .sort_values(['field', group_var])
-                        .style
-                        .format(precision=2)
-                        )
+                    group_var: str=None,
+                    profile: dict=None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Descriptive statistics of numeric and categorical fields
+
+    Ungrouped statistics are read from the precomputed column profile of
+    the dataset when profile is given, i.e. when df holds all its rows.
+    Otherwise numeric statistics come from one grouped aggregation plus
+    one grouped quantile pass, in the layout of DataFrame.describe().
+    Large frames are summarized in parallel, split by groups or else by
+    columns, and lazy Tables with aggregate queries.
+    """
+    schema = gs_engine.schema(df)
+    ctypes = gsu.get_df_column_types(schema)
+    # like describe(), numeric statistics skip datetime and bool columns
+    num_columns = [c for c in ctypes['num_columns']
+                   if is_numeric_dtype(schema[c]) and
+                   not is_bool_dtype(schema[c])]
+    if profile is not None and group_var is None:
+        df_desc_num = (gs_profile
+                       .describe_numeric(profile, num_columns)
+                       .rename_axis('field'))
+        df_desc_cat = (gs_profile
+                       .describe_categorical(profile, ctypes['cat_columns'])
+                       .rename_axis('field'))
+        return (df_desc_num, df_desc_cat)
+    if isinstance(df, gs_engine.Table):
+        return describe_table(df, group_var=group_var)
+    # empty column groups get an empty table, as describe() would raise
+    if not num_columns:
+        df_desc_num = (pd.DataFrame(columns=NUMERIC_METRICS)
+                       .rename_axis('field'))
+    elif group_var is not None:
+        parts = gsp.group_partitions(df.loc[:, [group_var, *num_columns]],
+                                     [group_var])
+        df_desc_num = (pd.concat(gsp.map_partitions(summarize_partition,
+                                                    parts, group_var))
+                       .rename_axis(columns=['field', 'metric'])
+                       .stack(0, future_stack=True)
+                       .sort_index(level=['field', group_var])
+                       .loc[:, NUMERIC_METRICS])
     else:
-        df_desc_num = (df
-                       .loc[:, ctypes['num_columns']]
-                       .describe()
-                       .T
-                       .rename_axis('field')
-                       .style.format(precision=2)                           
-                       )
-    df_desc_cat = (df
-                .loc[:, ctypes['cat_columns']]
-                .describe()
-                .T
-                .rename_axis('field')
-                .style.format(precision=2)
-        )
+        parts = [df.loc[:, columns] for columns
+                 in gsp.column_partitions(num_columns, len(df))]
+        df_desc_num = (pd.concat(gsp.map_partitions(summarize_partition,
+                                                    parts))
+                       .unstack()
+                       .loc[:, NUMERIC_METRICS]
+                       .rename_axis('field'))
+    if not ctypes['cat_columns']:
+        df_desc_cat = (pd.DataFrame(columns=CATEGORICAL_METRICS)
+                       .rename_axis('field'))
+        return (df_desc_num, df_desc_cat)
+    parts = [df.loc[:, columns] for columns
+             in gsp.column_partitions(ctypes['cat_columns'], len(df))]
+    df_desc_cat = (pd.concat(gsp.map_partitions(pd.DataFrame.describe,
+                                                parts), axis=1)
+                   .T
+                   .rename_axis('field'))
     return (df_desc_num, df_desc_cat)
 
 
-def show_description(grid: AgGrid):
-    ctypes = gsu.get_df_column_types(grid.data)
+def summarize(data) -> pd.DataFrame | pd.Series:
+    """
+    Count, moments, extremes and quartiles of a frame or grouped frame
+
+    Returns the aggregates indexed by (field, metric), as columns when
+    data is grouped.
+    """
+    stats = data.agg(['count', 'mean', 'std', 'min', 'max'])
+    quartiles = data.quantile([0.25, 0.5, 0.75])
+    if isinstance(data, pd.DataFrame):
+        quartiles.index = ['25%', '50%', '75%']
+        return pd.concat([stats, quartiles]).unstack()
+    quartiles = quartiles.unstack()
+    quartiles.columns = quartiles.columns.set_levels(['25%', '50%', '75%'],
+                                                     level=1)
+    return pd.concat([stats, quartiles], axis=1)
+
+
+def describe_table(table: gs_engine.Table,
+                   group_var: str=None,
+                   approximate: bool=False) -> tuple:
+    """get_description of a lazy Table, optionally with approximate
+    quartiles and distinct counts"""
+    schema = table.schema
+    ctypes = gsu.get_df_column_types(schema)
+    num_columns = [c for c in ctypes['num_columns']
+                   if is_numeric_dtype(schema[c]) and
+                   not is_bool_dtype(schema[c])]
+    group_fields = [group_var] if group_var is not None else []
+    if not num_columns:
+        df_desc_num = (pd.DataFrame(columns=NUMERIC_METRICS)
+                       .rename_axis('field'))
+    else:
+        stats = table.agg(num_columns, ['count', 'mean', 'std', 'min', 'max'],
+                          group_fields)
+        quartiles = table.quantiles(num_columns, [0.25, 0.5, 0.75],
+                                    group_fields, approximate=approximate)
+        quartiles.columns = pd.MultiIndex.from_tuples(
+            [(c, f'{q:.0%}') for c, q in quartiles.columns])
+        summary = pd.concat([stats, quartiles], axis=1)
+        if group_var is not None:
+            df_desc_num = (summary
+                           .rename_axis(columns=['field', 'metric'])
+                           .stack(0, future_stack=True)
+                           .sort_index(level=['field', group_var])
+                           .reindex(columns=NUMERIC_METRICS))
+        else:
+            df_desc_num = (summary
+                           .iloc[0]
+                           .unstack()
+                           .reindex(columns=NUMERIC_METRICS)
+                           .rename_axis('field'))
+
+    cat_columns = ctypes['cat_columns']
+    counts = table.agg(cat_columns, ['count', 'nunique'],
+                       approximate=approximate).iloc[0]
+    rows = {}
+    for column in cat_columns:
+        top = table.value_counts(column, limit=1)
+        rows[column] = {'count': counts[(column, 'count')],
+                        'unique': counts[(column, 'nunique')],
+                        'top': top.index[0] if len(top) else None,
+                        'freq': top.iloc[0] if len(top) else None}
+    df_desc_cat = pd.DataFrame.from_dict(
+        rows, orient='index', columns=CATEGORICAL_METRICS)
+    return (df_desc_num, df_desc_cat.rename_axis('field'))
+
+
+def summarize_partition(df: pd.DataFrame, group_var: str=None):
+    """summarize() of a partition of the rows or columns of a frame"""
+    if group_var is None:
+        return summarize(df)
+    return summarize(df.groupby(group_var, observed=True))
+
+
+def get_approx_description(df: pd.DataFrame,
+                           group_var: str=None,
+                           chunk_rows: int=SKETCH_CHUNK_ROWS) -> tuple:
+    """
+    Descriptive statistics using sketches for quantiles and cardinality
+
+    Sketches are filled in one pass over blocks of chunk_rows rows, in
+    parallel over partitions of the rows, and merged per group. Counts,
+    moments and extremes stay exact. The numeric table adds the bound on
+    the quartile rank error, the categorical table the standard error of
+    the distinct count and the bound on the error of the top value
+    frequency. Lazy Tables use the sketches of their engine instead,
+    without error bounds.
+    """
+    if isinstance(df, gs_engine.Table):
+        return describe_table(df, group_var=group_var, approximate=True)
+    ctypes = gsu.get_df_column_types(df)
+    num_columns = [c for c in ctypes['num_columns']
+                   if is_numeric_dtype(df[c]) and not is_bool_dtype(df[c])]
+    cat_columns = ctypes['cat_columns']
+    partials = gsp.map_partitions(fill_sketches, gsp.row_partitions(df),
+                                  group_var, num_columns, cat_columns,
+                                  chunk_rows)
+    quantiles, distinct, frequent = partials[0]
+    for other in partials[1:]:
+        for key, sketch in other[0].items():
+            if key in quantiles:
+                quantiles[key].merge(sketch)
+            else:
+                quantiles[key] = sketch
+        for column in cat_columns:
+            distinct[column].merge(other[1][column])
+            frequent[column].merge(other[2][column])
+
+    if not num_columns:
+        df_desc_num = (pd.DataFrame(columns=NUMERIC_METRICS +
+                                    ['rank error'])
+                       .rename_axis('field'))
+    else:
+        data = (df.groupby(group_var, observed=True)[num_columns]
+                if group_var is not None else df.loc[:, num_columns])
+        stats = data.agg(['count', 'mean', 'std', 'min', 'max'])
+        if group_var is not None:
+            stats = (stats
+                     .rename_axis(columns=['field', 'metric'])
+                     .stack(0, future_stack=True)
+                     .sort_index(level=['field', group_var]))
+        else:
+            stats = stats.T.rename_axis('field')
+        for label in stats.index:
+            group, column = label if group_var is not None else (None, label)
+            sketch = quantiles[(group, column)]
+            q1, q2, q3 = sketch.quantile([0.25, 0.5, 0.75])
+            stats.loc[label, ['25%', '50%', '75%', 'rank error']] = [
+                q1, q2, q3, sketch.rank_error]
+        df_desc_num = stats.loc[:, NUMERIC_METRICS + ['rank error']]
+
+    rows = {}
+    for column in cat_columns:
+        top = frequent[column].top(1)
+        unique = distinct[column].count()
+        rows[column] = {'count': df[column].count(),
+                        'unique': round(unique),
+                        'unique ±': round(unique *
+                                          distinct[column].relative_error),
+                        'top': top.index[0] if len(top) else None,
+                        'freq': top.iloc[0] if len(top) else None,
+                        'freq ±': frequent[column].count_error}
+    df_desc_cat = pd.DataFrame.from_dict(
+        rows, orient='index',
+        columns=['count', 'unique', 'unique ±', 'top', 'freq', 'freq ±'])
+    return (df_desc_num, df_desc_cat.rename_axis('field'))
+
+
+def fill_sketches(df: pd.DataFrame,
+                  group_var: str,
+                  num_columns: list,
+                  cat_columns: list,
+                  chunk_rows: int=SKETCH_CHUNK_ROWS) -> tuple:
+    """
+    Sketches of a block of rows, see get_approx_description
+
+    Returns:
+    tuple: QuantileSketch by (group, column) of the numeric columns, and
+    HyperLogLog and FrequentItems by column of the categorical columns
+    """
+    quantiles = {}
+    distinct = {c: gs_sketch.HyperLogLog() for c in cat_columns}
+    frequent = {c: gs_sketch.FrequentItems() for c in cat_columns}
+    for start in range(0, len(df), chunk_rows):
+        gs_tasks.check_cancelled()
+        chunk = df.iloc[start:start + chunk_rows]
+        groups = (chunk.groupby(group_var, observed=True)
+                  if group_var is not None else [(None, chunk)])
+        for group, rows in groups:
+            for column in num_columns:
+                sketch = quantiles.setdefault((group, column),
+                                              gs_sketch.QuantileSketch())
+                sketch.update(rows[column].to_numpy(dtype='float64',
+                                                    na_value=np.nan))
+        for column in cat_columns:
+            distinct[column].update(chunk[column])
+            frequent[column].update(chunk[column].dropna())
+    return quantiles, distinct, frequent
+
+
+def get_cached_description(df: pd.DataFrame,
+                           group_var: str=None,
+                           profile: dict=None,
+                           approximate: bool=False) -> tuple:
+    """
+    get_description memoized per dataset, filtered rows and grouping
+
+    Results are kept in session state, least recently used first out,
+    and computed in a background task.
+    """
+    key = (*gs_tasks.frame_key(df), group_var, approximate)
+    cache = st.session_state.setdefault('describe_cache', OrderedDict())
+    if key in cache:
+        gs_trace.annotate(cache='hit')
+        cache.move_to_end(key)
+        return cache[key]
+    if approximate:
+        cache[key] = gs_tasks.run('describe', key, get_approx_description,
+                                  df, group_var=group_var)
+    else:
+        cache[key] = gs_tasks.run('describe', key, get_description,
+                                  df, group_var=group_var, profile=profile)
+    while len(cache) > DESCRIBE_CACHE_ENTRIES:
+        cache.popitem(last=False)
+    return cache[key]
+
+
+def number_format(df: pd.DataFrame) -> dict:
+    """Column config showing floats with 2 decimals"""
+    return {column: st.column_config.NumberColumn(format='%.2f')
+            for column in df.columns[df.dtypes.map(is_float_dtype)]}
+
+
+def show_description(grid: gsu.GridView):
+    ctypes = gs_profile.get_column_types(grid.data)
+    profile = gs_profile.get_profile()
+    if profile:
+        # the profile only applies to the unfiltered dataset
+        p = next(iter(profile.values()))
+        if p.count + p.null_count != len(grid.data):
+            profile = None
     h_main = st.container()
 
     tab_num, tab_cat = st.tabs(['Numeric', 
@@ -47,10 +311,19 @@ def show_description(grid: AgGrid):
         get_describe_options(ctypes)
         group_by = st.session_state['describe_group_by']
 
-        df_desc_num, df_desc_cat = get_description(grid.data, 
-                                                   group_var=group_by)
-        tab_num.dataframe(df_desc_num, use_container_width=True)
-        tab_cat.dataframe(df_desc_cat, use_container_width=True)
+        approximate = st.session_state['describe_approximate']
+        df_desc_num, df_desc_cat = get_cached_description(grid.data, 
+                                                   group_var=group_by,
+                                                   profile=profile,
+                                                   approximate=approximate)
+        if approximate:
+            st.caption('Approximate quartiles and distinct counts, '
+                       'with error bounds')
+        # number formats via column config instead of a pandas Styler
+        tab_num.dataframe(df_desc_num, use_container_width=True,
+                          column_config=number_format(df_desc_num))
+        tab_cat.dataframe(df_desc_cat, use_container_width=True,
+                          column_config=number_format(df_desc_cat))
         
 
 def get_describe_options(ctypes, widget_id='describe_'):
@@ -59,9 +332,14 @@ def get_describe_options(ctypes, widget_id='describe_'):
         with st.container(border=True):
             st.markdown('**Describe Settings**')
             st.selectbox('Group by:',
-                        ctypes['cat_columns'],
+                        ctypes['group_columns'],
                         index=None,
                         label_visibility='visible',
                         help = '''Categorical variable for 
                         calculating grouped statistics of numeric fields''',
                         key=widget_id + 'group_by')
+            st.checkbox('Approximate',
+                        help = '''Estimate quartiles, distinct counts and
+                        top values with streaming sketches, for very large
+                        tables''',
+                        key=widget_id + 'approximate')
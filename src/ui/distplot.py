@@ -1,21 +1,34 @@
+import os
 import streamlit as st
+import numpy as np
 import pandas as pd
 import altair as alt
+from pandas.api.types import is_datetime64_any_dtype
+from src.ui import gs_engine
+from src.ui import gs_parallel as gsp
+from src.ui import gs_profile, gs_tasks
 from src.ui import gs_utils as gsu
 
 """
 Functions to create histograms
 """
 
-def make_dist_plot(grid_return):
+# Above this many rows, bins are counted in pandas and only the counts
+# are sent to the chart
+SERVER_BINNING_ROWS = int(os.environ.get('GS_SERVER_BINNING_ROWS', 10_000))
+# Same tolerance as the Vega bin transform
+BIN_EPSILON = 1e-14
+
+
+def make_dist_plot(grid_return: gsu.GridView):
     """Distribution Plot"""
-    ctypes = gsu.get_df_column_types(grid_return.data)    
+    ctypes = gs_profile.get_column_types(grid_return.data)    
     # settings and options
     opts, opts_types = get_dist_options(ctypes)
 
     # main viz    
     chart = plot_histogram(grid_return.data, opts, opts_types)
-    st.altair_chart(chart, use_container_width=False)
+    gsu.show_chart(chart, use_container_width=False)
 
 def plot_histogram(df: pd.DataFrame, 
                    opts: dict, 
@@ -58,6 +71,23 @@ def plot_histogram(df: pd.DataFrame,
     else:
         selection = alt.selection_multi()
 
+    group_fields = [opts[k] for k in ['color_by', 'facet_by_column',
+                                      'facet_by_row']
+                    if opts[k] is not None]
+    if len(df) <= SERVER_BINNING_ROWS:
+        df = gsu.chart_data(df, [opts['x_axis'], *group_fields])
+    else:
+        # Pre-aggregated counts, drawn with the same bins as Vega-Lite
+        args = (opts['x_axis'], opts['bins'], tuple(group_fields))
+        x_type = ('T' if is_datetime64_any_dtype(
+            gs_engine.schema(df)[opts['x_axis']]) else 'Q')
+        df = gs_tasks.run('histogram', (*gs_tasks.frame_key(df), *args),
+                          bin_counts, df, *args)
+        kwds['x'] = alt.X(f'bin_start:{x_type}', bin='binned',
+                          title=opts['x_axis'])
+        kwds['x2'] = alt.X2(f'bin_end:{x_type}')
+        kwds['y'] = alt.Y('count:Q', title='Count of Records')
+
     chart=(
         alt.Chart(data=df)
         .mark_bar(**mark_kwds)
@@ -75,6 +105,131 @@ def plot_histogram(df: pd.DataFrame,
     return chart
 
 
+def get_bin_params(extent: tuple[float, float],
+                   maxbins: int) -> tuple[float, float, float]:
+    """
+    Bin boundaries as chosen by Vega for 'nice' bins
+
+    Parameters:
+    extent (tuple): (min, max) of the data
+    maxbins (int): maximum number of bins
+
+    Returns:
+    (start, stop, step) of the bins
+    """
+    base, divide = 10, [5, 2]
+    _min, _max = extent
+    span = (_max - _min) or abs(_min) or 1
+    level = np.ceil(np.log(maxbins) / np.log(base))
+    step = base ** (np.round(np.log(span) / np.log(base)) - level)
+    # increase step size if too many bins
+    while np.ceil(span / step) > maxbins:
+        step *= base
+    # decrease step size if allowed
+    for div in divide:
+        if span / (step / div) <= maxbins:
+            step = step / div
+    v = np.log(step)
+    precision = 0 if v >= 0 else int(-v / np.log(base)) + 1
+    eps = base ** (-precision - 1)
+    v = np.floor(_min / step + eps) * step
+    start = v - step if _min < v else v
+    stop = np.ceil(_max / step) * step
+    if stop == start:
+        stop = start + step
+    return start, stop, step
+
+
+def bin_counts(df: pd.DataFrame,
+               x: str,
+               maxbins: int,
+               group_fields: list=()) -> pd.DataFrame:
+    """
+    Count rows per bin of x and per group
+
+    Large frames are counted in parallel over blocks of rows, lazy
+    Tables by a query.
+
+    Parameters:
+    df (pd.DataFrame): input data
+    x (str): numeric or datetime field to bin, datetimes in epoch
+    milliseconds as Vega-Lite bins them
+    maxbins (int): maximum number of bins
+    group_fields (list): categorical fields counted separately, e.g.
+    color and facet fields
+
+    Returns:
+    pd.DataFrame: one row per non-empty bin and group with columns
+    group_fields, bin_start, bin_end and count
+    """
+    lazy = isinstance(df, gs_engine.Table)
+    dtype = gs_engine.schema(df)[x].dtype
+    if lazy:
+        extent = tuple(df.agg([x], ['min', 'max']).iloc[0])
+        if is_datetime64_any_dtype(dtype):
+            extent = tuple(bin_values(pd.Series(extent, dtype=dtype)))
+    else:
+        values = bin_values(df[x])
+        valid = ~np.isnan(values)
+        values = values[valid]
+        extent = ((values.min(), values.max()) if len(values)
+                  else (np.nan, np.nan))
+    if pd.isna(list(extent)).any():
+        return pd.DataFrame(columns=[*group_fields, 'bin_start',
+                                     'bin_end', 'count'])
+    start, stop, step = get_bin_params(extent, maxbins)
+    if lazy:
+        counts = df.bin_counts(x, start, stop, step, group_fields)
+    else:
+        bins = np.floor(BIN_EPSILON +
+                        (np.clip(values, start, stop - step) - start) / step)
+        binned = (df.loc[valid, list(group_fields)]
+                  .assign(_bin=bins.astype(np.int64)))
+        partials = gsp.map_partitions(count_bins,
+                                      gsp.row_partitions(binned),
+                                      group_fields)
+        counts = partials[0]
+        if len(partials) > 1:
+            counts = (pd.concat(partials)
+                      .groupby([*group_fields, 'bin'], observed=True,
+                               dropna=False, sort=False)['count']
+                      .sum()
+                      .reset_index())
+    counts['bin_start'] = start + step * counts.pop('bin')
+    counts['bin_end'] = counts['bin_start'] + step
+    if is_datetime64_any_dtype(dtype):
+        for column in ['bin_start', 'bin_end']:
+            ms = pd.to_datetime(counts[column], unit='ms', utc=True)
+            counts[column] = (ms.dt.tz_convert(dtype.tz)
+                              if getattr(dtype, 'tz', None) is not None
+                              else ms.dt.tz_localize(None))
+    return counts
+
+
+def bin_values(s: pd.Series) -> np.ndarray:
+    """Values of a field to bin as floats, NaN if missing, see bin_counts"""
+    if is_datetime64_any_dtype(s):
+        values = (pd.DatetimeIndex(s).as_unit('ms').asi8
+                  .astype('float64'))
+        # NaT is the smallest int64, not NaN
+        values[s.isna().to_numpy()] = np.nan
+        return values
+    return s.to_numpy(dtype='float64', na_value=np.nan)
+
+
+def count_bins(binned: pd.DataFrame, group_fields: list) -> pd.DataFrame:
+    """Rows per bin and group of a block of rows, see bin_counts"""
+    if group_fields:
+        return (binned
+                .rename(columns={'_bin': 'bin'})
+                .value_counts(dropna=False, sort=False)
+                .rename('count')
+                .reset_index())
+    count = np.bincount(binned['_bin'])
+    return pd.DataFrame({'bin': np.flatnonzero(count),
+                         'count': count[count > 0]})
+
+
 def get_dist_options(ctypes):
     """Get parameters and options for distribution plots"""
     #names_tocheck=['gene_name', 'gene_symbol', 'name',
@@ -126,18 +281,18 @@ def get_dist_options(ctypes):
                                     step=5,
                                     value=30 )
             opts['color_by'] = st.selectbox('Color:',
-                                            ctypes['cat_columns'],
+                                            ctypes['group_columns'],
                                             label_visibility='collapsed',
                                             placeholder='Color by',
                                             index=None)
             opts['facet_by_column'] = st.selectbox('Column Facet:',
-                                                ctypes['cat_columns'], 
+                                                ctypes['group_columns'], 
                                                 label_visibility='visible',
                                                 placeholder='Column facet',  
                                         help='Select field for column facet',
                                                 index=None)
             opts['facet_by_row'] = st.selectbox('Row Facet:',
-                                                ctypes['cat_columns'],
+                                                ctypes['group_columns'],
                                                 label_visibility='collapsed',
                                                 placeholder='Row facet',
                                                 index=None)
@@ -1,27 +1,128 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-from st_aggrid import AgGrid
+from src.ui import gs_engine
+from src.ui import gs_parallel as gsp
+from src.ui import gs_profile, gs_tasks
 from src.ui import gs_utils as gsu
 
 """
 Functions to create dot plots
 """
 
-def make_dot_plot(grid_return: AgGrid):
+def make_dot_plot(grid_return: gsu.GridView):
     """Generate dotplot"""
-    ctypes = gsu.get_df_column_types(grid_return.data)
+    ctypes = gs_profile.get_column_types(grid_return.data)
     # settings and options
     opts, opts_type = get_dot_options(ctypes)
     
     # main viz        
     chart = plot_dot(grid_return.data, opts, opts_type)
-    st.altair_chart(chart, use_container_width=False)
+    gsu.show_chart(chart, use_container_width=False)
+
+
+def summarize_groups(df: pd.DataFrame,
+                     x: str,
+                     group_fields: list,
+                     opts: dict) -> pd.DataFrame:
+    """
+    Box plot, dispersion and average statistics of x per group
+
+    Computed in one grouped aggregation, with the same definitions as the
+    Vega-Lite boxplot (1.5 IQR whiskers clipped to the data) and errorbar
+    marks. The 'ci' extent uses the normal approximation of the 95%
+    confidence interval instead of bootstrapping. Large frames are
+    summarized in parallel, split by groups, lazy Tables by a query.
+
+    Returns:
+    pd.DataFrame: one row per group with columns group_fields, _q1,
+    _median, _q3, _lower, _upper, _avg, _disp0 and _disp1
+    """
+    if isinstance(df, gs_engine.Table):
+        return add_dispersion(df.box_summary(x, group_fields), opts)
+    parts = gsp.group_partitions(df.loc[:, [*group_fields, x]], group_fields)
+    return pd.concat(gsp.map_partitions(summarize_partition, parts, x,
+                                        group_fields, opts),
+                     ignore_index=True)
+
+
+def summarize_partition(df: pd.DataFrame,
+                        x: str,
+                        group_fields: list,
+                        opts: dict) -> pd.DataFrame:
+    """summarize_groups() of a frame holding all rows of its groups"""
+    grouped = df.groupby(group_fields, observed=True, dropna=False)[x]
+    stats = grouped.agg(['count', 'mean', 'std', 'min', 'max'])
+    quartiles = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats['_q1'] = quartiles[0.25]
+    stats['_median'] = quartiles[0.5]
+    stats['_q3'] = quartiles[0.75]
+    iqr = stats['_q3'] - stats['_q1']
+    # whiskers end at the most extreme values within 1.5 IQR
+    fences = pd.DataFrame({'_lo': stats['_q1'] - 1.5 * iqr,
+                           '_hi': stats['_q3'] + 1.5 * iqr})
+    values = df[group_fields + [x]].join(fences, on=group_fields)
+    within = values[x].between(values['_lo'], values['_hi'])
+    whiskers = (values.loc[within]
+                .groupby(group_fields, observed=True, dropna=False)[x]
+                .agg(['min', 'max']))
+    stats['_lower'] = whiskers['min']
+    stats['_upper'] = whiskers['max']
+    return add_dispersion(stats, opts)
+
+
+def add_dispersion(stats: pd.DataFrame, opts: dict) -> pd.DataFrame:
+    """
+    Average and dispersion columns from the box plot statistics
+
+    Parameters:
+    stats (pd.DataFrame): indexed by group, with columns count, mean,
+    std, min, max, _q1, _median, _q3, _lower and _upper
+    opts (dict): plot options, uses agg_average and agg_dispersion
+
+    Returns:
+    pd.DataFrame: see summarize_groups
+    """
+    stats['_avg'] = stats['mean' if opts['agg_average'] == 'mean'
+                          else '_median']
+    stderr = stats['std'] / stats['count'] ** 0.5
+    dispersion = opts['agg_dispersion']
+    if dispersion == 'iqr':
+        stats['_disp0'], stats['_disp1'] = stats['_q1'], stats['_q3']
+    else:
+        half_width = {'stdev': stats['std'],
+                      'stderr': stderr,
+                      'ci': 1.96 * stderr}[dispersion]
+        stats['_disp0'] = stats['mean'] - half_width
+        stats['_disp1'] = stats['mean'] + half_width
+    return (stats
+            .drop(columns=['count', 'mean', 'std', 'min', 'max'])
+            .reset_index())
+
+
+def sample_groups(df: pd.DataFrame,
+                  group_fields: list,
+                  max_points: int) -> pd.DataFrame:
+    """Uniformly downsample rows, keeping the share of every group"""
+    if len(df) <= max_points:
+        return df
+    return (df
+            .groupby(group_fields, observed=True, dropna=False,
+                     group_keys=False)
+            .sample(frac=max_points / len(df), random_state=0))
 
 
 def plot_dot(df: pd.DataFrame,
              opts: dict,
              opts_type: dict) -> alt.Chart:
+    """
+    Generate dotplot
+
+    The box plot, dispersion and average layers are drawn from a per
+    group summary computed in pandas, and at most opts['max_points'] raw
+    points are sent. All layers share one dataset, tagged by a _layer
+    field, so that the layered chart can be faceted.
+    """
     mark_kwds={k: opts.get(k, alt.Undefined) for k in opts_type['mark']}
     kwds={'x' : alt.X(opts['x_axis'],
                         scale = gsu.get_axis_scale(opts['x_scale']),
@@ -32,8 +133,7 @@ def plot_dot(df: pd.DataFrame,
                         opts['y_axis'])
             }
     facet_kwds = {}
-    tooltips=opts.get('add_tooltips', [])
-    select_fields=[]
+    tooltips=list(opts.get('add_tooltips', []))
     facet_header=alt.Header(titleFontSize=16, 
                             labelFontSize=16, 
                             labelAnchor='middle', 
@@ -60,56 +160,87 @@ def plot_dot(df: pd.DataFrame,
         kwds['color']={"field": opts['color_by'],
                        "scale": {"scheme": "tableau10"}}
         tooltips.extend([opts['color_by']])
-        select_fields.extend([opts['color_by']])
 
     tooltips.extend([
             alt.Tooltip(opts['x_axis']),
             alt.Tooltip(opts['y_axis'], format="0.2f")])
 
-    kwds['tooltip']=tooltips
-    
-    chart = (alt.Chart(data=df,
-                        mark = {**mark_kwds})
-                .encode(**kwds)
+    group_fields = list(dict.fromkeys(
+        [opts['y_axis']] + [opts[k] for k in ['color_by', 'column_facet',
+                                              'row_facet']
+                            if opts[k] is not None]))
+    point_fields = list(dict.fromkeys(
+        [opts['x_axis']] + group_fields +
+        list(opts.get('add_tooltips', []))))
+    if not opts['show_points']:
+        points = gs_engine.schema(df).loc[:, point_fields]
+    elif isinstance(df, gs_engine.Table):
+        points = df.sample(opts['max_points'], point_fields)
+    else:
+        points = sample_groups(df.loc[:, point_fields], group_fields,
+                               opts['max_points'])
+    layers = [points.assign(_layer='points')]
+    if (opts['show_boxplot'] or opts['show_dispersion'] or
+            opts['show_average']):
+        key = (*gs_tasks.frame_key(df), opts['x_axis'], tuple(group_fields),
+               opts['agg_average'], opts['agg_dispersion'])
+        summary = gs_tasks.run('dot_summary', key, summarize_groups, df,
+                               opts['x_axis'], group_fields, opts)
+        layers.append(summary.assign(_layer='summary'))
+    data = pd.concat(layers, ignore_index=True)
+
+    chart = (alt.Chart(mark = {**mark_kwds})
+                .encode(**kwds, tooltip=tooltips)
+                .transform_filter(alt.datum._layer == 'points')
                 .properties(width = opts['width'],
                             height = opts['height'])
                 )
+    summary = alt.Chart().transform_filter(alt.datum._layer == 'summary')
+    color = kwds.get('color', alt.Undefined)
+    x_scale = gsu.get_axis_scale(opts['x_scale'])
+    x_title = opts['x_title'] if opts['x_title'] else opts['x_axis']
 
     if opts['show_boxplot'] is True:
-        h_boxplot = (alt.Chart()
-                        .mark_boxplot(extent = 1.5,
-                                      opacity = opts['opacity'],
-                                      outliers={'size':0},
-                                      ticks = False)
-                        .encode(**kwds))
-        chart = alt.layer(chart, h_boxplot, data=df)
+        box_kwds = {'y': kwds['y'], 'color': color}
+        h_whisker = (summary
+                     .mark_rule(opacity = opts['opacity'])
+                     .encode(x=alt.X('_lower:Q', scale=x_scale,
+                                     title=x_title),
+                             x2='_upper:Q', **box_kwds))
+        h_box = (summary
+                 .mark_bar(size = 14, opacity = opts['opacity'])
+                 .encode(x=alt.X('_q1:Q', scale=x_scale, title=x_title),
+                         x2='_q3:Q', **box_kwds))
+        h_median = (summary
+                    .mark_tick(color = 'white', size = 14,
+                               opacity = opts['opacity'])
+                    .encode(x=alt.X('_median:Q', scale=x_scale,
+                                    title=x_title),
+                            y=kwds['y']))
+        chart = alt.layer(chart, h_whisker, h_box, h_median)
 
     if opts['show_dispersion'] is True:
-        agg_kwds = kwds
-        agg_kwds['tooltip'] = alt.Undefined        
-        h_dispersion = (alt.Chart()
-                        .mark_errorbar(extent = opts['agg_dispersion'],
-                                        thickness = 4,
-                                        opacity = opts['opacity'],
-                                        color = opts['default_agg_color'])
-                        .encode(**agg_kwds))
-        chart = alt.layer(chart, h_dispersion, data=df)
+        h_dispersion = (summary
+                        .mark_errorbar(thickness = 4,
+                                       opacity = opts['opacity'],
+                                       color = opts['default_agg_color'])
+                        .encode(x=alt.X('_disp0:Q', scale=x_scale,
+                                        title=x_title),
+                                x2='_disp1:Q', y=kwds['y']))
+        chart = alt.layer(chart, h_dispersion)
 
     if opts['show_average'] is True:
-        agg_kwds = kwds
-        agg_kwds['x'] = alt.X(opts['x_axis'],
-                                aggregate = opts['agg_average'],
-                                title = '')
-        agg_kwds['tooltip'] = alt.Undefined
-        h_avg = (alt.Chart()
+        h_avg = (summary
                     .mark_point(filled = True,
                             strokeWidth = 2,
                             size = 150,
                             opacity = opts['opacity'],
                             color = opts['default_agg_color'])
-                    .encode(**agg_kwds))
-        chart = alt.layer(chart, h_avg, data = df)
+                    .encode(x=alt.X('_avg:Q', scale=x_scale, title=x_title),
+                            y=kwds['y']))
+        chart = alt.layer(chart, h_avg)
 
+    chart = alt.layer(chart, data=data)
     if facet_kwds:
         chart = chart.facet(**facet_kwds)
 
@@ -162,6 +293,11 @@ def get_dot_options(ctypes, widget_id = 'dot_'):
                                                 ['stdev', 'iqr', 'stderr', 
                                                  'ci'],
                                                 index=0)                     
+                opts['max_points'] = st.number_input(
+                    'Max. points:', min_value=100, value=5000, step=1000,
+                    help='Larger tables show a sample of the points, '
+                    'box plots and averages still use all rows',
+                    key=widget_id + 'max_points')
                 opts['width'] = st.slider('Plot Width:', 
                                           min_value = 50, 
                                           max_value=1000, 
@@ -234,19 +370,19 @@ def get_dot_options(ctypes, widget_id = 'dot_'):
                                         index=default_y,
                                         key=widget_id + 'y_axis')
             opts['color_by'] = st.selectbox('Color:', 
-                                            ctypes['cat_columns'],
+                                            ctypes['group_columns'],
                                             label_visibility='collapsed',
                                             placeholder='Color by',
                                             index=None,
                                             key=widget_id + 'color_by')
             opts['column_facet'] = st.selectbox('Column Facet:',
-                                                ctypes['cat_columns'],
+                                                ctypes['group_columns'],
                                                 label_visibility='collapsed',
                                                 placeholder='Column facet',
                                                 index=None,
                                                 key=widget_id + 'column_facet')
             opts['row_facet'] = st.selectbox('Row Facet:',
-                                            ctypes['cat_columns'],
+                                            ctypes['group_columns'],
                                             label_visibility='collapsed',
                                             placeholder='Row facet',
                                             index=None,
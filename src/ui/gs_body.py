@@ -1,63 +1,447 @@
 import streamlit as st
-from st_aggrid import AgGrid, DataReturnMode, GridOptionsBuilder, ColumnsAutoSizeMode
+import numpy as np
 import pandas as pd
 from pandas.api.types import (
-    is_categorical_dtype,
     is_datetime64_any_dtype,
+    is_float_dtype,
     is_numeric_dtype,
     is_object_dtype,
 )
+import importlib
 import json
 import io
-from vega_datasets import local_data
-from src.ui import describe, dotplot, distplot, xyplot
+import os
+import shutil
+from collections import namedtuple
+from src.ui import gs_engine, gs_filter, gs_profile, gs_sample, gs_store
+from src.ui import gs_tasks, gs_trace
 from src.ui import gs_utils as gsu
 
-@st.cache_data
-def read_data(fd, file_type):
+# Map file extensions to the mime types understood by read_data
+FILE_TYPES = {'csv': 'text/csv',
+              'tsv': 'text/tab-separated-values',
+              'txt': 'text/plain',
+              'json': 'application/json',
+              'parquet': 'application/vnd.apache.parquet',
+              'pq': 'application/vnd.apache.parquet',
+              'feather': 'application/vnd.apache.arrow.file',
+              'arrow': 'application/vnd.apache.arrow.file',
+              'ipc': 'application/vnd.apache.arrow.file'}
+COMPRESSIONS = {'gz': 'gzip', 'zst': 'zstd'}
+COLUMNAR_TYPES = ['application/vnd.apache.parquet',
+                  'application/vnd.apache.arrow.file']
+# Tables larger than this are sorted and paged server-side
+GRID_SERVER_ROWS = 50_000
+GRID_PAGE_SIZES = [100, 500, 1000, 5000]
+# Hidden grid column holding row positions in the unpaged frame
+GRID_ROW_ID = '__gs_row__'
+# Rows parsed per block by the streaming CSV reader
+CSV_CHUNK_ROWS = 100_000
+# String columns whose distinct values are at most this fraction of the
+# rows (of the first block for CSV files) are stored as categoricals, the
+# other ones as Arrow strings
+CATEGORY_MAX_RATIO = 0.5
+
+# Upload whose dataset is stored, replacing the raw bytes in session state;
+# path and type are those of the spooled file of an upload queried out of
+# core, see spool_upload
+StoredUpload = namedtuple('StoredUpload', 'name key path type',
+                          defaults=[None, None])
+# Views of the Analyze section: module of src.ui and its render function.
+# Modules are imported on first use, keeping Altair out of the startup
+PLOTS = {'Describe': ('describe', 'show_description'),
+         'Histogram': ('distplot', 'make_dist_plot'),
+         'Dot': ('dotplot', 'make_dot_plot'),
+         'Scatter': ('xyplot', 'make_xy_plot'),
+         'Volcano': ('volcano', 'make_volcano_plot')}
+
+
+def get_file_type(name: str,
+                  mime_type: str=None) -> tuple[str, str]:
+    """
+    Infer file type and compression codec from a file name
+
+    Parameters:
+    name (str): file name, e.g. 'table.csv.gz'
+    mime_type (str): mime type reported by the browser, used when the
+    extension is not recognized
+
+    Returns:
+    file_type (str): mime type of the (decompressed) contents
+    compression (str): 'gzip', 'zstd' or None
+    """
+    suffixes = name.lower().split('.')[1:]
+    compression = None
+    if suffixes and suffixes[-1] in COMPRESSIONS:
+        compression = COMPRESSIONS[suffixes.pop()]
+    file_type = FILE_TYPES.get(suffixes[-1] if suffixes else '', mime_type)
+    return file_type, compression
+
+
+def _arrow_source(fd):
+    """Wrap a path or in-memory upload as a zero-copy Arrow source"""
+    import pyarrow as pa
+    if isinstance(fd, str):
+        return pa.memory_map(fd, 'r')
+    return pa.BufferReader(pa.py_buffer(fd.getbuffer()))
+
+
+def read_schema(fd, file_type: str) -> list[str]:
+    """List column names of a columnar file without reading the data"""
+    import pyarrow.feather as feather
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    source = _arrow_source(fd)
+    if file_type == 'application/vnd.apache.parquet':
+        return pq.read_schema(source).names
+    try:
+        return ipc.open_file(source).schema.names
+    except Exception:
+        # Feather v1 files are not Arrow IPC files
+        return feather.read_table(_arrow_source(fd)).column_names
+
+
+def read_csv_chunked(fd, sep: str=',',
+                     columns: list=None,
+                     progress=None,
+                     chunksize: int=CSV_CHUNK_ROWS) -> pd.DataFrame:
+    """
+    Stream a delimited text file into a compact dataframe
+
+    The input is parsed in blocks of chunksize rows. Column types are
+    inferred on the first block and each block is compacted before the
+    next one is read: low-cardinality strings become categoricals, other
+    strings Arrow strings, and numbers use the narrowest lossless
+    float32/int type. Blocks are assembled one column at a time, so peak
+    memory stays close to the final frame plus one block. Columns with
+    numbers in some blocks and text in others are stored as strings. The
+    sizes before and after compaction are recorded as in compact.
+
+    Parameters:
+    fd: path or binary file-like object
+    sep (str): field delimiter
+    columns (list): columns to keep, None for all
+    progress (callable): called as progress(rows, bytes_read, total_bytes)
+    after every block; total_bytes is None when unknown
+    chunksize (int): rows per block
+
+    Returns:
+    pd.DataFrame: parsed data
+    """
+    if isinstance(fd, str):
+        with open(fd, 'rb') as infile:
+            return read_csv_chunked(infile, sep=sep, columns=columns,
+                                    progress=progress, chunksize=chunksize)
+    if isinstance(fd, io.BytesIO):
+        total_bytes = fd.getbuffer().nbytes
+    elif isinstance(fd, io.IOBase):
+        total_bytes = os.fstat(fd.fileno()).st_size
+    else:
+        total_bytes = None
+    start = (fd.tell() if getattr(fd, 'seekable', lambda: False)()
+             else None)
+    chunks = []
+    cat_columns = None
+    nrows = 0
+    parsed_bytes = 0
+    with pd.read_csv(fd, sep=sep, usecols=columns,
+                     chunksize=chunksize) as reader:
+        for chunk in reader:
+            if cat_columns is None:
+                cat_columns = [c for c in chunk.columns
+                               if is_object_dtype(chunk[c]) and
+                               chunk[c].nunique() <=
+                               CATEGORY_MAX_RATIO * len(chunk)]
+                text_columns = gsu.string_columns(chunk)
+            parsed_bytes += gsu.memory_bytes(chunk)
+            chunks.append(gsu.compact_frame(chunk, cat_columns,
+                                            text_columns))
+            nrows += len(chunk)
+            if progress is not None:
+                progress(nrows, fd.tell(), total_bytes)
+
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    column_names = chunks[0].columns
+    # Columns parsed as numbers in some blocks and text in others are
+    # strings, as with pd.read_csv in one go: re-read as such when
+    # possible, otherwise converted from the parsed blocks
+    import pyarrow as pa
+    text_dtype = pd.ArrowDtype(pa.string())
+    mixed = [c for c in column_names
+             if is_mixed([chunk[c] for chunk in chunks])]
+    text = None
+    if mixed and start is not None:
+        fd.seek(start)
+        with pd.read_csv(fd, sep=sep, usecols=mixed, dtype=str,
+                         chunksize=chunksize) as reader:
+            text = pd.concat([chunk.astype(text_dtype) for chunk in reader],
+                             ignore_index=True)
+    df = {}
+    for column in column_names:
+        parts = [chunk.pop(column) for chunk in chunks]
+        if all(isinstance(p.dtype, pd.CategoricalDtype) for p in parts):
+            df[column] = pd.Series(
+                pd.api.types.union_categoricals(parts, ignore_order=True),
+                name=column)
+        elif column in mixed:
+            df[column] = (text.pop(column) if text is not None else
+                          pd.concat([p.astype(text_dtype) for p in parts],
+                                    ignore_index=True))
+        else:
+            df[column] = pd.concat(
+                [p.astype(object)
+                 if isinstance(p.dtype, pd.CategoricalDtype) else p
+                 for p in parts], ignore_index=True)
+        del parts
+    df = pd.DataFrame(df, columns=column_names, copy=False)
+    df.attrs['compaction'] = (parsed_bytes, gsu.memory_bytes(df))
+    return df
+
+
+def is_mixed(parts: list) -> bool:
+    """
+    Whether blocks of a column were parsed as both numbers and text,
+    blocks of missing values only being of either type
+    """
+    dtypes = {p.dtype for p in parts if p.notna().any()}
+    return (len(dtypes) > 1 and
+            not all(is_numeric_dtype(dtype) for dtype in dtypes))
+
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Store a parsed frame in compact dtypes, see gs_utils.compact_frame
+
+    The memory used before and after is recorded in
+    df.attrs['compaction'], which is kept in the dataset store.
+    """
+    parsed_bytes = gsu.memory_bytes(df)
+    df = gsu.compact_frame(df, max_category_ratio=CATEGORY_MAX_RATIO)
+    df.attrs['compaction'] = (parsed_bytes, gsu.memory_bytes(df))
+    return df
+
+
+def read_data(fd, file_type, columns=None, compression=None, progress=None):
+    """
+    Parse tabular data into a compact dataframe
+
+    Columnar formats (Parquet, Feather/Arrow IPC) are memory mapped when
+    fd is a path, or read zero-copy from the upload buffer, and only the
+    requested columns are materialized. Compressed text is decompressed
+    while streaming through pyarrow. Delimited text is parsed in blocks
+    with progress(rows, bytes_read, total_bytes) called after each block.
+    All formats are compacted, see compact.
+    """
+    if file_type in COLUMNAR_TYPES:
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+        if file_type == 'application/vnd.apache.parquet':
+            table = pq.read_table(_arrow_source(fd), columns=columns)
+        else:
+            table = feather.read_table(_arrow_source(fd), columns=columns)
+        return compact(table.to_pandas(split_blocks=True,
+                                       self_destruct=True))
+
+    if compression is not None:
+        import pyarrow as pa
+        fd = pa.input_stream(fd if isinstance(fd, str) else fd.getbuffer(),
+                             compression=compression)
     if file_type=='text/csv':
-        df = pd.read_csv(fd)
+        df = read_csv_chunked(fd, columns=columns, progress=progress)
     elif file_type in ['text/plain', 'text/tab-separated-values'] :
-        df = pd.read_csv(fd, sep='\t')
+        df = read_csv_chunked(fd, sep='\t', columns=columns,
+                              progress=progress)
     elif file_type=='application/json':
-        df = pd.json_normalize(json.load(fd))
+        if isinstance(fd, str):
+            with open(fd) as infile:
+                df = pd.json_normalize(json.load(infile))
+        else:
+            df = pd.json_normalize(json.load(fd))
+        if columns is not None:
+            df = df.loc[:, columns]
+        df = compact(df)
     else:
-        st.error(f"Unsupported file format: {file_type}")
+        raise ValueError(f"Unsupported file format: {file_type}")
     return df
 
-@st.cache_data
-def data_loader(uploaded_file):
-    
+
+def report_load_progress(rows: int, bytes_read: int, total_bytes: int):
+    """Report parsing progress of the loading task"""
+    if total_bytes:
+        gs_tasks.report_progress(f'{rows} rows, '
+                                 f'{bytes_read/total_bytes:.0%} parsed')
+    else:
+        gs_tasks.report_progress(f'{rows} rows parsed')
+
+
+def get_dataset_key(uploaded_file, columns=None) -> str:
+    """Content fingerprint of an upload or demo dataset"""
+    if isinstance(uploaded_file, StoredUpload):
+        return uploaded_file.key
+    if isinstance(uploaded_file, io.BytesIO):
+        return gs_store.fingerprint(uploaded_file, columns)
+    if uploaded_file.source == 'local-dataset':
+        return gs_store.fingerprint(uploaded_file.file, columns)
+    return gs_store.fingerprint(tuple(uploaded_file), columns)
+
+
+def data_loader(uploaded_file, columns=None):
+    """
+    Load a dataset through the process-wide dataset store
+
+    Parsing runs as a background task, reporting progress in the status
+    bar, and is cancelled if another dataset is picked meanwhile. Large
+    local files and uploads are not parsed but opened as a lazy
+    gs_engine.Table, queried out of core, uploads once spooled to disk.
+
+    The session holds a gs_store.DatasetRef to the frame, shared with the
+    other sessions using it, and an upload is replaced by a StoredUpload
+    once parsed.
+    """
+    key = get_dataset_key(uploaded_file, columns)
+    st.session_state['dataset_key'] = key
+    if getattr(uploaded_file, 'source', None) == 'local-dataset':
+        table = gs_engine.open_table(uploaded_file.file, uploaded_file.type,
+                                     columns)
+        if table is not None:
+            gs_trace.annotate(cache='lazy')
+            st.session_state['dataset_ref'] = None
+            gs_profile.start_profile(key, table)
+            return table
+    if isinstance(uploaded_file, StoredUpload) and uploaded_file.path:
+        if not os.path.exists(uploaded_file.path):
+            st.error("The uploaded file is no longer available, "
+                     "please load it again.")
+            return None
+        table = gs_engine.Table(uploaded_file.path, uploaded_file.type,
+                                columns)
+        gs_trace.annotate(cache='lazy')
+        gs_profile.start_profile(key, table)
+        return table
     if isinstance(uploaded_file, io.BytesIO):
-        try:
-            df = read_data(uploaded_file, uploaded_file.type)
-        except Exception as e:
-            st.error("An error occured loading the file.")
-            st.exception(e) 
-    elif isinstance(uploaded_file, tuple):
-        if uploaded_file.source == 'vega-dataset':
-            df = local_data(uploaded_file.file)
-        elif uploaded_file.source == 'local-dataset':                
+        path = spool_upload(key, uploaded_file)
+        if path is not None:
+            file_type, _ = get_file_type(uploaded_file.name,
+                                         uploaded_file.type)
+            st.session_state['data_file'] = StoredUpload(
+                uploaded_file.name, key, path, file_type)
+            st.session_state['dataset_ref'] = None
+            return data_loader(st.session_state['data_file'], columns)
+    ref = st.session_state.get('dataset_ref')
+    if ref is not None and ref.key == key:
+        gs_trace.annotate(cache='session')
+    else:
+        ref = gs_store.acquire(key)
+        gs_trace.annotate(cache='miss' if ref is None else 'store')
+        if ref is None and isinstance(uploaded_file, StoredUpload):
+            st.error("The uploaded file is no longer available, "
+                     "please load it again.")
+            return None
+        if ref is None:
             try:
-                df = read_data(open(uploaded_file.file), uploaded_file.type)
+                df = gs_tasks.run('load', key, store_dataset, key,
+                                  uploaded_file, columns,
+                                  show_progress=gsu.update_status)
             except Exception as e:
                 st.error("An error occured loading the file.")
                 st.exception(e)
-    return df
+                return None
+            ref = gs_store.acquire(key, df)
+            gs_tasks.discard('load')
+        st.session_state['dataset_ref'] = ref
+    if isinstance(uploaded_file, io.BytesIO):
+        st.session_state['data_file'] = StoredUpload(uploaded_file.name, key)
+    gs_profile.start_profile(key, ref.frame)
+    return ref.frame
+
+
+def spool_upload(key: str, uploaded_file: io.BytesIO) -> str:
+    """
+    Write an upload to be queried out of core to gs_engine.UPLOAD_DIR
+
+    Returns:
+    str or None: path of the spooled file, None when the upload is to be
+    parsed with pandas
+    """
+    file_type, compression = get_file_type(uploaded_file.name,
+                                           uploaded_file.type)
+    if (compression is not None or
+            not gs_engine.is_out_of_core(file_type,
+                                         uploaded_file.getbuffer().nbytes)):
+        return None
+    path = os.path.join(gs_engine.UPLOAD_DIR, key +
+                        os.path.splitext(uploaded_file.name)[1])
+    if not os.path.exists(path):
+        os.makedirs(gs_engine.UPLOAD_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        uploaded_file.seek(0)
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(uploaded_file, f)
+        # atomic so concurrent sessions never open partial files
+        os.replace(tmp_path, path)
+    return path
+
+
+def store_dataset(key: str, uploaded_file, columns=None) -> pd.DataFrame:
+    """Parse a dataset into the store, returns the stored frame"""
+    return gs_store.put(key, parse_dataset(uploaded_file, columns))
+
+
+def parse_dataset(uploaded_file, columns=None) -> pd.DataFrame:
+    """Parse an upload or demo dataset into a compacted frame"""
+    if isinstance(uploaded_file, io.BytesIO):
+        file_type, compression = get_file_type(uploaded_file.name,
+                                               uploaded_file.type)
+        uploaded_file.seek(0)
+        return read_data(uploaded_file, file_type,
+                         columns=columns,
+                         compression=compression,
+                         progress=report_load_progress)
+    if uploaded_file.source == 'vega-dataset':
+        from vega_datasets import local_data
+        return compact(local_data(uploaded_file.file))
+    _, compression = get_file_type(uploaded_file.file)
+    return read_data(uploaded_file.file, uploaded_file.type,
+                     columns=columns,
+                     compression=compression,
+                     progress=report_load_progress)
 
 def render_body(h_filter):
     # Load data
     data_file = st.session_state['data_file']
     if data_file is not None:
-        df_all = data_loader(data_file)
-        with h_filter:
-            df = filter_dataframe(df_all)
-        nrows = df_all.shape[0]
-        nrows_filt = df.shape[0]
-        if nrows == nrows_filt:
-            gsu.update_status(f'{nrows} rows')
-        else:
-            gsu.update_status(f'{nrows_filt}/{nrows} rows')
+        with gs_trace.span('load') as stage:
+            df_all = data_loader(data_file,
+                                 st.session_state.get('load_columns'))
+            if df_all is None:
+                return None
+            nrows = len(df_all)
+            stage['rows_out'] = nrows
+        with h_filter, gs_trace.span('filter_dataframe', rows_in=nrows):
+            df_all, conditions = filter_dataframe(df_all)
+            plan = gs_filter.get_plan(conditions)
+            if gs_filter.get_source_conditions('chart'):
+                st.button('Clear chart selection',
+                          icon=':material/deselect:',
+                          on_click=gs_filter.set_source_conditions,
+                          args=('chart', {}))
+        # all predicates are evaluated in a single pass, the selected rows
+        # are shared by the grid, Describe and the plots
+        with gs_trace.span('filter', rows_in=nrows) as stage:
+            rows = gs_filter.apply_plan(df_all, plan,
+                                        st.session_state['dataset_key'])
+            df = rows.rows
+            nrows_filt = len(df)
+            stage['rows_out'] = nrows_filt
+        status = (f'{nrows} rows' if nrows == nrows_filt
+                  else f'{nrows_filt}/{nrows} rows')
+        compaction = getattr(df_all, 'attrs', {}).get('compaction')
+        if compaction is not None:
+            parsed_bytes, nbytes = compaction
+            status += (f', {gsu.format_bytes(nbytes)} in memory '
+                       f'({gsu.format_bytes(parsed_bytes - nbytes)} saved)')
+        gsu.update_status(status)
         h_plot = st.expander('Analyze',
                              expanded=True,
                              icon=':material/insert_chart:')
@@ -71,36 +455,82 @@ def render_body(h_filter):
             #                     ["Select columns", "Filter data"],
             #                     default=None,
             #                     label_visibility = 'collapsed')
-            grid_return = render_grid(df, h_filter)
+            with gs_trace.span('grid', rows_in=nrows_filt):
+                grid_return = render_grid(df, h_filter)._replace(
+                    base=rows.base)
     
         # Visualization selector
         # Use pills since st.tabs do not support independent rendering
         with h_plot:
+            # large views are analyzed on a sample unless asked otherwise
+            grid_return, sample = gs_sample.sample_view(grid_return)
             plot_select = st.pills("Plots",
-                                ["Describe", "Histogram", "Dot", "Scatter"],
+                                list(PLOTS),
                                 default='Describe',
                                 label_visibility = 'collapsed')
             with st.container(border=False):
-                if plot_select=='Describe':
-                    # Descriptive statistics
-                    describe.show_description(grid_return)
-                if plot_select=='Histogram':
-                    # Histogram
-                    _ = distplot.make_dist_plot(grid_return)
-                elif plot_select=='Dot':
-                    # Dot plot
-                    _ = dotplot.make_dot_plot(grid_return)            
-                elif plot_select=='Scatter':
-                    # Scatter plot
-                    _ = xyplot.make_xy_plot(grid_return)            
+                if plot_select is not None:
+                    with gs_trace.span('plot', name=plot_select,
+                                       rows_in=len(grid_return.data)):
+                        _ = render_plot(plot_select, grid_return)
+            if sample is not None:
+                gs_sample.show_approximate(sample)
 
     return None
 
+
+def render_plot(plot_select: str, grid_return: gsu.GridView):
+    """Render a view of PLOTS, importing its module on first use"""
+    module_name, function = PLOTS[plot_select]
+    module = importlib.import_module(f'src.ui.{module_name}')
+    return getattr(module, function)(grid_return)
+
+
 def render_grid(df: pd.DataFrame,
-                h_filter) -> AgGrid:
-    """Render Grid"""
+                h_filter) -> gsu.GridView:
+    """
+    Render Grid
+
+    Tables with more than GRID_SERVER_ROWS rows use a server-side row
+    model: sorting and paging are evaluated in pandas, or queried from a
+    lazy Table, and only the visible page is sent to the browser. The
+    plots get the frame itself, rather than a copy round-tripped through
+    the grid, and the labels of the selected rows.
+
+    Column filters set in the grid are not applied by the grid, which may
+    only hold a page, but added to the filter plan of the next run.
+    """
+    from st_aggrid import AgGrid, DataReturnMode, GridOptionsBuilder
+    with h_filter: 
+        columns_to_show = st.multiselect('Display columns:',
+                        help = 'Pick columns to display in the grid',
+                                         options=df.columns,
+                                         default=df.columns)
+    lazy = isinstance(df, gs_engine.Table)
+    server_side = lazy or len(df) > GRID_SERVER_ROWS
+    if lazy:
+        # the page is queried, sorted by the engine
+        sort_by, descending = get_grid_sort(columns_to_show)
+        start, stop = get_grid_page(len(df))
+        grid_df = df.fetch(sort_by=sort_by, descending=descending,
+                           offset=start, limit=stop - start)
+        positions = grid_df.index.to_numpy()
+    elif server_side:
+        order = get_grid_order(df, *get_grid_sort(columns_to_show))
+        start, stop = get_grid_page(len(order))
+        positions = order[start:stop]
+        grid_df = df.iloc[positions].loc[:, columns_to_show]
+    else:
+        positions = np.arange(len(df))
+        grid_df = df
+    grid_df = grid_df.assign(**{GRID_ROW_ID: positions})
+    gs_trace.annotate(rows_out=len(grid_df))
+    if gs_trace.enabled():
+        # the grid sends its data as JSON records
+        gs_trace.annotate(bytes=len(grid_df.to_json(orient='records')))
+
     # Infer basic colDefs from dataframe types
-    gb = GridOptionsBuilder.from_dataframe(df)
+    gb = GridOptionsBuilder.from_dataframe(grid_df)
     # opt = {"rowSelection": {"mode": "multiRow"}, 
     #        "autoSizeStrategy" : {"type": 'fitGridWidth'},}
     opt = {"rowSelection": {"mode": "multiRow"}}
@@ -113,26 +543,26 @@ def render_grid(df: pd.DataFrame,
         filterable=False,        
         groupable=True,
         resizable = True,
+        # client-side sorting would only reorder the current page
+        sortable=not server_side,
         editable=False)        
     # Note the sidebar is only available with the enterprise version
     # i.e. set enable_enterprise_modules=True in AgGrid() call
     gb.configure_side_bar(filters_panel=True, columns_panel=True)
     # set precision of numeric columns
-    for f in df.dtypes[df.dtypes=='float64'].index:
+    for f in grid_df.columns[grid_df.dtypes.map(is_float_dtype)]:
         gb.configure_column(f, type=["numericColumn",
                                      "numberColumnFilter","customNumericFormat"], 
                                      precision=2)
+    gb.configure_column(GRID_ROW_ID, hide=True)
     gridOptions = gb.build()
     column_defs = gridOptions['columnDefs']
-    # Set all columns to be filterable
+    # Set all columns to be filterable, see gs_filter.grid_conditions
+    numeric = set(grid_df.columns[grid_df.dtypes.map(
+        lambda t: t.kind in 'biuf')])
     for col in column_defs:
-        col['filter'] = False
-  
-    with h_filter: 
-        columns_to_show = st.multiselect('Display columns:',
-                        help = 'Pick columns to display in the grid',
-                                         options=df.columns,
-                                         default=df.columns)
+        col['filter'] = ('agNumberColumnFilter' if col['field'] in numeric
+                         else 'agTextColumnFilter')
 
     columns_to_hide=set(df.columns).difference(columns_to_show)
 
@@ -140,12 +570,77 @@ def render_grid(df: pd.DataFrame,
         if col['headerName'] in columns_to_hide:
             col['hide'] = True
 
-    grid = AgGrid(df,
+    # The grid data is not returned, only the selection is used
+    # A key keeps the grid state, e.g. column filters, when data changes
+    grid = AgGrid(grid_df,
                   gridOptions=gridOptions,
                   fit_columns_on_grid_load=True,
-                  data_return_mode=DataReturnMode.FILTERED_AND_SORTED)
-    
-    return grid
+                  data_return_mode=DataReturnMode.AS_INPUT,
+                  key='grid')
+    if gs_filter.set_source_conditions(
+            'grid', gs_filter.grid_conditions(grid.grid_state)):
+        st.rerun()
+
+    selected = grid.selected_data
+    if selected is not None and GRID_ROW_ID in selected.columns:
+        selected_positions = selected[GRID_ROW_ID].astype(int)
+    else:
+        selected_positions = []
+    if lazy:
+        # only the fetched page is available
+        selected_rows = (grid_df
+                         .loc[selected_positions]
+                         .drop(columns=GRID_ROW_ID))
+        return gsu.GridView(df, selected_rows, df)
+    selected_rows = df.index[selected_positions]
+    return gsu.GridView(df, selected_rows, df)
+
+
+def get_grid_sort(columns: list) -> tuple[str, bool]:
+    """Sort controls for the server-side grid, returns (column, descending)"""
+    col_sort, col_dir = st.columns([0.8, 0.2],
+                                   vertical_alignment='bottom')
+    sort_by = col_sort.selectbox('Sort by:', columns, index=None,
+                                 placeholder='Sort by',
+                                 label_visibility='collapsed',
+                                 key='grid_sort_by')
+    descending = col_dir.toggle('Descending', key='grid_descending')
+    return sort_by, descending
+
+
+def get_grid_order(df: pd.DataFrame,
+                   sort_by: str,
+                   descending: bool) -> np.ndarray:
+    """Row positions of the server-side grid in sort order"""
+    if sort_by is None:
+        return np.arange(len(df))
+    # Sorting millions of rows is slow, reuse the order across reruns
+    key = (st.session_state['dataset_key'],
+           gsu.index_fingerprint(df.index), sort_by, descending)
+    cached = st.session_state.get('grid_order')
+    if cached is None or cached[0] != key:
+        # stable in both directions, missing values last
+        order = (df[sort_by].reset_index(drop=True)
+                 .sort_values(ascending=not descending, kind='stable',
+                              na_position='last')
+                 .index.to_numpy())
+        st.session_state['grid_order'] = (key, order)
+    return st.session_state['grid_order'][1]
+
+
+def get_grid_page(nrows: int) -> tuple[int, int]:
+    """Paging controls for the server-side grid, returns (start, stop)"""
+    col_size, col_page, col_info = st.columns([0.2, 0.2, 0.6],
+                                             vertical_alignment='bottom')
+    page_size = col_size.selectbox('Rows per page:', GRID_PAGE_SIZES,
+                                   key='grid_page_size')
+    npages = max(1, -(-nrows // page_size))
+    page = col_page.number_input('Page:', min_value=1, max_value=npages,
+                                 step=1, key='grid_page')
+    start = (page - 1) * page_size
+    stop = min(start + page_size, nrows)
+    col_info.caption(f'Rows {start + 1}-{stop} of {nrows}')
+    return start, stop
 
 
 def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
@@ -156,7 +651,8 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
         df (pd.DataFrame): Original dataframe
 
     Returns:
-        pd.DataFrame: Filtered dataframe
+        pd.DataFrame: df, with date-like columns converted if filtering
+        dict: filter conditions by column, see gs_filter.condition_mask
     
     See: https://blog.streamlit.io/auto-generate-a-dataframe-filtering-ui-in-streamlit-with-filter_dataframe/
     """
@@ -164,38 +660,46 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
                          help='Filter data columns conditionally')
 
     if not modify:
-        return df
-
-    df = df.copy()
+        return df, {}
 
     # Try to convert datetimes into a standard format (datetime, no timezone)
-    for col in df.columns:
-        if is_object_dtype(df[col]):
-            try:
-                df[col] = pd.to_datetime(df[col])
-            except Exception:
-                pass
-
-        if is_datetime64_any_dtype(df[col]):
-            df[col] = df[col].dt.tz_localize(None)
+    dataset_key = st.session_state['dataset_key']
+    df = gs_filter.coerce_datetimes(df, dataset_key)
 
+    profile = gs_profile.get_profile(dataset_key)
+    schema = gs_engine.schema(df)
     modification_container = st.container()
+    conditions = {}
 
     with modification_container:
         to_filter_columns = st.multiselect("Filter dataframe on", df.columns)
         for column in to_filter_columns:
             left, right = st.columns((1, 20))
+            p = profile[column]
+            cardinality, values = p.cardinality, p.values
+            if (is_datetime64_any_dtype(schema[column]) and
+                    p.kind != 'datetime'):
+                # converted by coerce_datetimes, the profile is of strings
+                cardinality, values = df[column].nunique(), None
             # Treat columns with < 10 unique values as categorical
-            if is_categorical_dtype(df[column]) or df[column].nunique() < 10:
+            if (isinstance(schema[column].dtype, pd.CategoricalDtype) or
+                    cardinality < 10):
+                if values is None:
+                    values = df[column].dropna().unique()
+                values = list(values)
+                if p.null_count:
+                    # missing values, see gs_filter.condition_mask
+                    values.append(None)
                 user_cat_input = right.multiselect(
                     f"Values for {column}",
-                    df[column].unique(),
-                    default=list(df[column].unique()),
+                    values,
+                    default=list(values),
                 )
-                df = df[df[column].isin(user_cat_input)]
-            elif is_numeric_dtype(df[column]):
-                _min = float(df[column].min())
-                _max = float(df[column].max())
+                if len(user_cat_input) < len(values):
+                    conditions[column] = ('isin', *user_cat_input)
+            elif p.kind == 'numeric' and p.min is not None:
+                _min = float(p.min)
+                _max = float(p.max)
                 step = (_max - _min) / 100
                 user_num_input = right.slider(
                     f"Values for {column}",
@@ -204,27 +708,28 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
                     value=(_min, _max),
                     step=step,
                 )
-                df = df[df[column].between(*user_num_input)]
-            elif is_datetime64_any_dtype(df[column]):
+                if user_num_input != (_min, _max):
+                    conditions[column] = ('between', *user_num_input)
+            elif is_datetime64_any_dtype(schema[column]):
+                # columns converted by coerce_datetimes have no profile
+                # range
+                if isinstance(df, gs_engine.Table):
+                    date_range = (p.min, p.max)
+                else:
+                    date_range = (df[column].min(), df[column].max())
                 user_date_input = right.date_input(
                     f"Values for {column}",
-                    value=(
-                        df[column].min(),
-                        df[column].max(),
-                    ),
+                    value=date_range,
                 )
                 if len(user_date_input) == 2:
                     user_date_input = tuple(map(pd.to_datetime, 
                                                 user_date_input))
-                    start_date, end_date = user_date_input
-                    df = df.loc[df[column].between(start_date, end_date)]
+                    conditions[column] = ('between', *user_date_input)
             else:
                 user_text_input = right.text_input(
                     f"Substring or regex in {column}",
                 )
                 if user_text_input:
-                    df = (df[df[column]
-                             .astype(str)
-                             .str.contains(user_text_input)])
+                    conditions[column] = ('contains', user_text_input)
 
-    return df
\ No newline at end of file
+    return df, conditions
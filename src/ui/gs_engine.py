@@ -0,0 +1,504 @@
+"""Out-of-core query engine for datasets larger than memory
+
+Datasets are pandas frames by default, and all computations use pandas.
+Local CSV/TSV and Parquet files larger than OUT_OF_CORE_BYTES are instead
+opened as a lazy Table when DuckDB is installed, as are uploads of these
+types once spooled to UPLOAD_DIR: the file is scanned by
+DuckDB, filters are kept as conditions, and statistics and chart
+aggregations are pushed down as SQL queries. Only their small results,
+or a page or sample of rows, are pulled into pandas.
+
+Modules accept either kind of dataset and dispatch on
+isinstance(df, Table), calling the Table methods below, which mirror the
+pandas operations they replace.
+"""
+import importlib.util
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
+
+from src.ui import gs_store
+
+# 'auto': files above OUT_OF_CORE_BYTES, 'duckdb': all supported files,
+# 'pandas': never
+ENGINE = os.environ.get('GS_ENGINE', 'auto')
+OUT_OF_CORE_BYTES = int(os.environ.get('GS_OUT_OF_CORE_BYTES', 2**30))
+# DuckDB spills to TEMP_DIR beyond this memory
+MEMORY_LIMIT = os.environ.get('GS_DUCKDB_MEMORY', '2GB')
+TEMP_DIR = os.environ.get(
+    'GS_DUCKDB_TEMP', os.path.join(os.path.dirname(gs_store.CACHE_DIR),
+                                   'duckdb'))
+# Large uploads are spooled there, named by their dataset key
+UPLOAD_DIR = os.environ.get(
+    'GS_UPLOAD_DIR', os.path.join(os.path.dirname(gs_store.CACHE_DIR),
+                                  'uploads'))
+# Rows pulled into pandas for charts of raw rows
+SAMPLE_ROWS = int(os.environ.get('GS_SAMPLE_ROWS', 50_000))
+# Table functions scanning each supported file type
+SQL_READERS = {'text/csv': "read_csv({}, delim=',', header=true)",
+               'text/plain': "read_csv({}, delim='\t', header=true)",
+               'text/tab-separated-values':
+                   "read_csv({}, delim='\t', header=true)",
+               'application/vnd.apache.parquet': 'read_parquet({})'}
+# Aggregate functions of Table.agg, on columns cast to double if marked
+SQL_AGGREGATES = {'count': ('count({})', False),
+                  'nunique': ('count(DISTINCT {})', False),
+                  'min': ('min({})', False),
+                  'max': ('max({})', False),
+                  'mean': ('avg({})', True),
+                  'std': ('stddev_samp({})', True),
+                  'median': ('quantile_cont({}, 0.5)', True)}
+APPROX_AGGREGATES = {'nunique': ('approx_count_distinct({})', False),
+                     'median': ('approx_quantile({}, 0.5)', True)}
+# Axis scale transforms of Table.cell_counts, NULL outside their domain
+SQL_TRANSFORMS = {'linear': '{}',
+                  'log10': 'CASE WHEN {0} > 0 THEN log10({0}) END',
+                  'log2': 'CASE WHEN {0} > 0 THEN log2({0}) END'}
+
+_connection = None
+_lock = threading.Lock()
+
+
+def is_available() -> bool:
+    return importlib.util.find_spec('duckdb') is not None
+
+
+def open_table(path: str, file_type: str, columns: list=None):
+    """
+    Open a local file as a lazy Table if it should be queried out of core
+
+    Returns:
+    Table or None: None when the file is to be loaded with pandas
+    """
+    if not is_out_of_core(file_type, os.path.getsize(path)):
+        return None
+    return Table(path, file_type, columns)
+
+
+def is_out_of_core(file_type: str, nbytes: int) -> bool:
+    """Whether a file of file_type and nbytes is to be queried out of core"""
+    if (ENGINE == 'pandas' or file_type not in SQL_READERS or
+            not is_available()):
+        return False
+    return ENGINE == 'duckdb' or nbytes > OUT_OF_CORE_BYTES
+
+
+def schema(df) -> pd.DataFrame:
+    """Empty frame with the columns and dtypes of a frame or Table"""
+    return df.schema if isinstance(df, Table) else df.iloc[:0]
+
+
+def get_connection():
+    """Process-wide DuckDB database, queried through per-thread cursors"""
+    global _connection
+    import duckdb
+    with _lock:
+        if _connection is None:
+            os.makedirs(TEMP_DIR, exist_ok=True)
+            _connection = duckdb.connect(config={
+                'memory_limit': MEMORY_LIMIT,
+                'temp_directory': TEMP_DIR})
+        return _connection
+
+
+def quote(name: str) -> str:
+    """SQL identifier"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _literal(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _condition_sql(column: str, condition: tuple) -> tuple[str, list]:
+    """SQL predicate and parameters of a gs_filter condition"""
+    kind, *args = condition
+    column = quote(column)
+    if kind == 'isin':
+        values = [v for v in args if v is not None]
+        sql = (f"{column} IN ({', '.join('?' * len(values))})" if values
+               else 'false')
+        if len(values) < len(args):
+            sql = f'({sql} OR {column} IS NULL)'
+        return sql, values
+    if kind == 'between':
+        return f'{column} BETWEEN ? AND ?', list(args)
+    if kind == 'greater':
+        return f'{column} > ?', [args[0]]
+    if kind == 'less':
+        return f'{column} < ?', [args[0]]
+    if kind == 'contains':
+        options = ", 'i'" if len(args) > 1 and not args[1] else ''
+        return (f'regexp_matches(CAST({column} AS VARCHAR), ?{options})',
+                [args[0]])
+    raise ValueError(f'Unknown filter condition: {kind}')
+
+
+class Table:
+    """
+    Lazy table: a file scanned by DuckDB, restricted to the rows matching
+    filter conditions
+
+    Parameters:
+    path (str): CSV, TSV or Parquet file, optionally compressed
+    file_type (str): mime type, one of SQL_READERS
+    columns (list): columns to keep, None for all
+    conditions: (column, condition) pairs, as in gs_filter.condition_mask
+    """
+
+    def __init__(self, path: str, file_type: str, columns: list=None,
+                 conditions=()):
+        self.path = path
+        self.file_type = file_type
+        self.columns_loaded = columns
+        self.conditions = frozenset(conditions)
+        self._schema = None
+        self._len = None
+
+    @property
+    def key(self) -> tuple:
+        """Hashable identity of the rows and columns"""
+        return (self.path, self.file_type,
+                None if self.columns_loaded is None
+                else tuple(self.columns_loaded),
+                self.conditions)
+
+    def filter(self, conditions) -> 'Table':
+        """
+        Table of the rows also matching conditions, (column, condition)
+        pairs with None conditions ignored
+        """
+        conditions = {(column, condition) for column, condition in conditions
+                      if condition is not None}
+        table = Table(self.path, self.file_type, self.columns_loaded,
+                      self.conditions.union(conditions))
+        if not conditions:
+            table._schema, table._len = self._schema, self._len
+        return table
+
+    def _relation(self) -> tuple[str, list]:
+        """SQL query of the rows and its parameters"""
+        source = SQL_READERS[self.file_type].format(_literal(self.path))
+        columns = ('*' if self.columns_loaded is None
+                   else ', '.join(map(quote, self.columns_loaded)))
+        sql = f'SELECT {columns} FROM {source}'
+        params = []
+        predicates = []
+        for column, condition in sorted(self.conditions, key=repr):
+            predicate, args = _condition_sql(column, condition)
+            predicates.append(predicate)
+            params.extend(args)
+        if predicates:
+            sql += ' WHERE ' + ' AND '.join(predicates)
+        return sql, params
+
+    def query(self, sql: str, params: list=()) -> pd.DataFrame:
+        """
+        Run a query on the rows, referred to as table t in sql
+
+        sql may start with a WITH clause of more common table expressions.
+        Parameters are bound in order, after those of the filters.
+        """
+        relation, relation_params = self._relation()
+        if sql.startswith('WITH '):
+            sql = ', ' + sql[len('WITH '):]
+        else:
+            sql = ' ' + sql
+        cursor = get_connection().cursor()
+        try:
+            return (cursor
+                    .execute(f'WITH t AS ({relation}){sql}',
+                             relation_params + list(params))
+                    .df())
+        finally:
+            cursor.close()
+
+    @property
+    def schema(self) -> pd.DataFrame:
+        """Empty frame with the columns and pandas dtypes of the rows"""
+        if self._schema is None:
+            self._schema = self.query('SELECT * FROM t LIMIT 0')
+        return self._schema
+
+    @property
+    def columns(self) -> pd.Index:
+        return self.schema.columns
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = int(self.query('SELECT count(*) FROM t').iloc[0, 0])
+        return self._len
+
+    def fetch(self, columns: list=None, sort_by: str=None,
+              descending: bool=False, offset: int=0,
+              limit: int=None) -> pd.DataFrame:
+        """
+        Rows from offset, in file order or sorted, as a pandas frame
+
+        The index holds the positions of the rows in that order.
+        """
+        select = '*' if columns is None else ', '.join(map(quote, columns))
+        sql = f'SELECT {select} FROM t'
+        if sort_by is not None:
+            sql += (f" ORDER BY {quote(sort_by)} "
+                    f"{'DESC' if descending else 'ASC'} NULLS LAST")
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        sql += f' OFFSET {int(offset)}'
+        df = self.query(sql)
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        return df
+
+    def sample(self, n: int, columns: list=None) -> pd.DataFrame:
+        """Uniform sample of at most n rows, all rows if fewer"""
+        select = '*' if columns is None else ', '.join(map(quote, columns))
+        return self.query(f'SELECT {select} FROM t '
+                          f'USING SAMPLE reservoir({int(n)} ROWS) '
+                          f'REPEATABLE (0)')
+
+    def stratified_sample(self, column: str, n: int, min_rows: int,
+                          columns: list=None) -> pd.DataFrame:
+        """
+        Sample of about n rows keeping every group of column, see
+        gs_sample.group_quotas
+        """
+        select = '*' if columns is None else ', '.join(map(quote, columns))
+        return self.query(
+            # rows hashed rather than shuffled: reruns draw the same rows
+            f'WITH s AS (SELECT *, '
+            f'row_number() OVER (PARTITION BY {quote(column)} '
+            f'ORDER BY hash(t)) AS _rank, '
+            f'count(*) OVER (PARTITION BY {quote(column)}) AS _size '
+            f'FROM t) '
+            f'SELECT {select} FROM s '
+            f'WHERE _rank <= greatest(floor(? * _size / ?), ?)',
+            [int(n), len(self), int(min_rows)])
+
+    def _grouped(self, select: list, group_fields: list) -> pd.DataFrame:
+        groups = list(map(quote, group_fields))
+        # a placeholder aggregate keeps the groups when select is empty
+        select = groups + select + ['count(*) AS _']
+        sql = f"SELECT {', '.join(select)} FROM t"
+        if groups:
+            # sorted groups, as in pandas
+            sql += (f" GROUP BY {', '.join(groups)}"
+                    f" ORDER BY {', '.join(groups)}")
+        df = self.query(sql).drop(columns='_')
+        return df.set_index(list(group_fields)) if group_fields else df
+
+    def agg(self, columns: list, funcs: list, group_fields: list=(),
+            approximate: bool=False) -> pd.DataFrame:
+        """
+        Aggregates of columns, optionally per group
+
+        Parameters:
+        columns (list): columns to aggregate
+        funcs (list): names of SQL_AGGREGATES
+        group_fields (list): fields to group by
+        approximate (bool): estimate distinct counts and medians
+
+        Returns:
+        pd.DataFrame: columns (column, func), one row per group indexed by
+        group_fields, a single row when ungrouped
+        """
+        aggregates = ({**SQL_AGGREGATES, **APPROX_AGGREGATES}
+                      if approximate else SQL_AGGREGATES)
+        select = []
+        labels = []
+        for column in columns:
+            for func in funcs:
+                template, as_double = aggregates[func]
+                expr = (f'CAST({quote(column)} AS DOUBLE)' if as_double
+                        else quote(column))
+                select.append(f'{template.format(expr)} AS _{len(labels)}')
+                labels.append((column, func))
+        df = self._grouped(select, group_fields)
+        df.columns = pd.MultiIndex.from_tuples(labels, names=[None, None])
+        return df
+
+    def quantiles(self, columns: list, q: list, group_fields: list=(),
+                  approximate: bool=False) -> pd.DataFrame:
+        """
+        Quantiles of numeric columns, interpolated as in pandas or
+        estimated with t-digest sketches when approximate
+
+        Returns:
+        pd.DataFrame: columns (column, q), indexed as in agg
+        """
+        func = 'approx_quantile' if approximate else 'quantile_cont'
+        points = '[' + ', '.join(map(repr, map(float, q))) + ']'
+        select = [f'{func}(CAST({quote(c)} AS DOUBLE), {points}) AS _{i}'
+                  for i, c in enumerate(columns)]
+        df = self._grouped(select, group_fields)
+        parts = []
+        for i, column in enumerate(columns):
+            values = np.array([v if v is not None and len(v)
+                               else [np.nan] * len(q)
+                               for v in df[f'_{i}']], dtype='float64')
+            parts.append(pd.DataFrame(
+                values.reshape(len(df), len(q)), index=df.index,
+                columns=pd.MultiIndex.from_product([[column], q])))
+        return pd.concat(parts, axis=1) if parts else df
+
+    def value_counts(self, column: str, limit: int=None) -> pd.Series:
+        """Counts of non-null values, most frequent first"""
+        sql = (f'SELECT {quote(column)}, count(*) AS count FROM t '
+               f'WHERE {quote(column)} IS NOT NULL '
+               f'GROUP BY {quote(column)} ORDER BY count DESC')
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return self.query(sql).set_index(column)['count']
+
+    def bin_counts(self, x: str, start: float, stop: float, step: float,
+                   group_fields: list=()) -> pd.DataFrame:
+        """
+        Rows per bin of x and per group, bins as in distplot.bin_counts
+
+        Returns:
+        pd.DataFrame: columns group_fields, bin (index from start) and
+        count
+        """
+        value = (f'CAST(epoch_ms({quote(x)}) AS DOUBLE)'
+                 if is_datetime64_any_dtype(self.schema[x])
+                 else f'CAST({quote(x)} AS DOUBLE)')
+        bin_sql = (f'CAST(floor(1e-14 + (least(greatest({value}, ?), ?) - ?)'
+                   f' / ?) AS BIGINT)')
+        groups = list(map(quote, group_fields))
+        return self.query(
+            f"SELECT {', '.join(groups + [bin_sql + ' AS bin'])}, "
+            f"count(*) AS count FROM t "
+            f"WHERE {value} IS NOT NULL AND NOT isnan({value}) "
+            f"GROUP BY ALL",
+            [start, stop - step, start, step])
+
+    def cell_counts(self, axes: dict, nbins: int,
+                    group_fields: list=()) -> tuple:
+        """
+        2D histogram, regular in the space of the axis scales
+
+        Parameters:
+        axes (dict): (column, scale) by axis name 'x' and 'y', scale one
+        of SQL_TRANSFORMS
+        nbins (int): bins per axis
+        group_fields (list): fields counted separately
+
+        Returns:
+        tuple: (counts, bounds) with counts columns group_fields, _cell
+        (x bin * nbins + y bin) and count, and bounds the (min, step) by
+        axis in the scale space; (None, None) without finite values
+        """
+        grid = self._grid(axes, nbins)
+        if grid is None:
+            return None, None
+        _, valid, cell, params, bounds = grid
+        groups = list(map(quote, group_fields))
+        counts = self.query(
+            f"SELECT {', '.join(groups)}{', ' if groups else ''}"
+            f"{cell} AS _cell, "
+            f"count(*) AS count FROM t WHERE {valid} GROUP BY ALL",
+            params)
+        return counts, bounds
+
+    def _grid(self, axes: dict, nbins: int) -> tuple:
+        """
+        SQL of a regular grid in the space of the axis scales, see
+        cell_counts
+
+        Returns:
+        tuple: (values, valid, cell, params, bounds) with values the
+        scaled value by axis, valid the predicate of finite values, cell
+        the cell number and params its parameters; None without finite
+        values
+        """
+        values = {axis: SQL_TRANSFORMS[scale].format(
+                      f'CAST({quote(column)} AS DOUBLE)')
+                  for axis, (column, scale) in axes.items()}
+        valid = ' AND '.join(f'isfinite({v})' for v in values.values())
+        extent = self.query(
+            'SELECT ' + ', '.join(f'min({v}), max({v})'
+                                  for v in values.values()) +
+            f' FROM t WHERE {valid}').iloc[0]
+        if extent.isna().any():
+            return None
+        bounds = {}
+        cells = []
+        params = []
+        for i, axis in enumerate(values):
+            _min = float(extent.iloc[2 * i])
+            _max = float(extent.iloc[2 * i + 1])
+            step = (_max - _min) / nbins or 1.
+            bounds[axis] = (_min, step)
+            cells.append(f'least(CAST(floor(({values[axis]} - ?) / ?) '
+                         f'AS BIGINT), {int(nbins) - 1})')
+            params.extend([_min, step])
+        cell = f'{cells[0]} * {int(nbins)} + {cells[1]}'
+        return values, valid, cell, params, bounds
+
+    def thin(self, axes: dict, nbins: int, cell_rows: int,
+             extreme_rows: int, group_fields: list=(),
+             columns: list=None) -> pd.DataFrame:
+        """
+        Points of a plot thinned on a grid, see xyplot.thin_points
+
+        Parameters:
+        axes (dict): (column, scale) by axis, as in cell_counts
+        nbins (int): cells per axis
+        cell_rows (int): rows kept per cell and group
+        extreme_rows (int): rows kept at each end of each axis
+        group_fields (list): fields thinned separately
+        columns (list): columns returned, None for all
+        """
+        grid = self._grid(axes, nbins)
+        if grid is None:
+            return self.schema if columns is None else self.schema[columns]
+        values, valid, cell, params, _ = grid
+        select = ('* EXCLUDE (_cell, _rank, _x_lo, _x_hi, _y_lo, _y_hi)'
+                  if columns is None else ', '.join(map(quote, columns)))
+        partition = ', '.join([*map(quote, group_fields), '_cell'])
+        ends = ', '.join(
+            f'row_number() OVER (ORDER BY {values[axis]} {order}) '
+            f'AS _{axis}_{end}'
+            for axis in ['x', 'y']
+            for end, order in [('lo', 'ASC'), ('hi', 'DESC')])
+        # points ranked by their hash, reruns draw the same points
+        return self.query(
+            f'WITH v AS (SELECT *, {cell} AS _cell FROM t WHERE {valid}), '
+            f'r AS (SELECT *, row_number() OVER (PARTITION BY {partition} '
+            f'ORDER BY hash(v)) AS _rank, {ends} FROM v) '
+            f'SELECT {select} FROM r WHERE _rank <= ? OR '
+            f'least(_x_lo, _x_hi, _y_lo, _y_hi) <= ?',
+            [*params, int(cell_rows), int(extreme_rows)])
+
+    def box_summary(self, x: str, group_fields: list) -> pd.DataFrame:
+        """
+        Box plot statistics of x per group
+
+        Returns:
+        pd.DataFrame: indexed by group_fields, with columns count, mean,
+        std, min, max, _q1, _median, _q3 and _lower, _upper: the most
+        extreme values within 1.5 IQR of the quartiles
+        """
+        value = f'CAST({quote(x)} AS DOUBLE)'
+        quoted = list(map(quote, group_fields))
+        groups = ', '.join(quoted)
+        s_groups = ', '.join(f's.{g}' for g in quoted)
+        same_group = ' AND '.join(f'v.{g} IS NOT DISTINCT FROM s.{g}'
+                                  for g in quoted)
+        df = self.query(
+            f'WITH v AS (SELECT {groups}, {value} AS x FROM t), '
+            f's AS (SELECT {groups}, count(x) AS count, avg(x) AS mean, '
+            f'stddev_samp(x) AS std, min(x) AS min, max(x) AS max, '
+            f'quantile_cont(x, 0.25) AS _q1, '
+            f'quantile_cont(x, 0.5) AS _median, '
+            f'quantile_cont(x, 0.75) AS _q3 FROM v GROUP BY ALL) '
+            f'SELECT s.*, w._lower, w._upper FROM s LEFT JOIN '
+            f'(SELECT {s_groups}, '
+            f'min(v.x) AS _lower, max(v.x) AS _upper '
+            f'FROM v JOIN s ON {same_group} '
+            f'WHERE v.x BETWEEN s._q1 - 1.5 * (s._q3 - s._q1) '
+            f'AND s._q3 + 1.5 * (s._q3 - s._q1) GROUP BY ALL) w ON '
+            + same_group.replace('v.', 'w.'))
+        return df.set_index(list(group_fields))
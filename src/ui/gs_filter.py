@@ -0,0 +1,305 @@
+"""Vectorized filter engine
+
+Rows are filtered by predicates from several sources: the conditional
+filter widgets, the grid column filters and selections made on a chart.
+They are collected in a FilterPlan, evaluated once per change of any of
+them, and the matching rows are shared by the grid, Describe and the
+plots.
+
+Each predicate evaluates to a boolean mask over the rows of the loaded
+dataset. Masks are cached per (column, condition) so changing one filter
+only recomputes that mask, and all masks are combined once before a
+single row selection, in a background task.
+
+The frames of the selected rows and the dataset with converted datetimes
+are shared by the sessions filtering the same dataset alike: the former
+are kept by gs_store as frames derived from the dataset, the latter for
+as long as a session uses it.
+"""
+import re
+import threading
+import weakref
+from collections import namedtuple
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from pandas.api.types import is_datetime64_any_dtype, is_string_dtype
+
+from src.ui import gs_engine, gs_store, gs_tasks
+
+# Filter sources, in the order they are applied
+SOURCES = ('filter', 'grid', 'chart')
+# AG Grid filter model types, as (kind, *args) of a filter value
+GRID_NUMBER_FILTERS = {'equals': lambda v, _: ('isin', v),
+                       'lessThan': lambda v, _: ('less', v),
+                       'lessThanOrEqual': lambda v, _: ('between',
+                                                        -np.inf, v),
+                       'greaterThan': lambda v, _: ('greater', v),
+                       'greaterThanOrEqual': lambda v, _: ('between',
+                                                           v, np.inf),
+                       'inRange': lambda v, to: ('between', v, to)}
+# AG Grid text filters, case-insensitive as in the grid
+GRID_TEXT_FILTERS = {'equals': lambda v: ('contains',
+                                          f'^{re.escape(v)}$', False),
+                     'contains': lambda v: ('contains', re.escape(v), False),
+                     'startsWith': lambda v: ('contains',
+                                              '^' + re.escape(v), False),
+                     'endsWith': lambda v: ('contains',
+                                            re.escape(v) + '$', False)}
+
+# Rows matching the plan: rows matches all predicates, base all but the
+# chart selection, and is drawn by the chart the selection is made on
+FilterResult = namedtuple('FilterResult', 'rows base')
+
+# Datasets with converted datetimes by dataset key, while used by a session
+_coerced = weakref.WeakValueDictionary()
+_coerced_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class FilterPlan:
+    """Active predicates as (source, column, condition) triples"""
+    predicates: frozenset = frozenset()
+
+    def add(self, source: str, conditions: dict) -> 'FilterPlan':
+        """Plan with the conditions by column of a source added"""
+        return FilterPlan(self.predicates.union(
+            (source, column, condition)
+            for column, condition in conditions.items()
+            if condition is not None))
+
+    def conditions(self, sources=SOURCES) -> frozenset:
+        """(column, condition) pairs of the predicates of some sources"""
+        return frozenset((column, condition)
+                         for source, column, condition in self.predicates
+                         if source in sources)
+
+    def __bool__(self) -> bool:
+        return bool(self.predicates)
+
+
+def get_filter_cache(dataset_key: str) -> dict:
+    """Session cache of filter results, reset when the dataset changes"""
+    cache = st.session_state.get('filter_cache')
+    if cache is None or cache['dataset'] != dataset_key:
+        cache = {'dataset': dataset_key, 'frame': None, 'masks': {},
+                 'masks_key': None, 'sources': {}}
+        st.session_state['filter_cache'] = cache
+    return cache
+
+
+def get_source_conditions(source: str) -> dict:
+    """Conditions by column last stored for a filter source"""
+    cache = get_filter_cache(st.session_state.get('dataset_key'))
+    return cache['sources'].get(source, {})
+
+
+def set_source_conditions(source: str, conditions: dict) -> bool:
+    """
+    Store the conditions of a filter source, applied from the next run on
+
+    Sources other than the filter widgets report their state after the
+    rows were selected; callers rerun the script when this returns True,
+    i.e. when the conditions changed.
+    """
+    cache = get_filter_cache(st.session_state.get('dataset_key'))
+    if cache['sources'].get(source, {}) == conditions:
+        return False
+    cache['sources'][source] = conditions
+    return True
+
+
+def get_plan(conditions: dict) -> FilterPlan:
+    """Plan of the filter widget conditions and stored source conditions"""
+    plan = FilterPlan().add('filter', conditions)
+    for source in SOURCES[1:]:
+        plan = plan.add(source, get_source_conditions(source))
+    return plan
+
+
+def grid_conditions(grid_state: dict) -> dict:
+    """
+    Conditions by column of an AG Grid filter model
+
+    Number and text filters with a single condition are supported, other
+    filters are ignored.
+    """
+    model = ((grid_state or {}).get('filter') or {}).get('filterModel') or {}
+    conditions = {}
+    for column, spec in model.items():
+        kind = spec.get('type')
+        if spec.get('filterType') == 'number' and kind in GRID_NUMBER_FILTERS:
+            conditions[column] = GRID_NUMBER_FILTERS[kind](
+                spec.get('filter'), spec.get('filterTo'))
+        elif spec.get('filterType') == 'text' and kind in GRID_TEXT_FILTERS:
+            conditions[column] = GRID_TEXT_FILTERS[kind](spec.get('filter'))
+    return conditions
+
+
+def coerce_datetimes(df: pd.DataFrame, dataset_key: str) -> pd.DataFrame:
+    """
+    Convert date-like columns to timezone-naive datetimes
+
+    Conversion is attempted once per dataset and the result reused on
+    later reruns, and by other sessions using the dataset. Other columns
+    are not copied. Lazy Tables are typed by their engine and returned as
+    is.
+    """
+    if isinstance(df, gs_engine.Table):
+        return df
+    cache = get_filter_cache(dataset_key)
+    if cache['frame'] is None:
+        with _coerced_lock:
+            frame = _coerced.get(dataset_key)
+        if frame is None:
+            frame = convert_datetimes(df)
+            with _coerced_lock:
+                frame = _coerced.setdefault(dataset_key, frame)
+        cache['frame'] = frame
+    return cache['frame']
+
+
+def convert_datetimes(df: pd.DataFrame) -> pd.DataFrame:
+    """Shallow copy of df with date-like columns converted, see above"""
+    converted = {}
+    for col in df.columns:
+        s = df[col]
+        # object or Arrow strings, not categoricals
+        if is_string_dtype(s.dtype):
+            try:
+                s = pd.to_datetime(s)
+            except Exception:
+                continue
+        # low-cardinality strings made categorical by compact, converted
+        # once per category
+        elif (isinstance(s.dtype, pd.CategoricalDtype) and
+                is_string_dtype(s.cat.categories.dtype)):
+            try:
+                categories = pd.to_datetime(s.cat.categories)
+            except Exception:
+                continue
+            # missing values have code -1
+            s = pd.Series(categories.take(s.cat.codes.to_numpy(),
+                                          fill_value=pd.NaT),
+                          index=s.index, name=col)
+        if is_datetime64_any_dtype(s):
+            converted[col] = s.dt.tz_localize(None)
+    if not converted:
+        return df
+    # assign would copy every column
+    frame = df.copy(deep=False)
+    for col, s in converted.items():
+        frame[col] = s
+    return frame
+
+
+def condition_mask(s: pd.Series, condition: tuple) -> np.ndarray:
+    """
+    Evaluate a filter condition on a column
+
+    Parameters:
+    s (pd.Series): column values
+    condition (tuple): (kind, *args) with kind one of
+    - 'isin': args are the accepted values, None accepting missing
+      values
+    - 'between': args are the inclusive (low, high) bounds
+    - 'greater', 'less': args is the exclusive bound
+    - 'contains': args is a substring or regex, optionally followed by
+      False for a case-insensitive match
+
+    Returns:
+    np.ndarray: boolean mask of matching rows
+    """
+    kind, *args = condition
+    if kind == 'isin':
+        values = [v for v in args if v is not None]
+        mask = s.isin(values)
+        if len(values) < len(args):
+            mask |= s.isna()
+    elif kind == 'between':
+        mask = s.between(*args)
+    elif kind == 'greater':
+        mask = s > args[0]
+    elif kind == 'less':
+        mask = s < args[0]
+    elif kind == 'contains':
+        if not isinstance(s.dtype, pd.ArrowDtype):
+            s = s.astype(str)
+        case = args[1] if len(args) > 1 else True
+        mask = s.str.contains(args[0], case=case)
+    else:
+        raise ValueError(f'Unknown filter condition: {kind}')
+    return mask.to_numpy(dtype=bool, na_value=False)
+
+
+def apply_plan(df: pd.DataFrame,
+               plan: FilterPlan,
+               dataset_key: str) -> FilterResult:
+    """
+    Select the rows matching a filter plan
+
+    Parameters:
+    df (pd.DataFrame): dataset, as returned by coerce_datetimes
+    plan (FilterPlan): active predicates
+    dataset_key (str): fingerprint of the loaded dataset
+
+    Returns:
+    FilterResult: matching rows, filtered Tables for a lazy Table. Frames
+    are df itself when no predicate applies to them.
+    """
+    base = plan.conditions(SOURCES[:-1])
+    selection = plan.conditions(SOURCES[-1:]).difference(base)
+    if isinstance(df, gs_engine.Table):
+        rows = df.filter(base)
+        return FilterResult(rows.filter(selection), rows)
+    cache = get_filter_cache(dataset_key)
+    if not plan:
+        cache['masks'] = {}
+        return FilterResult(df, df)
+    # df with or without the datetimes converted by coerce_datetimes, whose
+    # rows and masks differ
+    frame_key = (dataset_key, tuple(
+        df.columns[df.dtypes.map(is_datetime64_any_dtype)]))
+    if cache['masks_key'] != frame_key:
+        cache['masks'] = {}
+    masks, result = gs_tasks.run('filter', (frame_key, base, selection),
+                                 select_rows, df, base, selection,
+                                 cache['masks'], frame_key)
+    cache['masks'] = masks
+    cache['masks_key'] = frame_key
+    return result
+
+
+def select_rows(df: pd.DataFrame,
+                base: frozenset,
+                selection: frozenset,
+                masks: dict,
+                frame_key: tuple) -> tuple[dict, FilterResult]:
+    """
+    Rows matching the base and selection conditions, see apply_plan
+
+    Masks of conditions no longer active are dropped, the missing ones
+    are evaluated, unless the rows are already in gs_store under
+    frame_key, the identity of df. Returns the new masks and the matching
+    rows.
+    """
+    active = base.union(selection)
+    masks = {key: masks[key] for key in active if key in masks}
+
+    def get_mask(conditions: frozenset) -> np.ndarray:
+        for key in conditions.difference(masks):
+            gs_tasks.check_cancelled()
+            masks[key] = condition_mask(df[key[0]], key[1])
+        return np.logical_and.reduce([masks[key] for key in conditions])
+
+    def take(conditions: frozenset) -> pd.DataFrame:
+        return df.take(np.flatnonzero(get_mask(conditions)))
+
+    rows = (gs_store.derive(('rows', *frame_key, base), take, base)
+            if base else df)
+    if not selection:
+        return masks, FilterResult(rows, rows)
+    return masks, FilterResult(
+        gs_store.derive(('rows', *frame_key, active), take, active), rows)
@@ -0,0 +1,158 @@
+"""Memory held by sessions
+
+A session holds the dataset it uses, shared with other sessions through
+gs_store, and results derived from it: the latest result of each
+background task, the cached Describe tables and the filter masks. The
+raw bytes of an upload are dropped once its dataset is stored, see
+gs_body.data_loader.
+
+Results are accounted per session at the end of each run. Beyond the
+session budget, the least recently used ones are dropped, except those
+used by the run, and recomputed if needed again. Usage of the session
+and of the server process is shown in the sidebar.
+"""
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from src.ui import gs_store
+from src.ui import gs_utils as gsu
+
+# Bytes of results kept per session
+SESSION_BUDGET_BYTES = int(os.environ.get('GS_SESSION_BYTES', 256 * 2**20))
+
+# Bytes held by a session: raw upload, dataset (shared) and results
+Usage = namedtuple('Usage', 'upload dataset results')
+
+_sessions = weakref.WeakSet()
+_lock = threading.Lock()
+
+
+class SessionMemory:
+    """Memory accounting of a session, kept in its state"""
+
+    def __init__(self):
+        self.run_started = time.monotonic()
+        self.usage = Usage(0, 0, 0)
+
+
+def get_session_memory() -> SessionMemory:
+    memory = st.session_state.get('memory')
+    if memory is None:
+        memory = st.session_state['memory'] = SessionMemory()
+        with _lock:
+            _sessions.add(memory)
+    return memory
+
+
+def start_run():
+    """Mark the start of a script run, results it uses are not dropped"""
+    get_session_memory().run_started = time.monotonic()
+
+
+def sizeof(obj, seen: set=None) -> int:
+    """
+    Approximate bytes held by a result, not counting frames of gs_store
+    nor objects already seen
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        if isinstance(obj, pd.DataFrame) and gs_store.is_stored(obj):
+            return 0
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(sizeof(k, seen) + sizeof(v, seen)
+                   for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sum(sizeof(v, seen) for v in obj)
+    return sys.getsizeof(obj)
+
+
+def get_results() -> list:
+    """
+    Droppable results of the session, least recently used first
+
+    Returns:
+    list: (nbytes, drop, used) tuples, drop being a callable dropping the
+    result and used whether the current run used it
+    """
+    memory = get_session_memory()
+    seen = set()
+    results = []
+    tasks = st.session_state.get('tasks', {})
+    for name, task in list(tasks.items()):
+        future = task.future
+        if (not future.done() or future.cancelled() or
+                future.exception() is not None):
+            continue
+        if task.nbytes is None:
+            task.nbytes = sizeof(future.result(), seen)
+        seen.add(id(future.result()))
+        results.append((task.nbytes, partial(tasks.pop, name, None),
+                        task.used >= memory.run_started))
+    # results of the 'describe' task are cached too, counted once
+    cache = st.session_state.get('describe_cache', {})
+    for i, (key, result) in enumerate(list(cache.items())):
+        results.append((sizeof(result, seen), partial(cache.pop, key, None),
+                        i == len(cache) - 1))
+    return results
+
+
+def get_usage() -> Usage:
+    """Bytes held by the session, measured at the end of the last run"""
+    return get_session_memory().usage
+
+
+def server_usage() -> int:
+    """Bytes held by the dataset store and the results of all sessions"""
+    with _lock:
+        sessions = list(_sessions)
+    return (gs_store.memory_usage()[0] +
+            sum(s.usage.upload + s.usage.results for s in sessions))
+
+
+def enforce():
+    """
+    Account the memory of the session, dropping least recently used
+    results beyond SESSION_BUDGET_BYTES
+    """
+    memory = get_session_memory()
+    results = get_results()
+    total = sum(nbytes for nbytes, _, _ in results)
+    for nbytes, drop, used in results:
+        if total <= SESSION_BUDGET_BYTES:
+            break
+        if not used:
+            drop()
+            total -= nbytes
+    filter_cache = st.session_state.get('filter_cache') or {}
+    total += sizeof(filter_cache.get('masks', {}))
+    data_file = st.session_state.get('data_file')
+    ref = st.session_state.get('dataset_ref')
+    memory.usage = Usage(getattr(data_file, 'size', 0),
+                         ref.nbytes if ref is not None else 0,
+                         total)
+
+
+def show_usage():
+    """Caption of the memory held by the session and the server"""
+    usage = get_usage()
+    st.caption(f'Memory: {gsu.format_bytes(sum(usage))} session, '
+               f'{gsu.format_bytes(server_usage())} server',
+               help=(f'Upload {gsu.format_bytes(usage.upload)}, '
+                     f'dataset {gsu.format_bytes(usage.dataset)} '
+                     f'(shared), results '
+                     f'{gsu.format_bytes(usage.results)}'))
@@ -0,0 +1,123 @@
+"""Shared worker pool for computations on large frames
+
+Large frames are split into partitions, by blocks of rows for additive
+results (e.g. bin counts) or by whole groups for per-group statistics
+(e.g. quartiles), and the partitions are processed in parallel by a pool
+shared by all sessions of the server process. Callers merge the partial
+results.
+
+The pool uses threads by default: the numpy and pandas kernels doing the
+work release the GIL for most of their run time. GS_EXECUTOR=process
+switches to worker processes, at the cost of pickling the partitions.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.ui import gs_tasks
+
+# 'thread' or 'process'
+EXECUTOR = os.environ.get('GS_EXECUTOR', 'thread')
+WORKERS = int(os.environ.get('GS_WORKERS', os.cpu_count() or 1))
+# Frames with fewer rows are processed in the calling thread
+PARALLEL_ROWS = int(os.environ.get('GS_PARALLEL_ROWS', 200_000))
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """The shared pool, None when running with a single worker"""
+    global _executor
+    if WORKERS <= 1:
+        return None
+    with _lock:
+        if _executor is None:
+            if EXECUTOR == 'process':
+                _executor = ProcessPoolExecutor(max_workers=WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=WORKERS, thread_name_prefix='gs-worker')
+        return _executor
+
+
+def n_partitions(n_rows: int) -> int:
+    """Number of partitions worth using for a frame of n_rows rows"""
+    if get_executor() is None or n_rows < PARALLEL_ROWS:
+        return 1
+    return min(WORKERS, -(-n_rows // (PARALLEL_ROWS // 2)))
+
+
+def row_partitions(df: pd.DataFrame) -> list[pd.DataFrame]:
+    """Split a frame in contiguous blocks of rows, one per worker"""
+    n = n_partitions(len(df))
+    if n == 1:
+        return [df]
+    bounds = np.linspace(0, len(df), n + 1).astype(int)
+    return [df.iloc[start:stop] for start, stop in zip(bounds, bounds[1:])]
+
+
+def group_partitions(df: pd.DataFrame,
+                     group_fields: list) -> list[pd.DataFrame]:
+    """
+    Split a frame so that all rows of a group are in the same partition
+
+    Groups are assigned largest first to the partition with the fewest
+    rows, so partitions have similar sizes unless a single group
+    dominates.
+    """
+    n = n_partitions(len(df))
+    if n == 1 or not group_fields:
+        return [df]
+    codes = (df.groupby(list(group_fields), observed=True, dropna=False,
+                        sort=False)
+             .ngroup()
+             .to_numpy())
+    sizes = np.bincount(codes)
+    n = min(n, len(sizes))
+    if n == 1:
+        return [df]
+    assignment = np.empty(len(sizes), dtype=np.int64)
+    load = np.zeros(n, dtype=np.int64)
+    for group in np.argsort(sizes)[::-1]:
+        part = np.argmin(load)
+        assignment[group] = part
+        load[part] += sizes[group]
+    parts = assignment[codes]
+    return [df[parts == part] for part in range(n)]
+
+
+def column_partitions(columns: list, n_rows: int) -> list[list]:
+    """Split a list of columns in one list per worker"""
+    n = min(n_partitions(n_rows), len(columns))
+    if n <= 1:
+        return [list(columns)]
+    return [list(columns[part::n]) for part in range(n)]
+
+
+def map_partitions(func, partitions: list, *args) -> list:
+    """
+    Apply func(partition, *args) to all partitions, in the shared pool
+    when there is more than one
+
+    With the process pool func must be a module level function. Called
+    from a background task, a superseded task stops between partitions.
+    """
+    executor = get_executor()
+    gs_tasks.check_cancelled()
+    if executor is None or len(partitions) == 1:
+        return [func(part, *args) for part in partitions]
+    futures = [executor.submit(func, part, *args) for part in partitions]
+    results = []
+    try:
+        for future in futures:
+            results.append(future.result())
+            gs_tasks.check_cancelled()
+    except gs_tasks.Cancelled:
+        for future in futures:
+            future.cancel()
+        raise
+    return results
@@ -0,0 +1,276 @@
+"""Per-column statistics profile of a loaded dataset
+
+The profile is computed once per dataset, in a background thread started
+at load time, and shared by the filter widgets, the Describe tab and the
+plot option pickers instead of rescanning the data on every rerun.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype
+
+from src.ui import gs_engine, gs_store, gs_tasks
+from src.ui import gs_parallel as gsp
+from src.ui import gs_utils as gsu
+
+# Percentiles kept in the quantile sketch
+QUANTILES = np.linspace(0, 1, 101)
+# Number of most frequent values kept per column
+TOP_K = 10
+# Keep the full list of values of columns with at most this many
+MAX_VALUES = 1000
+# Categorical columns offered for grouping (color, facets, group by)
+MAX_GROUPS = 50
+# Number of dataset profiles kept
+MAX_PROFILES = 8
+
+_executor = ThreadPoolExecutor(max_workers=2,
+                               thread_name_prefix='gs-profile')
+_profiles = OrderedDict()
+_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ColumnProfile:
+    """Summary statistics of a single column"""
+    name: str
+    dtype: str
+    kind: str  # 'numeric', 'datetime' or 'categorical'
+    count: int  # non-null values
+    null_count: int
+    cardinality: int
+    min: object = None
+    max: object = None
+    mean: float = None
+    std: float = None
+    quantiles: np.ndarray = None  # values at QUANTILES
+    top_values: tuple = ()  # ((value, count), ...) most frequent first
+    values: tuple = None  # all distinct values if at most MAX_VALUES
+
+    def quantile(self, q: float) -> float:
+        """Quantile interpolated from the sketch"""
+        return float(np.interp(q, QUANTILES, self.quantiles))
+
+
+def profile_column(s: pd.Series) -> ColumnProfile:
+    """Compute the profile of a column"""
+    count = int(s.count())
+    cardinality = int(s.nunique())
+    kwds = {}
+    if is_datetime64_any_dtype(s):
+        kind = 'datetime'
+        kwds['min'], kwds['max'] = s.min(), s.max()
+    elif s.dtype.kind not in 'OSU':
+        kind = 'numeric'
+        values = s.to_numpy(dtype='float64', na_value=np.nan)
+        values = values[~np.isnan(values)]
+        if len(values):
+            kwds['quantiles'] = np.quantile(values, QUANTILES)
+            kwds['min'], kwds['max'] = values.min(), values.max()
+            kwds['mean'] = values.mean()
+            kwds['std'] = values.std(ddof=1) if len(values) > 1 else np.nan
+    else:
+        kind = 'categorical'
+    if kind != 'numeric' or is_bool_dtype(s):
+        counts = s.value_counts(sort=True)
+        kwds['top_values'] = tuple(counts.head(TOP_K).items())
+    if cardinality <= MAX_VALUES:
+        kwds['values'] = tuple(s.dropna().unique())
+    return ColumnProfile(name=s.name,
+                         dtype=str(s.dtype),
+                         kind=kind,
+                         count=count,
+                         null_count=int(len(s) - count),
+                         cardinality=cardinality,
+                         **kwds)
+
+
+def profile_dataframe(df: pd.DataFrame) -> dict:
+    """
+    Profile all columns, returns a dict of ColumnProfile by column
+
+    Large frames are profiled in parallel, split by columns, and lazy
+    Tables with aggregate queries.
+    """
+    if isinstance(df, gs_engine.Table):
+        return profile_table(df)
+    parts = gsp.column_partitions(list(df.columns), len(df))
+    profiles = {}
+    for part in gsp.map_partitions(profile_columns,
+                                   [df.loc[:, columns] for columns in parts]):
+        profiles.update(part)
+    return {column: profiles[column] for column in df.columns}
+
+
+def profile_columns(df: pd.DataFrame) -> dict:
+    """ColumnProfile by column of a partition of the columns"""
+    return {column: profile_column(df[column]) for column in df.columns}
+
+
+def start_profile(dataset_key: str, df: pd.DataFrame) -> Future:
+    """
+    Start profiling a dataset in the background, if not done already and
+    not precompiled in the demo bundle
+    """
+    with _lock:
+        if dataset_key in _profiles:
+            _profiles.move_to_end(dataset_key)
+        else:
+            profile = gs_store.get_bundled_profile(dataset_key)
+            if profile is None:
+                future = _executor.submit(profile_dataframe, df)
+            else:
+                # precompiled with a demo dataset
+                future = Future()
+                future.set_result(profile)
+            _profiles[dataset_key] = future
+            while len(_profiles) > MAX_PROFILES:
+                _profiles.popitem(last=False)
+        return _profiles[dataset_key]
+
+
+def get_profile(dataset_key: str=None, df: pd.DataFrame=None,
+                block: bool=True) -> dict:
+    """
+    Profile of a dataset, waiting for the background computation
+
+    Parameters:
+    dataset_key (str): fingerprint of the dataset, defaults to the one
+    loaded in this session
+    df (pd.DataFrame): the dataset, used to start profiling if needed
+    block (bool): wait for the profile, else None while it is computed
+
+    Returns:
+    dict: ColumnProfile by column name, None if the dataset is unknown
+    """
+    if dataset_key is None:
+        dataset_key = st.session_state.get('dataset_key')
+    with _lock:
+        future = _profiles.get(dataset_key)
+    if future is None:
+        if df is None:
+            return None
+        future = start_profile(dataset_key, df)
+    if not block and not future.done():
+        return None
+    while not wait([future], timeout=gs_tasks.POLL_SECONDS).done:
+        # Reading session state lets Streamlit interrupt this run, as in
+        # gs_tasks.run
+        st.session_state.get('dataset_key')
+    return future.result()
+
+
+def profile_table(table: gs_engine.Table) -> dict:
+    """
+    profile_dataframe of a lazy Table, quantiles are estimated with
+    t-digest sketches
+    """
+    schema = table.schema
+    columns = list(schema.columns)
+    kinds = {c: 'datetime' if is_datetime64_any_dtype(schema[c])
+             else 'numeric' if schema[c].dtype.kind not in 'OSU'
+             else 'categorical' for c in columns}
+    numeric = [c for c in columns if kinds[c] == 'numeric']
+    ordered = [c for c in columns if kinds[c] != 'categorical']
+    n_rows = len(table)
+    counts = table.agg(columns, ['count', 'nunique']).iloc[0]
+    extremes = table.agg(ordered, ['min', 'max']).iloc[0]
+    moments = table.agg(numeric, ['mean', 'std']).iloc[0]
+    quantiles = table.quantiles(numeric, list(QUANTILES),
+                                approximate=True).iloc[0]
+    profiles = {}
+    for column in columns:
+        count = int(counts[(column, 'count')])
+        cardinality = int(counts[(column, 'nunique')])
+        kwds = {}
+        if kinds[column] != 'categorical' and count:
+            kwds['min'] = extremes[(column, 'min')]
+            kwds['max'] = extremes[(column, 'max')]
+        if kinds[column] == 'numeric' and count:
+            # the sketch does not keep the extremes
+            kwds['quantiles'] = np.concatenate(
+                [[kwds['min']], quantiles[column].to_numpy()[1:-1],
+                 [kwds['max']]])
+            kwds['mean'] = moments[(column, 'mean')]
+            kwds['std'] = moments[(column, 'std')]
+        if kinds[column] != 'numeric' or is_bool_dtype(schema[column]):
+            top = table.value_counts(column, TOP_K)
+            kwds['top_values'] = tuple(zip(top.index.tolist(),
+                                           top.tolist()))
+        if cardinality <= MAX_VALUES:
+            kwds['values'] = tuple(table.value_counts(column)
+                                   .index.tolist())
+        profiles[column] = ColumnProfile(name=column,
+                                         dtype=str(schema[column].dtype),
+                                         kind=kinds[column],
+                                         count=count,
+                                         null_count=n_rows - count,
+                                         cardinality=cardinality,
+                                         **kwds)
+    return profiles
+
+
+def get_column_types(df: pd.DataFrame) -> dict:
+    """
+    Column types as in gs_utils.get_df_column_types, plus group_columns:
+    categorical columns with few enough values for color or facets
+
+    The profile is not waited for: until it is done, only columns of
+    categorical dtype with few enough categories are group columns.
+    """
+    schema = gs_engine.schema(df)
+    ctypes = gsu.get_df_column_types(schema)
+    profile = get_profile(block=False)
+    if profile is None:
+        ctypes['group_columns'] = [
+            c for c in ctypes['cat_columns']
+            if isinstance(schema[c].dtype, pd.CategoricalDtype) and
+            len(schema[c].cat.categories) <= MAX_GROUPS]
+        return ctypes
+    ctypes['group_columns'] = [
+        c for c in ctypes['cat_columns']
+        if c not in profile or profile[c].cardinality <= MAX_GROUPS]
+    return ctypes
+
+
+def describe_numeric(profile: dict, columns: list) -> pd.DataFrame:
+    """Table of numeric column statistics, same layout as describe()"""
+    rows = {}
+    for column in columns:
+        p = profile[column]
+        if p.quantiles is None:
+            # datetimes or columns without values
+            rows[column] = {'count': float(p.count),
+                            'min': p.min,
+                            'max': p.max}
+            continue
+        rows[column] = {'count': float(p.count),
+                        'mean': p.mean,
+                        'std': p.std,
+                        'min': p.min,
+                        '25%': p.quantile(0.25),
+                        '50%': p.quantile(0.5),
+                        '75%': p.quantile(0.75),
+                        'max': p.max}
+    return pd.DataFrame.from_dict(rows, orient='index',
+                                  columns=['count', 'mean', 'std', 'min',
+                                           '25%', '50%', '75%', 'max'])
+
+
+def describe_categorical(profile: dict, columns: list) -> pd.DataFrame:
+    """Table of categorical column statistics, same layout as describe()"""
+    rows = {}
+    for column in columns:
+        p = profile[column]
+        top, freq = p.top_values[0] if p.top_values else (None, None)
+        rows[column] = {'count': p.count,
+                        'unique': p.cardinality,
+                        'top': top,
+                        'freq': freq}
+    return pd.DataFrame.from_dict(rows, orient='index',
+                                  columns=['count', 'unique', 'top', 'freq'])
@@ -0,0 +1,168 @@
+"""Row samples for interactive previews of large datasets
+
+The Analyze panel can work on a sample of the filtered rows, so that
+statistics and charts render in bounded time whatever the dataset size,
+and flags its results as approximate until they are computed exactly.
+
+Samples are bottom-k samples: every row has a pseudo-random priority,
+a hash of its row label, and the rows with the smallest priorities are
+kept. This is a uniform sample, like a reservoir sample, that needs no
+state kept from loading, and the sample of a filtered frame is the
+filtered sample of the dataset, so it stays stable while filters change.
+Stratified samples keep the smallest priorities of each group of a
+categorical column, with a minimum per group so that colors and facets
+keep every group. Lazy Tables are sampled by DuckDB.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from src.ui import gs_engine, gs_profile, gs_tasks
+from src.ui import gs_utils as gsu
+
+SAMPLE_MODES = {'full': 'Full data',
+                'uniform': 'Uniform sample',
+                'stratified': 'Stratified sample'}
+# Rows analyzed in sample modes
+PREVIEW_ROWS = int(os.environ.get('GS_PREVIEW_ROWS', 100_000))
+# Datasets with more rows are analyzed on a sample by default
+AUTO_SAMPLE_ROWS = int(os.environ.get('GS_AUTO_SAMPLE_ROWS', 1_000_000))
+# Rows kept at least per group by stratified samples
+MIN_GROUP_ROWS = 100
+
+
+def priorities(index: pd.Index) -> np.ndarray:
+    """Pseudo-random priority of rows, a hash of their labels"""
+    return pd.util.hash_array(np.asarray(index))
+
+
+def uniform_sample(df: pd.DataFrame, n: int) -> pd.DataFrame:
+    """The n rows with the smallest priorities, in their original order"""
+    if isinstance(df, gs_engine.Table):
+        return df.sample(n)
+    if len(df) <= n:
+        return df
+    keep = np.argpartition(priorities(df.index), n)[:n]
+    return df.iloc[np.sort(keep)]
+
+
+def group_quotas(sizes: np.ndarray, n: int, min_rows: int) -> np.ndarray:
+    """
+    Rows sampled per group: proportional to the group sizes for a total
+    of about n, at least min_rows and at most the group size
+    """
+    quotas = np.maximum(np.floor(n * sizes / sizes.sum()), min_rows)
+    return np.minimum(quotas, sizes).astype(np.int64)
+
+
+def stratified_sample(df: pd.DataFrame, column: str, n: int,
+                      min_rows: int=MIN_GROUP_ROWS) -> pd.DataFrame:
+    """Rows with the smallest priorities of each group of column"""
+    if isinstance(df, gs_engine.Table):
+        return df.stratified_sample(column, n, min_rows)
+    if len(df) <= n:
+        return df
+    codes = (df.groupby(column, observed=True, dropna=False, sort=False)
+             .ngroup()
+             .to_numpy())
+    quotas = group_quotas(np.bincount(codes), n, min_rows)
+    rank = group_ranks(codes, priorities(df.index))
+    return df.iloc[np.flatnonzero(rank < quotas[codes])]
+
+
+def group_ranks(codes: np.ndarray, priority: np.ndarray) -> np.ndarray:
+    """Rank of each row by priority within its group of codes (>= 0)"""
+    # rows sorted by group, then by priority within their group
+    order = np.lexsort((priority, codes))
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] !=
+                                  sorted_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(codes)])
+    rank = np.empty(len(codes), dtype=np.int64)
+    rank[order] = np.arange(len(codes)) - np.repeat(starts, sizes)
+    return rank
+
+
+def sample_rows(df: pd.DataFrame, mode: str,
+                column: str=None, n: int=PREVIEW_ROWS) -> pd.DataFrame:
+    """Sample of df in one of SAMPLE_MODES, df itself for 'full'"""
+    if mode == 'uniform':
+        return uniform_sample(df, n)
+    if mode == 'stratified' and column is not None:
+        return stratified_sample(df, column, n)
+    return df
+
+
+def sample_view(grid: gsu.GridView) -> tuple[gsu.GridView, str]:
+    """
+    Sampling controls of the Analyze panel
+
+    Shown when the rows exceed PREVIEW_ROWS. The rows analyzed and the
+    rows before the chart selection are sampled; the rows selected in the
+    grid are all kept, as a frame.
+
+    Returns:
+    gsu.GridView: the view of the rows to analyze
+    str: description of the sample, None when analyzing all rows
+    """
+    nrows = len(grid.data)
+    if nrows <= PREVIEW_ROWS:
+        return grid, None
+    ctypes = gs_profile.get_column_types(grid.data)
+    col_mode, col_column = st.columns([0.5, 0.5],
+                                      vertical_alignment='bottom')
+    mode = col_mode.selectbox(
+        'Analyze:', list(SAMPLE_MODES),
+        index=1 if nrows > AUTO_SAMPLE_ROWS else 0,
+        format_func=SAMPLE_MODES.get,
+        label_visibility='collapsed',
+        help=f'''Samples of {PREVIEW_ROWS} rows render instantly, the
+        stratified sample keeps at least {MIN_GROUP_ROWS} rows of every
+        group''',
+        key='sample_mode')
+    column = None
+    if mode == 'stratified':
+        column = col_column.selectbox('Stratify by:',
+                                      ctypes['group_columns'],
+                                      index=None,
+                                      placeholder='Stratify by',
+                                      label_visibility='collapsed',
+                                      key='sample_column')
+        if column is None:
+            return grid, None
+    if mode == 'full':
+        return grid, None
+    sample = gs_tasks.run('sample',
+                          (*gs_tasks.frame_key(grid.data), mode, column),
+                          sample_rows, grid.data, mode, column)
+    base = sample
+    if grid.base is not grid.data:
+        base = gs_tasks.run('sample-base',
+                            (*gs_tasks.frame_key(grid.base), mode, column),
+                            sample_rows, grid.base, mode, column)
+    description = (f'{len(sample)} of {nrows} rows, '
+                   f'{SAMPLE_MODES[mode].lower()}')
+    if column is not None:
+        description += f' by {column}'
+    selected_rows = grid.selected_rows
+    if not isinstance(selected_rows, pd.DataFrame):
+        selected_rows = grid.data.loc[selected_rows]
+    return grid._replace(data=sample, selected_rows=selected_rows,
+                         base=base), description
+
+
+def show_approximate(description: str):
+    """Flag results computed on a sample, with an action to compute them
+    exactly"""
+    col_info, col_exact = st.columns([0.7, 0.3],
+                                     vertical_alignment='center')
+    col_info.caption(f'Approximate: computed on {description}')
+    col_exact.button('Compute exact', icon=':material/calculate:',
+                     on_click=compute_exact)
+
+
+def compute_exact():
+    """Analyze all rows from the next run on"""
+    st.session_state['sample_mode'] = 'full'
@@ -0,0 +1,164 @@
+"""Mergeable streaming sketches for approximate statistics
+
+All sketches are updated with chunks of values in one pass, can be merged
+across chunks or groups, and report a bound on their error:
+- QuantileSketch: quantiles with a bound on the rank error (KLL-style
+  compactors)
+- HyperLogLog: distinct counts with a relative standard error
+- FrequentItems: most frequent values with a bound on the count error
+  (Misra-Gries, the mergeable form of space-saving)
+"""
+import numpy as np
+import pandas as pd
+
+
+class QuantileSketch:
+    """
+    Quantile sketch built from a hierarchy of compactors
+
+    Level h holds items of weight 2**h. When a level exceeds k items it
+    is sorted and every other item, from a random offset, is promoted to
+    the next level. Each compaction at level h shifts any rank by at
+    most 2**h, which is accumulated into an exact worst-case bound.
+    """
+
+    def __init__(self, k: int=256, seed: int=0):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.max_rank_error = 0
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.n += other.n
+        self.max_rank_error += other.max_rank_error
+        self._compress()
+        return self
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if len(items) > self.k:
+                items = np.sort(items)
+                # an odd item out stays at this level
+                keep = items[-1:] if len(items) % 2 else items[:0]
+                pairs = items[:len(items) - len(keep)]
+                promoted = pairs[self._rng.integers(2)::2]
+                self.levels[h] = keep
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1],
+                                                     promoted])
+                self.max_rank_error += 2 ** h
+            h += 1
+
+    def quantile(self, q) -> np.ndarray:
+        """Approximate quantile(s) of the values seen"""
+        items = np.concatenate(self.levels)
+        if not len(items):
+            return np.full(np.shape(q), np.nan)
+        weights = np.concatenate([np.full(len(level), 2 ** h)
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(items)
+        cumulative = np.cumsum(weights[order])
+        ranks = np.asarray(q) * cumulative[-1]
+        index = np.searchsorted(cumulative, ranks, side='left')
+        return items[order][np.clip(index, 0, len(items) - 1)]
+
+    @property
+    def rank_error(self) -> float:
+        """Bound on the rank error, as a fraction of the count"""
+        return self.max_rank_error / self.n if self.n else 0.
+
+
+class HyperLogLog:
+    """Distinct count estimator with 2**p registers"""
+
+    def __init__(self, p: int=14):
+        self.p = p
+        self.registers = np.zeros(2 ** p, dtype=np.uint8)
+
+    def update(self, values):
+        values = pd.Series(values).dropna()
+        if not len(values):
+            return
+        hashed = pd.util.hash_array(values.to_numpy())
+        index = (hashed >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = hashed << np.uint64(self.p)
+        # rank = leading zeros of the remaining bits + 1
+        rank = (64 - _bit_length(rest) + 1).clip(max=64 - self.p + 1)
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(
+            np.exp2(-self.registers.astype('float64')))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting
+            estimate = m * np.log(m / zeros)
+        return float(estimate)
+
+    @property
+    def relative_error(self) -> float:
+        """Relative standard error of count()"""
+        return 1.04 / np.sqrt(len(self.registers))
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    """Bit length of uint64 values, exact (no float rounding)"""
+    high = (values >> np.uint64(32)).astype('float64')
+    low = (values & np.uint64(0xFFFFFFFF)).astype('float64')
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+
+class FrequentItems:
+    """
+    Most frequent values with at most `capacity` counters (Misra-Gries)
+
+    Counts are lower bounds; true counts exceed them by at most
+    count_error.
+    """
+
+    def __init__(self, capacity: int=64):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype='int64')
+        self.count_error = 0
+
+    def update(self, values):
+        self._merge_counts(pd.Series(values).value_counts(sort=False), 0)
+
+    def merge(self, other: 'FrequentItems') -> 'FrequentItems':
+        self._merge_counts(other.counts, other.count_error)
+        return self
+
+    def _merge_counts(self, counts: pd.Series, error: int):
+        counts = self.counts.add(counts, fill_value=0).astype('int64')
+        self.count_error += error
+        if len(counts) > self.capacity:
+            # subtract the (capacity+1)-th largest count from all counters
+            delta = int(counts.nlargest(self.capacity + 1).iloc[-1])
+            counts = counts[counts > delta] - delta
+            self.count_error += delta
+        self.counts = counts
+
+    def top(self, n: int=1) -> pd.Series:
+        """The n values with the largest counts"""
+        return self.counts.nlargest(n)
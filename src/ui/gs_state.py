@@ -2,7 +2,7 @@
 import json
 import streamlit as st
 
-@st.cache_data
+@st.cache_data(max_entries=1, ttl=3600)
 def get_demos():
     with open('data/demo_datasets.json', 'rt') as infile:
         demos = json.load(infile)
@@ -20,6 +20,10 @@ def init_state():
         st.session_state['examples'] = get_demos()
     if 'data_file' not in st.session_state:
         st.session_state['data_file'] = None
+    if 'dataset_key' not in st.session_state:
+        st.session_state['dataset_key'] = None
+    if 'load_columns' not in st.session_state:
+        st.session_state['load_columns'] = None
     if 'data_select' not in st.session_state:
         st.session_state['data_select'] = None
     if 'status_bar' not in st.session_state:
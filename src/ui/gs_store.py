@@ -0,0 +1,374 @@
+"""Process-wide dataset store keyed by content fingerprint
+
+Parsed frames are persisted as uncompressed Arrow IPC files in an
+on-disk LRU cache that survives restarts, and kept in a byte-budgeted
+in-memory LRU shared by all sessions of the server process. Keys come
+from a cheap fingerprint of the source (size plus a hash of sampled
+blocks), so re-opening the same file or demo skips parsing entirely.
+
+Frames in memory are read back from their cache file through a memory
+map without consolidating blocks: numeric columns without nulls and Arrow
+strings stay on the pages of the file, shared by all server processes of
+the host instead of copied into each one. Sessions hold a DatasetRef to
+the frame they use, which keeps it from being evicted; a frame is only
+evicted, beyond the budget, once no session references it. Frames
+derived from a dataset, e.g. the rows of a filter, are kept in the same
+LRU without being persisted or referenced, and evicted before datasets.
+Shared frames must not be modified in place.
+
+Demo datasets are also precompiled by data/save_demos.py into a bundle of
+Arrow files named by their key, with their column profiles. Bundle files
+are read through a memory map, so the pages of a demo are shared by all
+server processes and its numeric columns are not copied.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Bump when the loader output changes (e.g. dtype inference), so that
+# stale cache entries are not reused
+STORE_VERSION = 2
+CACHE_DIR = os.environ.get(
+    'GS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'grid-surfer',
+                 'datasets'))
+DISK_BUDGET_BYTES = int(os.environ.get('GS_CACHE_BYTES', 2 * 2**30))
+MEMORY_BUDGET_BYTES = int(os.environ.get('GS_MEMORY_CACHE_BYTES', 2**30))
+# Precompiled demo datasets, see data/save_demos.py
+BUNDLE_DIR = os.environ.get('GS_BUNDLE_DIR', os.path.join('data', 'demos'))
+# Schema metadata key of the pickled column profiles of a bundle file
+PROFILE_METADATA = b'grid_surfer.profile'
+# Fingerprint sampling: number and size of blocks hashed
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_BYTES = 64 * 2**10
+
+_memory = OrderedDict()
+_memory_bytes = 0
+# reentrant: DatasetRefs may be garbage collected, and released, by a
+# thread holding the lock
+_lock = threading.RLock()
+
+
+@dataclass
+class _Entry:
+    """Frame kept in memory, with the number of DatasetRefs to it"""
+    frame: pd.DataFrame
+    nbytes: int
+    refs: int = 0
+    derived: bool = False
+
+
+class DatasetRef:
+    """
+    Read-only reference of a session to a frame of the store
+
+    The frame is not evicted while referenced. The reference is released
+    when garbage collected, e.g. when it is replaced in the session state
+    or the session ends.
+    """
+
+    def __init__(self, key, frame: pd.DataFrame, nbytes: int):
+        self.key = key
+        self.frame = frame
+        self.nbytes = nbytes
+        weakref.finalize(self, _release, key)
+
+
+def fingerprint(source, *extra) -> str:
+    """
+    Cheap content fingerprint of a dataset source
+
+    Parameters:
+    source: path, in-memory upload (BytesIO) or any other value; other
+    values are hashed through their repr, e.g. a demo dataset name
+    extra: additional values that change the parsed result, e.g. the
+    projected columns
+
+    Returns:
+    str: hex digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((STORE_VERSION, extra)).encode())
+    if isinstance(source, str) and os.path.isfile(source):
+        with open(source, 'rb') as infile:
+            fileno = infile.fileno()
+            _hash_blocks(h, os.fstat(fileno).st_size,
+                         lambda o, n: os.pread(fileno, n, o))
+    elif hasattr(source, 'getbuffer'):
+        buf = source.getbuffer()
+        _hash_blocks(h, buf.nbytes, lambda o, n: buf[o:o + n])
+    else:
+        h.update(repr(source).encode())
+    return h.hexdigest()
+
+
+def _hash_blocks(h, size: int, read_at):
+    """Hash the size and evenly spaced blocks of a buffer or file"""
+    h.update(size.to_bytes(8, 'little'))
+    if size <= SAMPLE_BLOCKS * SAMPLE_BLOCK_BYTES:
+        h.update(read_at(0, size))
+        return
+    stride = (size - SAMPLE_BLOCK_BYTES) // (SAMPLE_BLOCKS - 1)
+    for i in range(SAMPLE_BLOCKS):
+        h.update(read_at(i * stride, SAMPLE_BLOCK_BYTES))
+
+
+def get(key: str) -> pd.DataFrame:
+    """Return the cached or bundled frame for key, or None"""
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key].frame
+    df = _read_bundle(key)
+    if df is None:
+        df = _read_disk(key)
+    if df is not None:
+        _put_memory(key, df)
+    return df
+
+
+def put(key: str, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cache a parsed frame on disk and in memory
+
+    Returns:
+    pd.DataFrame: the frame to use instead of df, mapped from its cache
+    file, or df itself if it could not be cached on disk
+    """
+    if _write_disk(key, df):
+        mapped = _read_disk(key)
+        if mapped is not None:
+            df = mapped
+    _put_memory(key, df)
+    return df
+
+
+def acquire(key, df: pd.DataFrame=None) -> DatasetRef:
+    """
+    Reference to the frame of key, None if not in the store
+
+    df, e.g. the frame just put, is stored again if evicted meanwhile.
+    """
+    df = get(key) if df is None else df
+    if df is None:
+        return None
+    with _lock:
+        if key not in _memory:
+            _insert(key, df, int(df.memory_usage(deep=True).sum()))
+        entry = _memory[key]
+        entry.refs += 1
+    return DatasetRef(key, df, entry.nbytes)
+
+
+def derive(key, func, *args) -> pd.DataFrame:
+    """
+    Frame derived from stored ones, kept in memory under key
+
+    Returns the frame kept under key, or computes it as func(*args) and
+    keeps it until evicted. Derived frames are not persisted.
+    """
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key].frame
+    df = func(*args)
+    _put_memory(key, df, derived=True)
+    return df
+
+
+def is_stored(df) -> bool:
+    """Whether df is a frame kept in memory by the store"""
+    with _lock:
+        return any(entry.frame is df for entry in _memory.values())
+
+
+def _release(key):
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None and entry.refs > 0:
+            entry.refs -= 1
+            _evict_memory()
+
+
+def _put_memory(key, df: pd.DataFrame, derived: bool=False):
+    nbytes = int(df.memory_usage(deep=True).sum())
+    with _lock:
+        _insert(key, df, nbytes, derived)
+
+
+def _insert(key, df: pd.DataFrame, nbytes: int, derived: bool=False):
+    """Add or replace an entry, keeping its references; holds _lock"""
+    global _memory_bytes
+    refs = 0
+    if key in _memory:
+        entry = _memory.pop(key)
+        _memory_bytes -= entry.nbytes
+        refs = entry.refs
+    _memory[key] = _Entry(df, nbytes, refs, derived)
+    _memory_bytes += nbytes
+    _evict_memory()
+
+
+def _evict_memory():
+    """
+    Drop least recently used unreferenced entries beyond the budget,
+    derived frames first, always keeping the newest one; holds _lock
+    """
+    global _memory_bytes
+    newest = next(reversed(_memory), None)
+    for derived in (True, False):
+        for key in list(_memory):
+            if _memory_bytes <= MEMORY_BUDGET_BYTES:
+                return
+            entry = _memory.get(key)
+            if (entry is not None and entry.refs == 0 and
+                    entry.derived >= derived and key != newest):
+                del _memory[key]
+                _memory_bytes -= entry.nbytes
+
+
+def memory_usage() -> tuple[int, int]:
+    """Bytes of the frames in memory, and of those referenced"""
+    with _lock:
+        return (_memory_bytes,
+                sum(e.nbytes for e in _memory.values() if e.refs))
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key + '.arrow')
+
+
+def _bundle_path(key: str) -> str:
+    return os.path.join(BUNDLE_DIR, key + '.arrow')
+
+
+def _string_types():
+    """
+    Arrow type mapper restoring the Arrow string columns of compacted
+    frames, which the pandas metadata would read as StringDtype
+    """
+    import pyarrow as pa
+    return {pa.string(): pd.ArrowDtype(pa.string())}.get
+
+
+def _read_mapped(path: str) -> pd.DataFrame:
+    """
+    Frame of an uncompressed Arrow file, through a memory map
+
+    Columns are not consolidated in blocks, so numeric columns without
+    nulls and Arrow strings keep referencing the mapped pages.
+    """
+    import pyarrow as pa
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return table.to_pandas(split_blocks=True, types_mapper=_string_types())
+
+
+def _read_bundle(key: str) -> pd.DataFrame:
+    path = _bundle_path(key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        return _read_mapped(path)
+    except Exception:
+        logger.warning('Ignoring unreadable bundle file %s', path,
+                       exc_info=True)
+        return None
+
+
+def get_bundled_profile(key: str) -> dict:
+    """
+    Column profiles precompiled with a bundled dataset, as computed by
+    gs_profile.profile_dataframe, None if the dataset is not bundled
+    """
+    import pyarrow as pa
+    path = _bundle_path(key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        metadata = pa.ipc.open_file(pa.memory_map(path)).schema.metadata
+        # bundles are built locally by data/save_demos.py
+        return pickle.loads(metadata[PROFILE_METADATA])
+    except Exception:
+        logger.warning('Ignoring profile of bundle file %s', path,
+                       exc_info=True)
+        return None
+
+
+def write_bundle(key: str, df: pd.DataFrame, profile: dict) -> str:
+    """Write a dataset and its column profiles to the bundle, returns the
+    path of the file"""
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, PROFILE_METADATA: pickle.dumps(profile)})
+    os.makedirs(BUNDLE_DIR, exist_ok=True)
+    path = _bundle_path(key)
+    with pa.ipc.new_file(path, table.schema) as writer:
+        writer.write_table(table)
+    return path
+
+
+def _read_disk(key: str) -> pd.DataFrame:
+    path = _cache_path(key)
+    try:
+        df = _read_mapped(path)
+        # mtime orders entries for LRU eviction
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning('Discarding unreadable cache entry %s', path,
+                       exc_info=True)
+        _remove(path)
+        return None
+    return df
+
+
+def _write_disk(key: str, df: pd.DataFrame) -> bool:
+    """Write the cache file of a frame, returns whether it was written"""
+    import pyarrow.feather as feather
+    path = _cache_path(key)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        feather.write_feather(df, tmp_path, compression='uncompressed')
+        # atomic so concurrent readers never see partial files
+        os.replace(tmp_path, path)
+    except Exception:
+        # e.g. read-only cache dir or columns of mixed python types
+        logger.warning('Could not cache dataset %s', key, exc_info=True)
+        _remove(tmp_path)
+        return False
+    _evict_disk()
+    return True
+
+
+def _evict_disk():
+    """Delete least recently used cache files beyond the byte budget"""
+    try:
+        entries = [e for e in os.scandir(CACHE_DIR)
+                   if e.name.endswith('.arrow')]
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    total = 0
+    for entry in entries:
+        total += entry.stat().st_size
+        if total > DISK_BUDGET_BYTES:
+            _remove(entry.path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
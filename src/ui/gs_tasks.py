@@ -0,0 +1,148 @@
+"""Cancellable background tasks tied to a session
+
+Heavy work (loading, filtering, aggregations) runs in a worker thread
+while the script thread waits for it at an interruption point. When newer
+widget state arrives, e.g. while scrubbing a slider, Streamlit stops the
+waiting script run and starts a new one right away instead of queueing
+it; the new run cancels the task of the stale one, and meanwhile the
+browser keeps showing the elements of the last completed run. Tasks are
+identified by a name per session and a key of their inputs, so a rerun
+with unchanged inputs picks up the running or completed task.
+
+Task functions must not call Streamlit. They report progress and check
+for cancellation with report_progress and check_cancelled.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pandas as pd
+import streamlit as st
+
+from src.ui import gs_engine, gs_trace
+from src.ui import gs_utils as gsu
+
+TASK_WORKERS = int(os.environ.get('GS_TASK_WORKERS', 4))
+# Interval between checks for newer widget state while waiting
+POLL_SECONDS = 0.05
+
+_executor = ThreadPoolExecutor(max_workers=TASK_WORKERS,
+                               thread_name_prefix='gs-task')
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    """Raised in a task superseded by a newer one"""
+
+
+class Task:
+    """A function call running in the task pool"""
+
+    def __init__(self, key, func, args: tuple, kwds: dict):
+        self.key = key
+        self.progress = None
+        # time.monotonic() of the last run picking up the task
+        self.used = time.monotonic()
+        # bytes of the result, measured by gs_memory
+        self.nbytes = None
+        self._cancel = threading.Event()
+        self.future = _executor.submit(self._run, func, args, kwds)
+
+    def _run(self, func, args, kwds):
+        _local.task = self
+        try:
+            return func(*args, **kwds)
+        finally:
+            _local.task = None
+
+    def cancel(self):
+        self._cancel.set()
+        self.future.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+
+def check_cancelled():
+    """Raise Cancelled in a task that was superseded, no-op elsewhere"""
+    task = getattr(_local, 'task', None)
+    if task is not None and task.cancelled:
+        raise Cancelled()
+
+
+def report_progress(message: str):
+    """Report progress of the calling task, also a cancellation point"""
+    task = getattr(_local, 'task', None)
+    if task is not None:
+        task.progress = message
+    check_cancelled()
+
+
+def run(name: str, key, func, *args, show_progress=None, **kwds):
+    """
+    Run func(*args, **kwds) as a session task and wait for its result
+
+    Parameters:
+    name (str): task name, at most one task per name runs per session
+    key: hashable identity of the inputs; a task with another key under
+    the same name is cancelled and replaced
+    func (callable): task function
+    show_progress (callable): called from the script thread with the
+    latest message passed to report_progress
+
+    Returns:
+    the result of func, exceptions raised by func are re-raised and the
+    failed task is dropped
+    """
+    tasks = st.session_state.setdefault('tasks', {})
+    # least recently used first, see gs_memory
+    task = tasks.pop(name, None)
+    if task is None or task.key != key:
+        if task is not None:
+            task.cancel()
+        task = Task(key, func, args, kwds)
+        cache = 'miss'
+    else:
+        cache = 'hit' if task.future.done() else 'running'
+    task.used = time.monotonic()
+    tasks[name] = task
+    rows_in = (len(args[0]) if args and isinstance(args[0], pd.DataFrame)
+               else None)
+    with gs_trace.span('task', name=name, cache=cache,
+                       rows_in=rows_in) as stage:
+        shown = None
+        while not wait([task.future], timeout=POLL_SECONDS).done:
+            # Reading session state lets Streamlit interrupt this run when
+            # newer widget state arrived
+            st.session_state.get('tasks')
+            if show_progress is not None and task.progress != shown:
+                shown = task.progress
+                show_progress(shown)
+        try:
+            result = task.future.result()
+        except BaseException:
+            # not kept, so that the next run retries, e.g. after an IO
+            # error or running out of memory
+            if tasks.get(name) is task:
+                del tasks[name]
+            raise
+        if isinstance(result, pd.DataFrame):
+            stage['rows_out'] = len(result)
+    return result
+
+
+def discard(name: str):
+    """Cancel or forget the task of a name, dropping its result"""
+    task = st.session_state.get('tasks', {}).pop(name, None)
+    if task is not None:
+        task.cancel()
+
+
+def frame_key(df: pd.DataFrame) -> tuple:
+    """Identity of a selection of rows and columns of the loaded dataset"""
+    if isinstance(df, gs_engine.Table):
+        return (st.session_state.get('dataset_key'), df.key)
+    return (st.session_state.get('dataset_key'),
+            gsu.index_fingerprint(df.index), tuple(df.columns))
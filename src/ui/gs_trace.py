@@ -0,0 +1,126 @@
+"""Timing of the stages of a script run
+
+The hot paths of a run (loading, filtering, the grid, the plots, their
+background tasks and chart rendering) are wrapped in spans recording
+their wall time along with rows in and out, bytes sent to the browser
+and whether a cache was hit. Spans nest, e.g. the tasks of a plot.
+
+Each span is logged as a JSON line by the src.ui.gs_trace logger, at
+DEBUG level, or at INFO to stderr with GS_TRACE_LOG=1, and the spans of
+the last runs are kept in session state for the performance panel of the
+sidebar. Bytes are only measured while the panel is shown or spans are
+logged at INFO, as this serializes the data once more.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+logger = logging.getLogger(__name__)
+
+TRACE_LOG = os.environ.get('GS_TRACE_LOG', '0') != '0'
+LOG_LEVEL = logging.INFO if TRACE_LOG else logging.DEBUG
+# Runs kept per session for the panel
+MAX_RUNS = 20
+# Columns of the panel, in order
+FIELDS = ['stage', 'name', 'ms', 'rows_in', 'rows_out', 'bytes', 'cache']
+
+_local = threading.local()
+
+if TRACE_LOG:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def start_run():
+    """Start recording the spans of a script run"""
+    runs = st.session_state.get('trace')
+    if runs is None:
+        runs = st.session_state['trace'] = deque(maxlen=MAX_RUNS)
+    runs.append([])
+    st.session_state['trace_run'] = st.session_state.get('trace_run', 0) + 1
+    ctx = get_script_run_ctx(suppress_warning=True)
+    st.session_state['trace_session'] = (ctx.session_id if ctx is not None
+                                         else None)
+    _local.stack = []
+
+
+def enabled() -> bool:
+    """Whether spans measure bytes, see module docstring"""
+    return TRACE_LOG or bool(st.session_state.get('trace_panel'))
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """
+    Time the enclosed block as a stage of the run
+
+    Parameters:
+    stage (str): stage name, e.g. 'load' or 'grid'
+    fields: initial fields, among FIELDS
+
+    Yields:
+    dict: the span record, fields can be set in the block, see also
+    annotate
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    record = {'stage': stage, **fields, 'depth': len(stack)}
+    runs = st.session_state.get('trace')
+    if runs:
+        # in start order, nested spans after the enclosing one
+        runs[-1].append(record)
+    stack.append(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['ms'] = round((time.perf_counter() - started) * 1000, 1)
+        stack.pop()
+        if logger.isEnabledFor(LOG_LEVEL):
+            logger.log(LOG_LEVEL, json.dumps(
+                {'session': st.session_state.get('trace_session'),
+                 'run': st.session_state.get('trace_run'), **record},
+                default=str))
+
+
+def annotate(**fields):
+    """Set fields of the innermost open span, if any"""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].update(fields)
+
+
+def show_panel():
+    """Toggle and tables of the performance panel"""
+    if not st.toggle('Performance', key='trace_panel',
+                     help='Time spent per stage of the last runs'):
+        return
+    runs = [run for run in st.session_state.get('trace', []) if run]
+    if not runs:
+        return
+    last = runs[-1]
+    total = sum(r['ms'] for r in last if r['depth'] == 0)
+    st.caption(f'Last run: {total:.0f} ms in traced stages')
+    # nested stages are indented
+    st.dataframe(pd.DataFrame([{**{f: r.get(f) for f in FIELDS},
+                                'stage': '\u2003' * r['depth'] + r['stage']}
+                               for r in last]),
+                 hide_index=True)
+    spans = pd.DataFrame([r for run in runs for r in run])
+    st.caption(f'Last {len(runs)} runs, by stage')
+    st.dataframe(spans.groupby('stage')['ms']
+                 .agg(['count', 'mean', 'max'])
+                 .round(1),
+                 column_config={'count': 'spans'})
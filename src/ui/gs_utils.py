@@ -1,9 +1,29 @@
-import altair as alt
 import numpy as np
 import pandas as pd
+from pandas.api.types import (
+    is_bool_dtype,
+    is_float_dtype,
+    is_integer_dtype,
+    is_object_dtype,
+)
 import streamlit as st
 import subprocess
+from collections import namedtuple
 from decimal import Decimal
+from typing import TYPE_CHECKING
+from src.ui import gs_engine, gs_trace
+
+if TYPE_CHECKING:
+    # imported on first use, see get_axis_scale
+    import altair as alt
+
+# Rows of the (filtered) dataset as shown in the grid: data is the frame
+# itself, not a copy, and selected_rows the labels of rows selected in the
+# grid. For a lazy gs_engine.Table or a sample of the rows, selected_rows
+# holds the selected rows themselves. base is data before the chart
+# selection, drawn by the chart it is made on.
+GridView = namedtuple('GridView', 'data selected_rows base')
+
 
 def init_custom_style():
     """Custom CSS styling for widgets
@@ -38,7 +58,9 @@ def init_custom_style():
 
 
 def get_df_column_types(df: pd.DataFrame) -> dict:
-    is_numeric=df.dtypes!='object'
+    # object, string and categorical dtypes all have kind 'O', Arrow
+    # strings 'U'
+    is_numeric=df.dtypes.map(lambda t: t.kind not in 'OSU').astype(bool)
     column_types={}
     column_types['all_columns']=df.columns
     column_types['num_columns']=df.columns[is_numeric].tolist()
@@ -46,6 +68,98 @@ def get_df_column_types(df: pd.DataFrame) -> dict:
     return column_types
 
 
+def index_fingerprint(index: pd.Index) -> int:
+    """Cheap hash identifying a set of rows, e.g. a filter result"""
+    hashed = pd.util.hash_array(np.asarray(index))
+    return hash((len(index), int(hashed.sum())))
+
+
+def downcast_frame(df: pd.DataFrame,
+                   cat_columns: list=()) -> pd.DataFrame:
+    """
+    Store columns in the narrowest lossless dtype
+
+    Parameters:
+    df (pd.DataFrame): input data, modified in place
+    cat_columns (list): string columns to convert to categoricals
+
+    Returns:
+    pd.DataFrame: the downcast dataframe
+    """
+    for column in df.columns:
+        s = df[column]
+        if column in cat_columns:
+            if is_object_dtype(s):
+                df[column] = s.astype('category')
+        elif is_integer_dtype(s) and not is_bool_dtype(s):
+            df[column] = pd.to_numeric(s, downcast='integer')
+        elif is_float_dtype(s) and s.dtype.itemsize > 4:
+            s32 = s.astype('float32')
+            # keep float64 unless every value round-trips exactly
+            if np.array_equal(s32.to_numpy(dtype='float64'), s.to_numpy(),
+                              equal_nan=True):
+                df[column] = s32
+    return df
+
+
+def compact_frame(df: pd.DataFrame,
+                  cat_columns: list=None,
+                  text_columns: list=None,
+                  max_category_ratio: float=0.5) -> pd.DataFrame:
+    """
+    Store columns in compact dtypes
+
+    Strings with few distinct values become categoricals and the other
+    strings Arrow strings, instead of Python objects; numbers are
+    downcast as in downcast_frame.
+
+    Parameters:
+    df (pd.DataFrame): input data, modified in place
+    cat_columns (list): string columns to convert to categoricals, by
+    default those with at most max_category_ratio distinct values per row
+    text_columns (list): string columns, by default the object columns
+    holding only strings; values of other types are converted to strings
+    max_category_ratio (float): see cat_columns
+
+    Returns:
+    pd.DataFrame: the compacted dataframe
+    """
+    import pyarrow as pa
+    if text_columns is None:
+        text_columns = string_columns(df)
+    if cat_columns is None:
+        cat_columns = [c for c in text_columns
+                       if df[c].nunique() <= max_category_ratio * len(df)]
+    df = downcast_frame(df, cat_columns)
+    for column in text_columns:
+        if column not in cat_columns:
+            df[column] = df[column].astype(pd.ArrowDtype(pa.string()))
+    return df
+
+
+def string_columns(df: pd.DataFrame) -> list:
+    """Object columns holding only strings (and missing values)"""
+    return [c for c in df.columns
+            if is_object_dtype(df[c]) and
+            pd.api.types.infer_dtype(df[c], skipna=True) == 'string']
+
+
+def memory_bytes(df: pd.DataFrame) -> int:
+    """Memory used by a frame, including the Python objects it holds"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def format_bytes(n: float) -> str:
+    """Human readable byte count, e.g. 12.3 MB"""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n) < 1000:
+            break
+        n /= 1000
+    else:
+        unit = 'TB'
+    return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+
+
 def pick_if_present(reference: list,
                     to_check: list,
                     default: int=0) -> tuple[int, list]:
@@ -68,7 +182,7 @@ def pick_if_present(reference: list,
     return pick, items_found
 
 
-def get_axis_scale(scale_str: str) -> alt.Scale:
+def get_axis_scale(scale_str: str) -> 'alt.Scale':
     """
     This function takes a scale string as input and returns an Altair Scale 
     object based on the provided scale type.
@@ -84,6 +198,7 @@ def get_axis_scale(scale_str: str) -> alt.Scale:
     alt.Scale: An Altair Scale object configured according to the specified 
     scale type.
     """
+    import altair as alt
     scale_lut={'linear': {'type':'linear'},
     'log10' : {'type':'log', 'base':10},
     'log2' : {'type':'log', 'base':2}
@@ -96,25 +211,49 @@ def format_float(f):
     return d.quantize(Decimal(1)) if d == d.to_integral() else d.normalize()
 
 
-def transform_nlogp(p: list[float], base:int=10) -> float:
+def transform_nlogp(p: list[float], base:int=10) -> np.ndarray:
     """
     Calculate negative-log p-values 
     
     Parameters:
-    p (list[float]): list of p-values
+    p (list[float]): list of p-values, missing values stay NaN
     base (int): Base of logarithm. Default is 10
 
     Returns:
-    nlogp: list of negative log_base p-values of same length as p     
+    nlogp: array of negative log_base p-values of same length as p     
     """
-    
+    p = np.asarray(p, dtype='float64')
     # to avoid log(0), set zeros to small non-zero values
-    min_nz_p = 0.01*np.min(p[p]>0)
+    nonzero = p[p > 0]
+    min_nz_p = (0.01*nonzero.min() if len(nonzero)
+                else np.finfo('float64').tiny)
     return -np.log(np.clip(p, min_nz_p, 1))/np.log(base)
 
 
-def set_chart_name(chart: alt.Chart,
-                   filename: str) -> alt.Chart:
+def chart_data(df: pd.DataFrame, fields: list) -> pd.DataFrame:
+    """
+    Restrict chart data to the fields it encodes
+
+    Altair embeds every column of the chart data, so unused columns only
+    add to the payload sent to the browser.
+
+    Parameters:
+    df (pd.DataFrame): chart data, or a lazy gs_engine.Table of which at
+    most gs_engine.SAMPLE_ROWS sampled rows are used
+    fields (list): field names or alt.Tooltip objects, None is ignored
+
+    Returns:
+    pd.DataFrame: df with only the referenced columns
+    """
+    names = [getattr(f, 'shorthand', f) for f in fields if f is not None]
+    columns = [c for c in dict.fromkeys(names) if c in df.columns]
+    if isinstance(df, gs_engine.Table):
+        return df.sample(gs_engine.SAMPLE_ROWS, columns)
+    return df.loc[:, columns]
+
+
+def set_chart_name(chart: 'alt.Chart',
+                   filename: str) -> 'alt.Chart':
     # set chart save filename and actions
     chart['usermeta'] = {
         'embedOptions': {
@@ -128,11 +267,26 @@ def set_chart_name(chart: alt.Chart,
     return chart
 
 
+def show_chart(chart: 'alt.Chart', **kwargs):
+    """
+    st.altair_chart, traced as the 'chart' stage
+
+    The bytes of the chart spec and its data are measured while tracing
+    is enabled, see gs_trace.
+    """
+    data = getattr(chart, 'data', None)
+    with gs_trace.span('chart', rows_in=(len(data) if isinstance(
+            data, pd.DataFrame) else None)) as stage:
+        if gs_trace.enabled():
+            stage['bytes'] = len(chart.to_json())
+        return st.altair_chart(chart, **kwargs)
+
+
 def update_status(s: str):
     """Display string in status bar"""
     st.session_state['status_bar'].code(s, language='python')
 
-@st.cache_data
+@st.cache_data(max_entries=1)
 def get_version()->str:
     """Get version from build-time generated file or fallback to git"""
     try:
@@ -0,0 +1,136 @@
+"""Startup cost of the server process
+
+Heavy dependencies (Altair, AG Grid, vega_datasets, DuckDB) and the plot
+modules are imported on first use, so that a new server process renders
+the landing page right away. The first session would then pay for them
+on its first chart, along with loading the Vega-Lite schema Altair
+validates charts against and parsing the demo dataset it picks. The
+warm-up does this work in a background thread, started by the first run
+of the app while the user is still picking data; GS_WARMUP=0 disables it.
+
+The import time of the startup modules is kept under a budget, checked
+in a fresh interpreter with `python -m src.ui.gs_warmup`, which exits
+with status 1 when the budget is exceeded or a module meant to be
+imported lazily is imported at startup.
+"""
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+WARMUP = os.environ.get('GS_WARMUP', '1') != '0'
+# Seconds allowed to import the startup modules, once streamlit and pandas
+# are imported
+IMPORT_BUDGET_SECONDS = float(os.environ.get('GS_IMPORT_BUDGET', 0.2))
+# Modules imported by app.py before any data is loaded
+STARTUP_MODULES = ['src.ui.gs_body', 'src.ui.gs_memory', 'src.ui.gs_state',
+                   'src.ui.gs_trace', 'src.ui.gs_utils']
+# Modules imported on first use, not at startup
+LAZY_MODULES = ['altair', 'st_aggrid', 'vega_datasets', 'duckdb',
+                'src.ui.describe', 'src.ui.distplot', 'src.ui.dotplot',
+                'src.ui.volcano', 'src.ui.xyplot']
+
+Dataset = namedtuple('Dataset', 'name source type file')
+
+_started = False
+_lock = threading.Lock()
+
+
+def start(demos: dict):
+    """
+    Start the warm-up in the background, once per server process
+
+    Parameters:
+    demos (dict): demo datasets by name, as in data/demo_datasets.json
+    """
+    global _started
+    if not WARMUP:
+        return
+    with _lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=warm_up, args=(demos,), name='gs-warmup',
+                     daemon=True).start()
+
+
+def warm_up(demos: dict):
+    """Import the lazy modules, load the chart schema and parse the demos"""
+    from src.ui import gs_body
+    started = time.perf_counter()
+    for module_name, _ in gs_body.PLOTS.values():
+        importlib.import_module(f'src.ui.{module_name}')
+    importlib.import_module('st_aggrid')
+    load_chart_schema()
+    for name, demo in demos.items():
+        try:
+            preload_dataset(Dataset(name, **demo))
+        except Exception:
+            logger.exception('Warm-up could not load demo %r', name)
+    logger.info('Warm-up done in %.2fs', time.perf_counter() - started)
+
+
+def load_chart_schema():
+    """Validate a minimal chart, which loads the Vega-Lite schema"""
+    import altair as alt
+    import pandas as pd
+    (alt.Chart(pd.DataFrame({'x': [0.]}))
+     .mark_point()
+     .encode(x='x:Q')
+     .to_dict())
+
+
+def preload_dataset(dataset: Dataset):
+    """
+    Parse a demo dataset into the dataset store and start its profile, as
+    gs_body.data_loader does on first use
+    """
+    from src.ui import gs_body, gs_engine, gs_profile, gs_store
+    key = gs_body.get_dataset_key(dataset)
+    if dataset.source == 'local-dataset':
+        table = gs_engine.open_table(dataset.file, dataset.type)
+        if table is not None:
+            gs_profile.start_profile(key, table)
+            return
+    df = gs_store.get(key)
+    if df is None:
+        df = gs_body.store_dataset(key, dataset)
+    gs_profile.start_profile(key, df)
+
+
+def measure_imports() -> tuple[float, list]:
+    """
+    Import the startup modules in this interpreter
+
+    Returns:
+    tuple: seconds spent importing them, and the LAZY_MODULES they
+    imported
+    """
+    import pandas  # noqa: F401
+    import streamlit  # noqa: F401
+    started = time.perf_counter()
+    for module_name in STARTUP_MODULES:
+        importlib.import_module(module_name)
+    seconds = time.perf_counter() - started
+    return seconds, [m for m in LAZY_MODULES if m in sys.modules]
+
+
+def main() -> int:
+    if any(m in sys.modules for m in STARTUP_MODULES):
+        print('Run in a fresh interpreter: python -m src.ui.gs_warmup')
+        return 2
+    seconds, eager = measure_imports()
+    print(f'Startup imports: {seconds * 1000:.0f} ms, '
+          f'budget {IMPORT_BUDGET_SECONDS * 1000:.0f} ms')
+    if eager:
+        print('Imported at startup: ' + ', '.join(eager))
+    return int(seconds > IMPORT_BUDGET_SECONDS or bool(eager))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+import threading
+from collections import OrderedDict
+import streamlit as st
+import numpy as np
+import pandas as pd
+import altair as alt
+from src.ui import gs_engine
+from src.ui import gs_profile, gs_store, gs_tasks, xyplot
+from src.ui import gs_utils as gsu
+
+"""
+Functions to create volcano plots of differential expression tables
+"""
+
+# Classes of the rows, in legend order
+CLASSES = ['down', 'ns', 'up']
+DOWN, NS, UP = range(len(CLASSES))
+# Column of the -log10 p-values in the chart data
+NLOGP = '_nlogp'
+# Number of -log10 p-value columns kept, one per dataset and p column
+MAX_TRANSFORMS = 8
+
+_transforms = OrderedDict()
+_lock = threading.Lock()
+
+
+def make_volcano_plot(grid_return: gsu.GridView):
+    """Render volcano plot in ui"""
+    ctypes = gs_profile.get_column_types(grid_return.data)
+    # settings and options
+    opts = get_volcano_options(ctypes)
+
+    # main viz
+    df = grid_return.data
+    dataset_key = st.session_state.get('dataset_key')
+    key = (*gs_tasks.frame_key(df), tuple(opts['add_tooltips']),
+           *(opts[k] for k in ['fc_axis', 'p_axis', 'fc_threshold',
+                               'p_threshold', 'column_facet',
+                               'density_bins']))
+    data, counts = gs_tasks.run('volcano', key, volcano_data, df, opts,
+                                dataset_key)
+    n_points = int((data['_layer'] == 'points').sum())
+    n_significant = counts[DOWN] + counts[UP]
+    caption = (f'{counts[UP]} up, {counts[DOWN]} down, {counts[NS]} not '
+               f'significant (binned)')
+    if n_points < n_significant:
+        caption += (f', {n_points} of {n_significant} significant points '
+                    f'drawn')
+    st.caption(caption)
+    chart = plot_volcano(data, opts)
+    gsu.show_chart(chart, use_container_width=False)
+
+
+def get_nlogp(df: pd.DataFrame, p_field: str,
+              dataset_key: str) -> np.ndarray:
+    """
+    -log10 p-values of the rows of df
+
+    The transform is computed once per dataset and p-value column, over
+    all loaded rows, so that zero p-values get the same floor whatever
+    the filters, and then looked up by row label for each view. Rows
+    fetched from a lazy Table are transformed as they are.
+    """
+    key = (dataset_key, p_field)
+    with _lock:
+        nlogp = _transforms.get(key)
+        if nlogp is not None:
+            _transforms.move_to_end(key)
+    if nlogp is None:
+        full = gs_store.get(dataset_key)
+        if (full is None or p_field not in full.columns or
+                not full.index.is_unique):
+            return gsu.transform_nlogp(
+                df[p_field].to_numpy(dtype='float64', na_value=np.nan))
+        nlogp = pd.Series(gsu.transform_nlogp(
+            full[p_field].to_numpy(dtype='float64', na_value=np.nan)),
+            index=full.index)
+        with _lock:
+            _transforms[key] = nlogp
+            while len(_transforms) > MAX_TRANSFORMS:
+                _transforms.popitem(last=False)
+    if nlogp.index.equals(df.index):
+        return nlogp.to_numpy()
+    return nlogp.reindex(df.index).to_numpy()
+
+
+def classify(fc: np.ndarray,
+             nlogp: np.ndarray,
+             fc_threshold: float,
+             p_threshold: float) -> np.ndarray:
+    """
+    Class codes (DOWN, NS or UP) of the rows
+
+    Rows are significant when p <= p_threshold and |fc| >= fc_threshold,
+    rows with missing values are not.
+    """
+    with np.errstate(divide='ignore'):
+        significant = nlogp >= -np.log10(p_threshold)
+    codes = np.full(len(fc), NS, dtype=np.int8)
+    codes[significant & (fc >= fc_threshold)] = UP
+    codes[significant & (fc <= -fc_threshold)] = DOWN
+    return codes
+
+
+def volcano_data(df: pd.DataFrame,
+                 opts: dict,
+                 dataset_key: str) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    Chart data of a volcano plot
+
+    Significant rows are drawn as points, thinned with
+    xyplot.thin_points beyond xyplot.DENSITY_ROWS, and the non-significant
+    bulk is binned server-side as in xyplot.density_counts.
+
+    Parameters:
+    df (pd.DataFrame): input data, or a lazy Table of which the plotted
+    columns are fetched
+    opts (dict): plot options
+    dataset_key (str): fingerprint of the loaded dataset
+
+    Returns:
+    tuple: (data, counts) with data a single frame of the layers tagged
+    by _layer, and counts the number of rows per class
+    """
+    group_fields = ([opts['column_facet']]
+                    if opts['column_facet'] is not None else [])
+    columns = list(dict.fromkeys([opts['fc_axis'], opts['p_axis'],
+                                  *group_fields, *opts['add_tooltips']]))
+    if isinstance(df, gs_engine.Table):
+        df = df.fetch(columns)
+    nlogp = get_nlogp(df, opts['p_axis'], dataset_key)
+    fc = df[opts['fc_axis']].to_numpy(dtype='float64', na_value=np.nan)
+    codes = classify(fc, nlogp, opts['fc_threshold'], opts['p_threshold'])
+    data = df.loc[:, columns].assign(
+        **{NLOGP: nlogp,
+           '_class': pd.Categorical.from_codes(codes, CLASSES)})
+    axes_opts = {'x_axis': opts['fc_axis'], 'y_axis': NLOGP,
+                 'x_scale': 'linear', 'y_scale': 'linear',
+                 'density_bins': opts['density_bins']}
+    significant = codes != NS
+    bulk = xyplot.density_counts(data[~significant], axes_opts,
+                                 group_fields)
+    points = data[significant]
+    if len(points) > xyplot.DENSITY_ROWS:
+        points = xyplot.thin_points(points, axes_opts,
+                                    ['_class', *group_fields])
+    # threshold rules, repeated in every facet
+    rules = pd.DataFrame({
+        '_layer': ['fc_threshold', 'fc_threshold', 'p_threshold'],
+        'x0': [-opts['fc_threshold'], opts['fc_threshold'], np.nan],
+        'y0': [np.nan, np.nan, -np.log10(opts['p_threshold'])]})
+    if group_fields:
+        rules = rules.merge(data[group_fields].drop_duplicates(),
+                            how='cross')
+    # a single dataset with a layer tag, so that layers can be faceted
+    data = pd.concat([bulk.assign(_layer='bulk'),
+                      points.assign(_layer='points'),
+                      rules], ignore_index=True)
+    return data, np.bincount(codes, minlength=len(CLASSES))
+
+
+def plot_volcano(data: pd.DataFrame, opts: dict) -> alt.Chart:
+    """
+    Volcano plot of the layers computed by volcano_data
+
+    Parameters:
+    data (pd.DataFrame): chart data
+    opts (dict): plot options
+
+    Returns:
+    alt.Chart: the layered chart
+    """
+    x_title = opts['fc_axis']
+    y_title = f"-log10({opts['p_axis']})"
+    axis = alt.Axis(tickCount=9, format='2.4g')
+    base = alt.Chart().properties(width=opts['width'],
+                                  height=opts['height'])
+    h_bulk = (base
+              .mark_rect()
+              .encode(x=alt.X('x0:Q', title=x_title, axis=axis),
+                      x2=alt.X2('x1:Q'),
+                      y=alt.Y('y0:Q', title=y_title, axis=axis),
+                      y2=alt.Y2('y1:Q'),
+                      color=alt.Color('count:Q',
+                                      scale=alt.Scale(type='log',
+                                                      scheme='greys'),
+                                      title='Not significant'),
+                      tooltip=[alt.Tooltip('count:Q')])
+              .transform_filter(alt.datum._layer == 'bulk'))
+    h_points = (base
+                .mark_point(filled=True, size=opts['size'],
+                            opacity=opts['opacity'])
+                .encode(x=alt.X(opts['fc_axis'], title=x_title, axis=axis),
+                        y=alt.Y(NLOGP, title=y_title, axis=axis),
+                        color=alt.Color('_class:N',
+                                        scale=alt.Scale(
+                                            domain=[CLASSES[DOWN],
+                                                    CLASSES[UP]],
+                                            range=[opts['down_color'],
+                                                   opts['up_color']]),
+                                        title='Significant'),
+                        tooltip=[*opts['add_tooltips'],
+                                 alt.Tooltip(opts['fc_axis'],
+                                             format='0.2f'),
+                                 alt.Tooltip(opts['p_axis'],
+                                             format='.2e')])
+                .transform_filter(alt.datum._layer == 'points'))
+    h_fc = (base
+            .mark_rule(strokeDash=[4, 4], color='#808080')
+            .encode(x=alt.X('x0:Q'))
+            .transform_filter(alt.datum._layer == 'fc_threshold'))
+    h_p = (base
+           .mark_rule(strokeDash=[4, 4], color='#808080')
+           .encode(y=alt.Y('y0:Q'))
+           .transform_filter(alt.datum._layer == 'p_threshold'))
+    chart = (alt.layer(h_bulk, h_points, h_fc, h_p, data=data)
+             .resolve_scale(color='independent'))
+
+    if opts['column_facet'] is not None:
+        facet_header = alt.Header(titleFontSize=20,
+                                  labelFontSize=20,
+                                  labelAnchor='middle',
+                                  labelColor='#808080',
+                                  labelFontWeight='normal',
+                                  titleFontWeight='bold',
+                                  titleAnchor='middle',
+                                  labelAlign='center')
+        chart = chart.facet(column=alt.Facet(opts['column_facet'],
+                                             header=facet_header))
+
+    chart = (chart
+             .configure_axis(labelFontSize=16,
+                        titleFontSize=16,
+                        titleFontWeight='bold')
+             .configure_view(stroke='#808080',
+                        strokeWidth=1.5))
+    return gsu.set_chart_name(chart, opts['plot_name'])
+
+
+def get_volcano_options(ctypes) -> dict:
+
+    names_tocheck=['gene_name', 'gene_symbol', 'name', 'id']
+    # preferred columns first
+    fc_to_check = ['logfc', 'logFC', 'log2fc', 'log2FoldChange',
+                   'log2_fold_change']
+    p_to_check = ['adj_p_value', 'padj', 'adj.P.Val', 'fdr', 'FDR',
+                  'p_value', 'pvalue', 'P.Value']
+    num_columns = ctypes['num_columns']
+    _, names_list = gsu.pick_if_present(ctypes['cat_columns'],
+                                        names_tocheck)
+    default_fc = next((num_columns.index(c) for c in fc_to_check
+                       if c in num_columns), 0)
+    default_p = next((num_columns.index(c) for c in p_to_check
+                      if c in num_columns), min(1, len(num_columns) - 1))
+
+    opts={}
+    with st.sidebar:
+        with st.container(border=True):
+            st.markdown('**Volcano Settings**')
+            with st.popover('Fine tune',
+                            icon=':material/tune:',
+                            use_container_width=True).container(
+                                height=400):
+                opts['plot_name'] = st.text_input('Plot name:',
+                                                  'volcano_plot',
+                                                  max_chars=50)
+                opts['density_bins'] = st.slider(
+                    'Density bins:', min_value=10, max_value=300, step=10,
+                    value=100,
+                    help='Bins per axis of the non-significant rows')
+                opts['width'] = st.slider('Plot width:',
+                                        min_value=50,
+                                        max_value=1000,
+                                        step=25,
+                                        value=400)
+                opts['height'] = st.slider('Plot height:',
+                                        min_value=50,
+                                        max_value=1000,
+                                        step=25,
+                                        value=400)
+                opts['opacity'] = st.slider('Opacity:', min_value=0.0,
+                                            max_value=1.0, step=0.1,
+                                            value=0.8)
+                opts['size'] = st.slider('Size:', min_value=0,
+                                         max_value=500, step=10, value=30)
+                opts['up_color'] = st.color_picker('Up color:', '#d62728')
+                opts['down_color'] = st.color_picker('Down color:',
+                                                     '#1f77b4')
+            opts['fc_axis'] = st.selectbox('Fold change:',
+                                           num_columns,
+                                           index=default_fc)
+            opts['p_axis'] = st.selectbox('P-value:',
+                                          num_columns,
+                                          index=default_p)
+            opts['fc_threshold'] = st.number_input(
+                'Fold change threshold:', min_value=0.0, value=1.0,
+                step=0.25,
+                help='Minimum absolute fold change of significant rows')
+            opts['p_threshold'] = st.number_input(
+                'P-value threshold:', min_value=1e-300, max_value=1.0,
+                value=0.05, step=0.01, format='%g',
+                help='Maximum p-value of significant rows')
+            opts['column_facet'] = st.selectbox('Column Facet:',
+                                                ctypes['group_columns'],
+                                                label_visibility='collapsed',
+                                                placeholder='Column facet',
+                                                index=None)
+            opts['add_tooltips'] = st.multiselect('Tooltips:',
+                                                ctypes['all_columns'],
+                                                label_visibility='collapsed',
+                                                placeholder='Add tooltips',
+                                                default=names_list)
+    return opts
@@ -1,26 +1,105 @@
+import os
 import streamlit as st
+import numpy as np
 import pandas as pd
 import altair as alt
-from st_aggrid import AgGrid
+from pandas.api.types import is_datetime64_any_dtype
+from src.ui import gs_engine
+from src.ui import gs_parallel as gsp
+from src.ui import gs_filter, gs_profile, gs_sample, gs_tasks
 from src.ui import gs_utils as gsu
 
 """
 Functions to create XY / scatter plots
 """
 
-def make_xy_plot(grid_return: AgGrid):
+# In 'Auto' render mode, more rows than this are drawn as a density
+DENSITY_ROWS = int(os.environ.get('GS_DENSITY_ROWS', 50_000))
+# In 'Auto' render mode, more rows than this are thinned; by default
+# thinning is only used when picked, Vega-Lite draws this many points fine
+POINT_ROWS = int(os.environ.get('GS_POINT_ROWS', DENSITY_ROWS))
+# Thinning grid: cells per axis, and points kept per cell and group
+THIN_BINS = 64
+THIN_CELL_ROWS = 4
+# Points kept at each end of each axis when thinning
+EXTREME_ROWS = 25
+# Transforms of the axis scales, density bins are regular in this space
+SCALE_TRANSFORMS = {'linear': (lambda v: v, lambda v: v),
+                    'log10': (np.log10, lambda v: 10 ** v),
+                    'log2': (np.log2, np.exp2)}
+
+def make_xy_plot(grid_return: gsu.GridView):
     """ Render scatter plot in ui
     """
-    ctypes = gsu.get_df_column_types(grid_return.data)
+    ctypes = gs_profile.get_column_types(grid_return.data)
     # settings and options
     opts, opts_type = get_xy_options(ctypes)
     
-    # main viz        
-    chart = plot_xy(grid_return.data, opts, opts_type)
-    st.altair_chart(chart, use_container_width=False)
+    # main viz, of the rows before the selection made on it
+    df = grid_return.base
+    render_mode = opts['render_mode']
+    if render_mode == 'Auto':
+        render_mode = ('Points' if len(df) <= POINT_ROWS
+                       else 'Thinned' if len(df) <= DENSITY_ROWS
+                       else 'Density')
+    if render_mode == 'Points':
+        chart = plot_xy(df, opts, opts_type)
+    else:
+        # rows selected in the grid are always drawn as points
+        selected = grid_return.selected_rows
+        highlight = (selected if isinstance(selected, pd.DataFrame)
+                     else df.loc[selected])
+        if render_mode == 'Density':
+            chart = plot_xy_density(df, opts, highlight=highlight)
+        else:
+            chart = plot_xy_thinned(df, opts, opts_type,
+                                    highlight=highlight)
+    selection = gs_filter.get_source_conditions('chart')
+    if not opts['select_rows'] or set(selection).difference(
+            [opts['x_axis'], opts['y_axis']]):
+        # the selection was made with other options
+        if gs_filter.set_source_conditions('chart', {}):
+            st.rerun()
+    if opts['select_rows']:
+        gsu.show_chart(chart, use_container_width=False,
+                       on_select=lambda: store_selection(opts),
+                       key='xy_selection')
+    else:
+        gsu.show_chart(chart, use_container_width=False)
+
 
-def plot_xy(df: pd.DataFrame, opts:dict, opts_type:dict) -> alt.Chart:
-    """Generate XY plot"""
+def store_selection(opts: dict):
+    """
+    Store the rows brushed on the plot as chart filter conditions
+
+    The density layer encodes the cell bounds x0 and y0 instead of the
+    axis fields.
+    """
+    state = st.session_state.get('xy_selection') or {}
+    brush = (state.get('selection') or {}).get('brush') or {}
+    fields = {'x0': opts['x_axis'], 'y0': opts['y_axis'],
+              opts['x_axis']: opts['x_axis'], opts['y_axis']: opts['y_axis']}
+    gs_filter.set_source_conditions(
+        'chart', {fields[field]: ('between', *map(float, bounds))
+                  for field, bounds in brush.items()
+                  if field in fields and len(bounds) == 2})
+
+
+def get_brush(opts: dict):
+    """Interval selection of rows on the plot, None if not enabled"""
+    if not opts['select_rows']:
+        return None
+    return alt.selection_interval(name='brush', encodings=['x', 'y'])
+
+def plot_xy(df: pd.DataFrame, opts:dict, opts_type:dict,
+            average: pd.DataFrame=None) -> alt.Chart:
+    """
+    Generate XY plot
+
+    Averages are computed by the chart from the points drawn, unless
+    given as a frame of precomputed points, e.g. of all rows when only
+    some are drawn.
+    """
     mark_kwds={k: opts.get(k) for k in opts_type['mark']}
     kwds={'x' : alt.X(opts['x_axis'], 
                       title=opts['x_axis'],
@@ -81,6 +160,15 @@ def plot_xy(df: pd.DataFrame, opts:dict, opts_type:dict) -> alt.Chart:
     else:
         selection=alt.selection_point()
     
+    df = gsu.chart_data(df, [opts['x_axis'], opts['y_axis'],
+                             opts['color_by'], opts['size_by'],
+                             opts['shape_by'], opts['column_facet'],
+                             opts['row_facet'], *tooltips])
+    if opts['show_average'] and average is not None:
+        # a single dataset with a layer tag, so that layers can be faceted
+        df = pd.concat([df.assign(_layer='points'),
+                        average.assign(_layer='average')],
+                       ignore_index=True)
     chart=(
         alt.Chart(data=df)
         .mark_point(**mark_kwds)
@@ -90,8 +178,26 @@ def plot_xy(df: pd.DataFrame, opts:dict, opts_type:dict) -> alt.Chart:
         .properties(width=opts['width'],
                     height=opts['height'])
         )
+    if opts['show_average'] and average is not None:
+        chart = chart.transform_filter(alt.datum._layer == 'points')
+    brush = get_brush(opts)
+    if brush is not None:
+        chart = chart.add_params(brush)
 
-    if opts['show_average']:
+    if opts['show_average'] and average is not None:
+        avg_value = (alt.Chart(df)
+                     .mark_point(filled=True,
+                                 strokeWidth=4,
+                                 size = 120,
+                                 opacity=0.8)
+                     .encode(x=alt.X(opts['x_axis']),
+                             y=alt.Y(opts['y_axis']),
+                             color = kwds.get('color', alt.Undefined)
+                             )
+                     .transform_filter(alt.datum._layer == 'average')
+                    )
+        chart = alt.layer(chart, avg_value)
+    elif opts['show_average']:
         avg_value = (alt.Chart(df)
                      .mark_point(filled=True,
                                  strokeWidth=4,
@@ -119,6 +225,355 @@ def plot_xy(df: pd.DataFrame, opts:dict, opts_type:dict) -> alt.Chart:
     return chart
 
 
+def density_counts(df: pd.DataFrame,
+                   opts: dict,
+                   group_fields: list=()) -> pd.DataFrame:
+    """
+    2D histogram of the x and y fields
+
+    Bins are regular in the space of the axis scales (e.g. log10), so
+    cells have equal size on the plot. Values that cannot be shown on a
+    log scale are dropped. Large frames are counted in parallel over
+    blocks of rows, lazy Tables by a query.
+
+    Parameters:
+    df (pd.DataFrame): input data
+    opts (dict): plot options, uses x_axis, y_axis, x_scale, y_scale and
+    density_bins
+    group_fields (list): fields counted separately, e.g. color and facets
+
+    Returns:
+    pd.DataFrame: one row per non-empty cell and group with columns
+    group_fields, x0, x1, y0, y1 (cell bounds in data units) and count
+    """
+    nbins = opts['density_bins']
+    if isinstance(df, gs_engine.Table):
+        counts, bounds = df.cell_counts(
+            {axis: (opts[axis + '_axis'], opts[axis + '_scale'])
+             for axis in ['x', 'y']}, nbins, group_fields)
+    else:
+        counts, bounds = _cell_counts(df, opts, group_fields)
+    if counts is None:
+        return pd.DataFrame(columns=[*group_fields, 'x0', 'x1',
+                                     'y0', 'y1', 'count'])
+    cell = counts.pop('_cell').to_numpy()
+    for axis, index in [('x', cell // nbins), ('y', cell % nbins)]:
+        _min, step = bounds[axis]
+        _, inverse = SCALE_TRANSFORMS[opts[axis + '_scale']]
+        counts[axis + '0'] = inverse(_min + step * index)
+        counts[axis + '1'] = inverse(_min + step * (index + 1))
+    return counts
+
+
+def scaled_values(df: pd.DataFrame, opts: dict) -> tuple[dict, np.ndarray]:
+    """
+    x and y values in the space of the axis scales, by axis, and the mask
+    of rows where both are finite, i.e. can be drawn
+    """
+    values = {}
+    valid = np.ones(len(df), dtype=bool)
+    for axis in ['x', 'y']:
+        forward, _ = SCALE_TRANSFORMS[opts[axis + '_scale']]
+        column = df[opts[axis + '_axis']]
+        raw = column.to_numpy(dtype='float64', na_value=np.nan)
+        if is_datetime64_any_dtype(column):
+            # NaT converts to the smallest int64, which is finite
+            raw[column.isna().to_numpy()] = np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values[axis] = forward(raw)
+        valid &= np.isfinite(values[axis])
+    return values, valid
+
+
+def grid_cells(values: dict, valid: np.ndarray, nbins: int) -> tuple:
+    """
+    Cells of the valid rows on a regular grid of nbins per axis
+
+    Returns:
+    tuple: (cells, bounds) with cells the x bin * nbins + y bin of each
+    valid row and bounds the (min, step) by axis; (None, None) without
+    valid rows
+    """
+    if not valid.any():
+        return None, None
+    cells = {}
+    bounds = {}
+    for axis in ['x', 'y']:
+        v = values[axis][valid]
+        _min, _max = v.min(), v.max()
+        step = (_max - _min) / nbins or 1.
+        cells[axis] = np.minimum((v - _min) // step,
+                                 nbins - 1).astype(np.int64)
+        bounds[axis] = (_min, step)
+    return cells['x'] * nbins + cells['y'], bounds
+
+
+def _cell_counts(df: pd.DataFrame,
+                 opts: dict,
+                 group_fields: list) -> tuple:
+    """
+    Counts per cell of a frame, as returned by gs_engine.Table.cell_counts
+    """
+    values, valid = scaled_values(df, opts)
+    cells, bounds = grid_cells(values, valid, opts['density_bins'])
+    if cells is None:
+        return None, None
+    binned = (df.loc[valid, list(group_fields)]
+              .assign(_cell=cells))
+    partials = gsp.map_partitions(count_cells, gsp.row_partitions(binned))
+    counts = partials[0]
+    if len(partials) > 1:
+        counts = (pd.concat(partials)
+                  .groupby([*group_fields, '_cell'], observed=True,
+                           dropna=False, sort=False)['count']
+                  .sum()
+                  .reset_index())
+    return counts, bounds
+
+
+def count_cells(binned: pd.DataFrame) -> pd.DataFrame:
+    """Rows per cell and group of a block of rows, see density_counts"""
+    return (binned
+            .value_counts(dropna=False, sort=False)
+            .rename('count')
+            .reset_index())
+
+
+def get_group_fields(opts: dict) -> list:
+    """Distinct fields of the color and facets"""
+    return list(dict.fromkeys(opts[k] for k in ['color_by', 'column_facet',
+                                                'row_facet']
+                              if opts[k] is not None))
+
+
+def average_points(df: pd.DataFrame,
+                   opts: dict,
+                   group_fields: list=()) -> pd.DataFrame:
+    """Average x and y of all rows, one row per group"""
+    if isinstance(df, gs_engine.Table):
+        average = (df.agg([opts['x_axis'], opts['y_axis']],
+                          [opts['average_measure']], group_fields)
+                   .droplevel(1, axis=1))
+        return average.reset_index() if group_fields else average
+    average = (df.groupby(group_fields, observed=True, dropna=False)
+               if group_fields else df)
+    average = (average[[opts['x_axis'], opts['y_axis']]]
+               .agg(opts['average_measure']))
+    return (average.reset_index() if group_fields
+            else average.to_frame().T)
+
+
+def thin_points(df: pd.DataFrame,
+                opts: dict,
+                group_fields: list=(),
+                columns: list=None) -> pd.DataFrame:
+    """
+    Level-of-detail subset of the points of an XY plot
+
+    The plot area is divided in THIN_BINS x THIN_BINS cells, regular in
+    the space of the axis scales. Each cell keeps at most THIN_CELL_ROWS
+    points per group, picked by the row priorities of gs_sample, so
+    sparse regions keep all their points and dense cores are thinned.
+    The EXTREME_ROWS most extreme points at both ends of both axes are
+    always kept, e.g. the hits of a volcano plot. Points that cannot be
+    drawn on the axis scales are dropped.
+
+    Parameters:
+    df (pd.DataFrame): input data, or a lazy Table thinned by a query
+    opts (dict): plot options, uses x_axis, y_axis, x_scale and y_scale
+    group_fields (list): fields thinned separately, e.g. color and facets
+    columns (list): columns returned, None for all
+
+    Returns:
+    pd.DataFrame: the points kept
+    """
+    if isinstance(df, gs_engine.Table):
+        return df.thin({axis: (opts[axis + '_axis'], opts[axis + '_scale'])
+                        for axis in ['x', 'y']},
+                       THIN_BINS, THIN_CELL_ROWS, EXTREME_ROWS,
+                       group_fields, columns)
+    values, valid = scaled_values(df, opts)
+    cells, _ = grid_cells(values, valid, THIN_BINS)
+    if cells is None:
+        return df.iloc[:0] if columns is None else df.iloc[:0][columns]
+    positions = np.flatnonzero(valid)
+    if group_fields:
+        codes = (df.groupby(list(group_fields), observed=True,
+                            dropna=False, sort=False)
+                 .ngroup()
+                 .to_numpy()[valid])
+        cells = codes * THIN_BINS ** 2 + cells
+    rank = gs_sample.group_ranks(cells,
+                                 gs_sample.priorities(df.index[valid]))
+    keep = [positions[rank < THIN_CELL_ROWS]]
+    for axis in ['x', 'y']:
+        v = values[axis][valid]
+        if len(v) > 2 * EXTREME_ROWS:
+            keep.append(positions[np.argpartition(v, EXTREME_ROWS)
+                                  [:EXTREME_ROWS]])
+            keep.append(positions[np.argpartition(v, -EXTREME_ROWS)
+                                  [-EXTREME_ROWS:]])
+    thinned = df.iloc[np.unique(np.concatenate(keep))]
+    return thinned if columns is None else thinned.loc[:, columns]
+
+
+def plot_xy_thinned(df: pd.DataFrame,
+                    opts: dict,
+                    opts_type: dict,
+                    highlight: pd.DataFrame=None) -> alt.Chart:
+    """
+    XY plot of the points kept by thin_points, with averages of all rows
+
+    Parameters:
+    df (pd.DataFrame): input data
+    opts (dict): plot options
+    opts_type (dict): option types, see plot_xy
+    highlight (pd.DataFrame): rows drawn even if thinned out
+
+    Returns:
+    alt.Chart: the chart
+    """
+    group_fields = get_group_fields(opts)
+    columns = list(dict.fromkeys(
+        f for f in [opts['x_axis'], opts['y_axis'], *group_fields,
+                    opts['size_by'], opts['shape_by'],
+                    *opts['add_tooltips']]
+        if f is not None))
+    key = (*gs_tasks.frame_key(df), tuple(group_fields), tuple(columns),
+           *(opts[k] for k in ['x_axis', 'y_axis', 'x_scale', 'y_scale']))
+    points = gs_tasks.run('thin', key, thin_points, df, opts,
+                          group_fields, columns)
+    if highlight is not None and len(highlight):
+        if isinstance(df, gs_engine.Table):
+            points = pd.concat([points, highlight.loc[:, columns]],
+                               ignore_index=True)
+        else:
+            points = pd.concat([points, highlight.loc[
+                ~highlight.index.isin(points.index), columns]])
+    st.caption(f'{len(points)} of {len(df)} points drawn, dense regions '
+               f'are thinned')
+    average = (average_points(df, opts, group_fields)
+               if opts['show_average'] else None)
+    return plot_xy(points, opts, opts_type, average=average)
+
+
+def plot_xy_density(df: pd.DataFrame,
+                    opts: dict,
+                    highlight: pd.DataFrame=None) -> alt.Chart:
+    """
+    XY plot drawn as a density of binned counts computed server-side
+
+    Parameters:
+    df (pd.DataFrame): input data
+    opts (dict): plot options
+    highlight (pd.DataFrame): rows drawn as individual points on top
+
+    Returns:
+    alt.Chart: the layered chart
+    """
+    group_fields = get_group_fields(opts)
+    key = (*gs_tasks.frame_key(df), tuple(group_fields),
+           *(opts[k] for k in ['x_axis', 'y_axis', 'x_scale', 'y_scale',
+                               'density_bins']))
+    counts = gs_tasks.run('density', key, density_counts, df, opts,
+                          group_fields)
+    layers = [counts.assign(_layer='density')]
+    point_fields = list(dict.fromkeys([opts['x_axis'], opts['y_axis'],
+                                       *group_fields,
+                                       *opts['add_tooltips']]))
+    if highlight is None or not len(highlight):
+        # no rows, but typed columns for the point layer encodings
+        highlight = gs_engine.schema(df)
+    layers.append(highlight.loc[:, point_fields].assign(_layer='points'))
+    if opts['show_average']:
+        layers.append(average_points(df, opts, group_fields)
+                      .assign(_layer='average'))
+    # single dataset with a layer tag, so that layers can be faceted
+    data = pd.concat(layers, ignore_index=True)
+
+    x_title = opts['x_axis']
+    y_title = opts['y_axis']
+    x_scale = gsu.get_axis_scale(opts['x_scale'])
+    y_scale = gsu.get_axis_scale(opts['y_scale'])
+    axis = alt.Axis(tickCount=9, format = '2.4g')
+    kwds = {'x': alt.X('x0:Q', title=x_title, scale=x_scale, axis=axis),
+            'x2': alt.X2('x1:Q'),
+            'y': alt.Y('y0:Q', title=y_title, scale=y_scale, axis=axis),
+            'y2': alt.Y2('y1:Q'),
+            'tooltip': [alt.Tooltip('count:Q')] + group_fields}
+    if opts['color_by'] is not None:
+        # overlapping groups: hue by group, opacity by density
+        kwds['color'] = alt.Color(opts['color_by'],
+                                  scale=alt.Scale(scheme='tableau10'),
+                                  legend=alt.Legend(orient='right'))
+        kwds['opacity'] = alt.Opacity('count:Q',
+                                      scale=alt.Scale(type='log',
+                                                      range=[0.2, 1]),
+                                      legend=None)
+    else:
+        kwds['color'] = alt.Color('count:Q',
+                                  scale=alt.Scale(type='log',
+                                                  scheme='viridis'),
+                                  title='Count')
+    point_kwds = {'x': alt.X(opts['x_axis'], title=x_title, scale=x_scale,
+                             axis=axis),
+                  'y': alt.Y(opts['y_axis'], title=y_title, scale=y_scale,
+                             axis=axis)}
+    if opts['color_by'] is not None:
+        point_kwds['color'] = alt.Color(opts['color_by'])
+
+    base = alt.Chart().properties(width=opts['width'],
+                                  height=opts['height'])
+    h_density = (base
+                 .mark_rect()
+                 .encode(**kwds)
+                 .transform_filter(alt.datum._layer == 'density'))
+    brush = get_brush(opts)
+    if brush is not None:
+        h_density = h_density.add_params(brush)
+    h_points = (base
+                .mark_point(filled=True, size=opts['size'],
+                            color=opts['color'], stroke='black',
+                            strokeWidth=1)
+                .encode(**point_kwds,
+                        tooltip=[*opts['add_tooltips'],
+                                 alt.Tooltip(opts['x_axis'], format="0.2f"),
+                                 alt.Tooltip(opts['y_axis'], format="0.2f")])
+                .transform_filter(alt.datum._layer == 'points'))
+    h_avg = (base
+             .mark_point(filled=True, strokeWidth=4, size=120,
+                         opacity=0.8, color=opts['color'])
+             .encode(**point_kwds)
+             .transform_filter(alt.datum._layer == 'average'))
+    chart = alt.layer(h_density, h_points, h_avg, data=data)
+
+    facet_kwds = {}
+    facet_header = alt.Header(titleFontSize=20,
+                              labelFontSize=20,
+                              labelAnchor='middle',
+                              labelColor='#808080',
+                              labelFontWeight='normal',
+                              titleFontWeight='bold',
+                              titleAnchor='middle',
+                              labelAlign='center')
+    if opts['column_facet'] is not None:
+        facet_kwds['column'] = alt.Facet(opts['column_facet'],
+                                         header=facet_header)
+    if opts['row_facet'] is not None:
+        facet_kwds['row'] = alt.Facet(opts['row_facet'],
+                                      header=facet_header)
+    if facet_kwds:
+        chart = chart.facet(**facet_kwds)
+
+    chart = (chart
+             .configure_axis(labelFontSize=16,
+                        titleFontSize=16,
+                        titleFontWeight='bold')
+             .configure_view(stroke='#808080',
+                        strokeWidth=1.5))
+    return gsu.set_chart_name(chart, opts['plot_name'])
+
+
 def get_xy_options(ctypes):
 
     mark_props={
@@ -164,6 +619,11 @@ def get_xy_options(ctypes):
                                                 **scale_props['x_scale'])
                 opts['y_scale'] = st.selectbox('Y-Axis Scale:',
                                                 **scale_props['y_scale'])
+                opts['density_bins'] = st.slider('Density bins:',
+                                                 min_value=10,
+                                                 max_value=300,
+                                                 step=10,
+                                                 value=100)
                 opts['width'] = st.slider('Plot width:',
                                         min_value=50,
                                         max_value=1000,
@@ -188,7 +648,21 @@ def get_xy_options(ctypes):
                                                 **mark_props['color'])
                 opts['filled'] = st.checkbox('Fill Markers:',
                                             **mark_props['filled'])
+            auto_thins = (f'thins above {POINT_ROWS} rows and '
+                          if POINT_ROWS < DENSITY_ROWS else '')
+            opts['render_mode'] = st.segmented_control(
+                'Render:',
+                ['Auto', 'Points', 'Thinned', 'Density'],
+                default='Auto',
+                help=f'''Thinned draws all outliers and sparse points
+                but only some points of dense regions, Density bins the
+                points server-side. Auto {auto_thins}uses density above
+                {DENSITY_ROWS} rows''') or 'Auto'
             opts['show_average'] = st.checkbox('Show Averages', value = False)
+            opts['select_rows'] = st.checkbox(
+                'Select rows', value=False,
+                help='''Drag on the plot to restrict the table, Describe
+                and other plots to the selected x and y ranges''')
             opts['x_axis'] = st.selectbox('X-Axis:',
                                         ctypes['num_columns'],
                                         index=default_x)
@@ -196,7 +670,7 @@ def get_xy_options(ctypes):
                                         ctypes['num_columns'],
                                         index=default_y)
             opts['color_by'] = st.selectbox('Color:',
-                                            ctypes['cat_columns'],
+                                            ctypes['group_columns'],
                                             label_visibility='collapsed',
                                             placeholder='Color by',
                                             index=None)
@@ -211,12 +685,12 @@ def get_xy_options(ctypes):
                                             placeholder='Shape by',
                                             index=None)
             opts['column_facet'] = st.selectbox('Column Facet:',
-                                                ctypes['cat_columns'],
+                                                ctypes['group_columns'],
                                                 label_visibility='collapsed',
                                                 placeholder='Column facet',
                                                 index=None)
             opts['row_facet'] = st.selectbox('Row Facet:',
-                                            ctypes['cat_columns'],
+                                            ctypes['group_columns'],
                                             label_visibility='collapsed',
                                             placeholder='Row facet',
                                             index=None)